@@ -4,87 +4,39 @@ import psycopg2
 import csv
 import os
 import logging
+import time
+import argparse
+from datetime import datetime
 from psycopg2 import sql
+from bulk_copy import copy_rows, upsert_rows
+from batch_writer import write_isolated, merge_counts
+from partitions import is_partitioned, ensure_month_partitions, replace_month_partition, month_start
+from db import DB_CONFIG_TARGET, connect_db, close_db, close_pools
+from parallel_ingest import ingest_files, merge_stats, DEFAULT_WRITERS
+from manifest import IngestionManifest
+from checkpoints import FileCheckpoint, batches, DEFAULT_BATCH_ROWS
+from resolvers import get_resolver, set_fuzzy_matching, log_resolver_stats
+from quarantine import (Quarantine, replay, FORMAT_INVALIDE, QUANTITE_INVALIDE, DATE_INVALIDE,
+                        REFERENCE_MANQUANTE, REFERENCE_INCONNUE, REFUS_BASE)
+from log_config import setup_logging
+from metrics import record_file
 
 # --- Configuration ---
-DB_CONFIG = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Base de données cible (AEP_HARMONISE) : voir db.py
 
 # Utiliser le répertoire du script comme dossier CSV
 DOSSIER_CSV = os.path.dirname(os.path.abspath(__file__))
 
 # --- Logging ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('migration_eau_brute.log'),
-        logging.StreamHandler()
-    ]
-)
+setup_logging('migration_eau_brute.log')
 
 # --- Fonctions Utilitaires ---
-def connect_db(config):
-    try:
-        conn = psycopg2.connect(**config)
-        conn.autocommit = False
-        logging.info("Connexion à la base de données réussie")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Échec de connexion à la base de données: {e}")
-        raise
-
-def close_db(conn):
-    if conn:
-        try:
-            conn.close()
-            logging.info("Connexion à la base de données fermée")
-        except psycopg2.Error as e:
-            logging.error(f"Erreur lors de la fermeture de la connexion: {e}")
-
 def get_captage_id(cur, nom_captage):
-    """Récupère l'ID du captage par son nom (insensible à la casse)
-       Cas spécial : si nom_captage == 'VATOSOLA', on cherche d'abord 'BARRAGE 1 - VATOSOLA'
+    """Récupère l'ID du captage par son nom (insensible à la casse), en mémoire.
+       Les orthographes particulières (ex: 'VATOSOLA' -> 'BARRAGE 1 - VATOSOLA') sont
+       déclarées dans la table reference_alias.
     """
-    try:
-        if nom_captage.strip().upper() == "VATOSOLA":
-            # Recherche prioritaire 'BARRAGE 1 - VATOSOLA'
-            cur.execute("""
-                SELECT id_capt FROM captage 
-                WHERE UPPER(TRIM(libelle_capt)) = UPPER(TRIM(%s))
-                LIMIT 1;
-            """, ("BARRAGE 1 - VATOSOLA",))
-            result = cur.fetchone()
-            if result:
-                return result[0]
-
-            # Sinon recherche simple 'VATOSOLA'
-            cur.execute("""
-                SELECT id_capt FROM captage 
-                WHERE UPPER(TRIM(libelle_capt)) = UPPER(TRIM(%s))
-                LIMIT 1;
-            """, (nom_captage,))
-            result = cur.fetchone()
-            return result[0] if result else None
-
-        else:
-            # Cas normal 
-            cur.execute("""
-                SELECT id_capt FROM captage 
-                WHERE UPPER(TRIM(libelle_capt)) = UPPER(TRIM(%s))
-                LIMIT 1;
-            """, (nom_captage,))
-            result = cur.fetchone()
-            return result[0] if result else None
-
-    except psycopg2.Error as e:
-        logging.error(f"Erreur recherche captage {nom_captage}: {e}")
-        return None
+    return get_resolver(cur.connection, 'captage').resolve(nom_captage)
 
 
 def check_duplicate_data(cur, date, captage_id):
@@ -100,10 +52,8 @@ def check_duplicate_data(cur, date, captage_id):
         logging.error(f"Erreur vérification doublon: {e}")
         return False
 
-def process_csv_file(conn, file_path):
-    """Traite un fichier CSV et insère les données dans la base"""
-    cursor = conn.cursor()
-    stats = {
+def _file_stats():
+    return {
         'total': 0, 
         'success': 0, 
         'errors': 0, 
@@ -111,149 +61,471 @@ def process_csv_file(conn, file_path):
         'skipped_empty': 0,
         'null_quantite': 0,
         'null_date': 0,
-        'duplicates': 0  # Nouveau compteur pour les doublons
+        'duplicates': 0,  # Nouveau compteur pour les doublons
+        'updated': 0,
+        'other_month': 0,
+        'rejected': 0  # lignes refusées par la base (voir batch_writer.py)
     }
-    
-    try:
-        with open(file_path, 'r', encoding='utf-8') as csvfile:
-            csvreader = csv.reader(csvfile)
+
+def parse_rows(rows, stats):
+    """Valide des lignes CSV numérotées [(ligne, [quantite, date, nom_captage])].
+    Retourne (enregistrements (ligne, quantite, date, nom_captage), rejets (ligne, motif, ligne brute, détail)).
+    """
+    records = []
+    rejects = []
+
+    for line, row in rows:
+        try:
+            # Vérifier si la ligne a au moins 3 colonnes
+            if len(row) < 3:
+                stats['errors'] += 1
+                rejects.append((line, FORMAT_INVALIDE, row, f"{len(row)} colonne(s)"))
+                continue
+            
+            quantite_str, date_str, nom_captage = row
             
-            for row in csvreader:
+            # Nettoyage des valeurs
+            quantite_str = quantite_str.strip()
+            date_str = date_str.strip()
+            nom_captage = nom_captage.strip()
+            
+            # Cas 1: Les deux champs sont vides → ignorer la ligne
+            if not quantite_str and not date_str:
+                stats['skipped_empty'] += 1
+                continue
+            
+            stats['total'] += 1
+            
+            # Conversion des valeurs
+            quantite = None
+            if quantite_str:
                 try:
-                    # Vérifier si la ligne a au moins 3 colonnes
-                    if len(row) < 3:
-                        stats['errors'] += 1
-                        continue
-                    
-                    quantite_str, date_str, nom_captage = row
-                    
-                    # Nettoyage des valeurs
-                    quantite_str = quantite_str.strip()
-                    date_str = date_str.strip()
-                    nom_captage = nom_captage.strip()
-                    
-                    # Cas 1: Les deux champs sont vides → ignorer la ligne
-                    if not quantite_str and not date_str:
-                        stats['skipped_empty'] += 1
-                        continue
-                    
-                    stats['total'] += 1
-                    
-                    # Conversion des valeurs
-                    quantite = None
-                    if quantite_str:
-                        try:
-                            quantite = float(quantite_str.replace(',', '.'))
-                        except ValueError:
-                            stats['errors'] += 1
-                            continue
-                    else:
-                        stats['null_quantite'] += 1
-                    
-                    # Validation de la date
-                    date = None
-                    if date_str:
-                        if len(date_str) == 10 and date_str.count('-') == 2:
-                            date = date_str
-                        else:
-                            stats['errors'] += 1
-                            continue
-                    else:
-                        stats['null_date'] += 1
-                    
-                    # Recherche du captage (obligatoire)
-                    if not nom_captage:
-                        stats['errors'] += 1
-                        continue
-                        
-                    captage_id = get_captage_id(cursor, nom_captage)
-                    if not captage_id:
-                        stats['no_captage'] += 1
-                        continue
-                    
-                    # Vérification des doublons avant insertion
-                    if check_duplicate_data(cursor, date, captage_id):
-                        stats['duplicates'] += 1
-                        logging.debug(f"Doublon ignoré: captage {captage_id}, date {date}")
-                        continue
-                    
-                    # Insertion dans la base
-                    cursor.execute("""
-                        INSERT INTO eau_brute (quantite, date, id_capt)
-                        VALUES (%s, %s, %s)
-                    """, (quantite, date, captage_id))
-                    
-                    stats['success'] += 1
-                    
-                except Exception as e:
+                    quantite = float(quantite_str.replace(',', '.'))
+                except ValueError:
+                    stats['errors'] += 1
+                    rejects.append((line, QUANTITE_INVALIDE, row, quantite_str))
+                    continue
+            else:
+                stats['null_quantite'] += 1
+            
+            # Validation de la date (dates impossibles, ex: 2023-02-30, comprises)
+            date = None
+            if date_str:
+                try:
+                    date = datetime.strptime(date_str, '%Y-%m-%d').date().isoformat()
+                except ValueError:
                     stats['errors'] += 1
-                    logging.error(f"Erreur traitement ligne: {row} - {str(e)}")
+                    rejects.append((line, DATE_INVALIDE, row, date_str))
                     continue
+            else:
+                stats['null_date'] += 1
+            
+            # Nom du captage (obligatoire)
+            if not nom_captage:
+                stats['errors'] += 1
+                rejects.append((line, REFERENCE_MANQUANTE, row, None))
+                continue
+
+            records.append((line, quantite, date, nom_captage))
+            
+        except Exception as e:
+            stats['errors'] += 1
+            rejects.append((line, FORMAT_INVALIDE, row, str(e)))
+            logging.error(f"Erreur traitement ligne: {row} - {str(e)}")
+            continue
+
+    return records, rejects
+
+def parse_csv_file(file_path):
+    """Lit et valide un fichier CSV, sans accès à la base (exécutable dans un processus
+    de l'ingestion parallèle). Retourne (enregistrements (ligne, quantite, date, nom_captage), stats,
+    rejets (ligne, motif, ligne brute, détail)).
+    """
+    stats = _file_stats()
+    with open(file_path, 'r', encoding='utf-8') as csvfile:
+        records, rejects = parse_rows(enumerate(csv.reader(csvfile), 1), stats)
+    return records, stats, rejects
+
+def quarantine_rejects(quarantine, file_path, rejects):
+    """Met en quarantaine les lignes rejetées à la lecture (contenu brut de la ligne CSV)"""
+    if quarantine is not None:
+        for line, reason, row, detail in rejects:
+            quarantine.add(reason, row, file_path, line, detail)
+
+def raw_row(quantite, date, nom):
+    """Ligne CSV brute d'un enregistrement validé (contenu mis en quarantaine)"""
+    return ['' if quantite is None else str(quantite), date or '', nom]
+
+def quarantine_refused(quarantine, file_path, records, lines, rejected):
+    """Met en quarantaine les lignes refusées par la base (rejected de write_isolated ;
+    lines : numéro de ligne de chaque ligne écrite)"""
+    if quarantine is None or not rejected:
+        return
+    by_line = {record[0]: record for record in records}
+    for position, _, message in rejected:
+        line = lines[position]
+        quarantine.add(REFUS_BASE, raw_row(*by_line[line][1:]), file_path, line, message)
+
+def write_batch(cursor, file_path, records, rows, lines, stats, on_conflict, quarantine, label, seen_keys=None,
+                create_partitions=True):
+    """Écrit les lignes d'un lot sous SAVEPOINT (voir batch_writer.py) : les lignes refusées
+    par la base sont isolées et mises en quarantaine (leur clé n'est pas retenue dans
+    seen_keys), les autres sont écrites"""
+    written, rejected = write_isolated(cursor, lambda c, part: write_rows(c, part, on_conflict, create_partitions),
+                                       rows, label=label)
+    for key, value in merge_counts(written).items():
+        stats[key] += value
+    stats['rejected'] += len(rejected)
+    quarantine_refused(quarantine, file_path, records, lines, rejected)
+    if seen_keys is not None:
+        seen_keys.difference_update((row[1], row[2]) for _, row, _ in rejected)
+
+def resolve_records(cursor, records, stats, reload_month=None, check_database=False, seen_keys=None,
+                    quarantine=None, file_path=None, lines=None):
+    """Résout les captages (en mémoire) et écarte les doublons et les lignes hors du mois
+    rechargé. check_database : contrôle des doublons déjà en base par SELECT (mode 'copy').
+    seen_keys : clés déjà retenues par les lots précédents du fichier ou, en rechargement
+    mensuel, par les fichiers précédents (un doublon entre fichiers ferait échouer l'ATTACH).
+    quarantine : les lignes de référence inconnue y sont mises avec leur fichier et leur ligne.
+    lines : liste complétée du numéro de ligne CSV de chaque ligne retournée.
+    Retourne les lignes (quantite, date, id_capt) à écrire.
+    """
+    pending_rows = []
+    # (date, id) déjà mis en attente (partagé entre les lots d'un fichier, ou entre les fichiers du mois rechargé)
+    pending_keys = seen_keys if seen_keys is not None else set()
+
+    for line, quantite, date, nom_captage in records:
+        captage_id = get_captage_id(cursor, nom_captage)
+        if not captage_id:
+            stats['no_captage'] += 1
+            if quarantine is not None:
+                quarantine.add(REFERENCE_INCONNUE, raw_row(quantite, date, nom_captage),
+                               file_path, line, f"Captage inconnu: {nom_captage}")
+            continue
+        
+        # Mode rechargement : lignes hors du mois rechargé ignorées
+        if reload_month and month_start(date) != reload_month:
+            stats['other_month'] += 1
+            continue
         
+        # Vérification des doublons avant insertion
+        if (date, captage_id) in pending_keys or \
+           (check_database and check_duplicate_data(cursor, date, captage_id)):
+            stats['duplicates'] += 1
+            logging.debug(f"Doublon ignoré: captage {captage_id}, date {date}")
+            continue
+        
+        # Mise en attente pour l'insertion en masse
+        pending_keys.add((date, captage_id))
+        pending_rows.append((quantite, date, captage_id))
+        if lines is not None:
+            lines.append(line)
+
+    return pending_rows
+
+def write_rows(cursor, rows, on_conflict='nothing', create_partitions=True):
+    """Écrit les lignes (quantite, date, id_capt) ; retourne {'success', 'updated', 'duplicates'}"""
+    # Partitions mensuelles manquantes créées avant l'écriture
+    if create_partitions and is_partitioned(cursor, 'eau_brute'):
+        ensure_month_partitions(cursor, 'eau_brute', [r[1] for r in rows])
+    if on_conflict == 'copy':
+        # Insertion par COPY de toutes les lignes valides du fichier
+        return {'success': copy_rows(cursor, 'eau_brute', ('quantite', 'date', 'id_capt'), rows),
+                'updated': 0, 'duplicates': 0}
+    # Insertion idempotente : les relevés déjà en base sont ignorés ou mis à jour.
+    # Tri sur la clé : des écrivains concurrents verrouillent les lignes dans le même ordre
+    rows = sorted(rows, key=lambda r: (r[2], str(r[1])))
+    counts = upsert_rows(cursor, 'eau_brute', ('quantite', 'date', 'id_capt'), rows,
+                         ('id_capt', 'date'), on_conflict)
+    return {'success': counts['inserted'] + counts['updated'],
+            'updated': counts['updated'], 'duplicates': counts['skipped']}
+
+def record_file_metrics(file_path, stats, seconds=None):
+    """Lignes du fichier pour le rapport d'exécution (voir metrics.py)"""
+    record_file(file_path, read=stats['total'] + stats['skipped_empty'],
+                written=stats['success'],  # relevés mis à jour compris
+                rejected=stats['errors'] + stats['rejected'] + stats['no_captage'], seconds=seconds,
+                input_dir=DOSSIER_CSV)
+
+def log_file_stats(file_path, stats):
+    logging.info(
+        f"Fichier {os.path.basename(file_path)} traité. "
+        f"Total: {stats['total']}, Succès: {stats['success']}\n"
+        f"Détail: "
+        f"Lignes ignorées (vides): {stats['skipped_empty']}, "
+        f"Quantités NULL: {stats['null_quantite']}, "
+        f"Dates NULL: {stats['null_date']}, "
+        f"Erreurs: {stats['errors']}, "
+        f"Captages non trouvés: {stats['no_captage']}, "
+        f"Doublons ignorés: {stats['duplicates']}, "  # Ajout du compteur de doublons
+        f"Mis à jour: {stats['updated']}, "
+        f"Refusées par la base: {stats['rejected']}"
+    )
+
+def process_csv_file(conn, file_path, reload_month=None, reload_rows=None, on_conflict='nothing',
+                     manifest=None, resume=False, batch_rows=DEFAULT_BATCH_ROWS, quarantine=None,
+                     reload_keys=None):
+    """Traite un fichier CSV et insère les données dans la base
+
+    on_conflict: 'nothing' / 'update' écrivent par INSERT ... ON CONFLICT sur la clé
+    (date, id) ; 'copy' conserve la vérification des doublons par SELECT puis COPY.
+
+    Mode rechargement (reload_month): seules les lignes du mois sont retenues, sans
+    recherche de doublons en base, et ajoutées à reload_rows au lieu d'être écrites ;
+    reload_keys (partagé entre les fichiers) écarte les doublons d'un fichier à l'autre.
+
+    Sinon, les lignes sont écrites par lots de batch_rows, une transaction par lot avec son
+    point de reprise (voir checkpoints.py) ; resume repart après le dernier lot validé.
+    Le fichier est enregistré dans manifest avec son dernier lot.
+    Les lignes rejetées sont mises en quarantaine (voir quarantine.py), validées avec les lots.
+    """
+    cursor = conn.cursor()
+    
+    try:
+        records, stats, rejects = parse_csv_file(file_path)
+        quarantine_rejects(quarantine, file_path, rejects)
+        
+        if reload_month:
+            # Écriture différée : la partition du mois est remplacée en une fois par l'appelant
+            pending_rows = resolve_records(cursor, records, stats, reload_month, seen_keys=reload_keys,
+                                           quarantine=quarantine, file_path=file_path)
+            reload_rows.extend(pending_rows)
+            stats['success'] = len(pending_rows)
+        else:
+            checkpoint = FileCheckpoint(conn, 'eau_brute', file_path, resume=resume, manifest=manifest)
+            if quarantine is not None and checkpoint.next_batch == 0:
+                quarantine.forget_file(cursor, file_path)  # fichier retraité depuis le début
+            seen_keys = set()
+            for batch_index, start, batch in batches(records, batch_rows):
+                if checkpoint.skip(batch_index):
+                    continue
+                lines = []
+                pending_rows = resolve_records(cursor, batch, stats, check_database=(on_conflict == 'copy'),
+                                               seen_keys=seen_keys, quarantine=quarantine, file_path=file_path,
+                                               lines=lines)
+                write_batch(cursor, file_path, batch, pending_rows, lines, stats, on_conflict, quarantine,
+                            f"{os.path.basename(file_path)} lot {batch_index}", seen_keys)
+                checkpoint.save(cursor, batch_index, start + len(batch), batch)
+                if quarantine is not None:
+                    quarantine.flush(cursor)
+                conn.commit()
+            checkpoint.clear(cursor)
+            stats['resumed_from'] = checkpoint.next_row
+        if quarantine is not None:
+            quarantine.flush(cursor)
+        if manifest:
+            manifest.record(file_path, stats)
         conn.commit()
-        logging.info(
-            f"Fichier {os.path.basename(file_path)} traité. "
-            f"Total: {stats['total']}, Succès: {stats['success']}\n"
-            f"Détail: "
-            f"Lignes ignorées (vides): {stats['skipped_empty']}, "
-            f"Quantités NULL: {stats['null_quantite']}, "
-            f"Dates NULL: {stats['null_date']}, "
-            f"Erreurs: {stats['errors']}, "
-            f"Captages non trouvés: {stats['no_captage']}, "
-            f"Doublons ignorés: {stats['duplicates']}"  # Ajout du compteur de doublons
-        )
+        log_file_stats(file_path, stats)
         return stats
         
     except Exception as e:
         conn.rollback()
+        if quarantine is not None:
+            quarantine.discard()
         logging.error(f"ERREUR fichier {file_path}: {e}")
         raise
+
+def replay_file(cursor, file_path, entries, quarantine, on_conflict='nothing'):
+    """Retraite les lignes en quarantaine d'un fichier (voir quarantine.replay) : la ligne CSV
+    brute est revalidée, résolue et écrite ; les lignes encore rejetées y retournent."""
+    stats = _file_stats()
+    records, rejects = parse_rows(((entry.source_line, entry.payload) for entry in entries), stats)
+    quarantine_rejects(quarantine, file_path, rejects)
+    lines = []
+    rows = resolve_records(cursor, records, stats, check_database=(on_conflict == 'copy'),
+                           quarantine=quarantine, file_path=file_path, lines=lines)
+    write_batch(cursor, file_path, records, rows, lines, stats, on_conflict, quarantine,
+                f"{os.path.basename(file_path)} (rejeu)")
+    return stats
+
+def _ingest_parallel(conn, file_paths, reload_month, reload_rows, reload_keys, on_conflict, workers, writers,
+                     quarantine=None):
+    """Lecture des fichiers dans workers processus, écriture par writers connexions"""
+    with conn.cursor() as cursor:
+        partitioned = is_partitioned(cursor, 'eau_brute')
+
+    def prepare(file_path, parsed):
+        records, stats, rejects = parsed
+        lines = []
+        with conn.cursor() as cursor:
+            # Rejets du fichier validés ici, avant l'envoi aux écrivains
+            if quarantine is not None and not reload_month:
+                quarantine.forget_file(cursor, file_path)
+            quarantine_rejects(quarantine, file_path, rejects)
+            rows = resolve_records(cursor, records, stats, reload_month,
+                                   check_database=(not reload_month and on_conflict == 'copy'),
+                                   seen_keys=reload_keys if reload_month else None,
+                                   quarantine=quarantine, file_path=file_path, lines=lines)
+            if quarantine is not None:
+                quarantine.flush(cursor)
+            if reload_month:
+                reload_rows.extend(rows)
+                stats['success'] = len(rows)
+                conn.commit()
+                return None, stats
+            # Partitions créées ici, une seule fois, avant l'envoi aux écrivains
+            if partitioned:
+                ensure_month_partitions(cursor, 'eau_brute', [r[1] for r in rows])
+        conn.commit()
+        return (file_path, records, rows, lines), stats
+
+    def write(writer_conn, batch):
+        # Lignes refusées isolées comme en séquentiel, mises en quarantaine dans la transaction de l'écrivain
+        if batch is None:
+            return {}
+        file_path, records, rows, lines = batch
+        counts = dict.fromkeys(('success', 'updated', 'duplicates', 'rejected'), 0)
+        refused = Quarantine(writer_conn, 'eau_brute') if quarantine is not None else None
+        with writer_conn.cursor() as cursor:
+            write_batch(cursor, file_path, records, rows, lines, counts, on_conflict, refused,
+                        os.path.basename(file_path), create_partitions=False)
+            if refused is not None:
+                refused.flush(cursor)
+        return counts
+
+    results, failures = ingest_files(os.path.abspath(__file__), 'parse_csv_file', file_paths,
+                                     prepare, write, workers, writers)
+    if quarantine is not None:
+        # Rejets écrits par les écrivains, comptés avec ceux de l'étape
+        quarantine.stats[REFUS_BASE] += sum(stats['rejected'] for stats in results.values())
+    for file_path, stats in results.items():
+        log_file_stats(file_path, stats)
+    return results, failures
         
 # --- Migration principale ---
-def migrate_eau_brute():
-    conn = None
+def migrate_eau_brute(reload_month=None, on_conflict='nothing', conn=None, workers=1, writers=DEFAULT_WRITERS,
+                      force=False, resume=False, replay_rejects=False):
+    """Charge tous les CSV du dossier ; avec reload_month, remplace uniquement la partition de ce mois.
+
+    workers > 1 : les fichiers sont lus et validés en parallèle (un processus par fichier)
+    puis écrits par au plus writers connexions, une transaction par fichier.
+
+    Mode incrémental (défaut) : seuls les fichiers nouveaux ou modifiés depuis leur dernier
+    chargement sont traités (voir manifest.py) ; force retraite tous les fichiers. Le
+    rechargement mensuel relit toujours tous les fichiers.
+
+    En lecture séquentielle, chaque fichier est écrit par lots avec point de reprise ;
+    resume repart du dernier lot validé des fichiers interrompus (voir checkpoints.py).
+
+    Les lignes rejetées sont mises en quarantaine (voir quarantine.py) ; replay_rejects
+    retraite seulement ces lignes, sans relire les fichiers.
+    """
+    own_conn = conn is None  # connexion fournie par le pipeline ou ouverte ici
+    reload_rows = []
+    reload_keys = set()  # (date, id_capt) retenus pour le mois rechargé, tous fichiers confondus
     global_stats = {
         'total': 0, 
         'success': 0, 
         'errors': 0, 
         'no_captage': 0,
-        'duplicates': 0  # Ajout du compteur global de doublons
+        'duplicates': 0,  # Ajout du compteur global de doublons
+        'updated': 0,
+        'rejected': 0
     }
     
     try:
-        conn = connect_db(DB_CONFIG)
+        if own_conn:
+            conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
+
+        if replay_rejects:
+            # Rejeu de la quarantaine seule, après correction des références
+            stats = replay(conn, 'eau_brute', lambda cursor, file_path, entries, quarantine:
+                           replay_file(cursor, file_path, entries, quarantine, on_conflict),
+                           written_keys=('success',))
+            log_resolver_stats('captage')
+            return stats
+        quarantine = Quarantine(conn, 'eau_brute')
         
-        # Parcourir tous les fichiers CSV du dossier
-        for filename in os.listdir(DOSSIER_CSV):
-            if filename.endswith('.csv'):
-                file_path = os.path.join(DOSSIER_CSV, filename)
-                logging.info(f"Traitement du fichier {filename}...")
+        # Tous les fichiers CSV du dossier, dans l'ordre des noms
+        file_paths = [os.path.join(DOSSIER_CSV, filename)
+                      for filename in sorted(os.listdir(DOSSIER_CSV)) if filename.endswith('.csv')]
+
+        # Fichiers déjà chargés et inchangés écartés (sauf rechargement mensuel)
+        manifest = None
+        if not reload_month:
+            manifest = IngestionManifest(conn, 'eau_brute', force=force)
+            file_paths = manifest.select(file_paths)
+
+        if workers > 1:
+            results, failures = _ingest_parallel(conn, file_paths, reload_month, reload_rows, reload_keys,
+                                                 on_conflict, workers, writers, quarantine)
+            merge_stats(global_stats, results)
+            global_stats['errors'] += len(failures)
+            for file_path, file_stats in results.items():
+                record_file_metrics(file_path, file_stats)
+            if manifest:
+                for file_path, file_stats in results.items():
+                    manifest.record(file_path, file_stats)
+                conn.commit()
+        else:
+            for file_path in file_paths:
+                logging.info(f"Traitement du fichier {os.path.basename(file_path)}...")
                 
+                started = time.perf_counter()
                 try:
-                    file_stats = process_csv_file(conn, file_path)
+                    file_stats = process_csv_file(conn, file_path, reload_month, reload_rows, on_conflict,
+                                                  manifest=manifest, resume=resume, quarantine=quarantine,
+                                                  reload_keys=reload_keys)
                     # Mise à jour des statistiques globales
-                    for key in file_stats:
-                        if key in global_stats:
-                            global_stats[key] += file_stats[key]
+                    merge_stats(global_stats, {file_path: file_stats})
+                    record_file_metrics(file_path, file_stats, time.perf_counter() - started)
                 
                 except Exception as e:
-                    logging.error(f"Échec traitement fichier {filename}: {e}")
+                    logging.error(f"Échec traitement fichier {os.path.basename(file_path)}: {e}")
                     global_stats['errors'] += 1
                     continue
         
+        if reload_month:
+            with conn.cursor() as cursor:
+                if not is_partitioned(cursor, 'eau_brute'):
+                    raise RuntimeError("Le rechargement mensuel nécessite une table eau_brute partitionnée")
+                replace_month_partition(cursor, 'eau_brute', reload_month, ('quantite', 'date', 'id_capt'), reload_rows)
+            conn.commit()
+        
+        global_stats['quarantined'] = sum(quarantine.stats.values())
+        quarantine.log_summary()
         logging.info(f"Migration terminée. Statistiques globales: {global_stats}")
+        log_resolver_stats('captage')
+        return global_stats
         
     except Exception as e:
         if conn: conn.rollback()
         logging.error(f"ERREUR GLOBALE: {str(e)}", exc_info=True)
         raise
     finally:
-        if conn: close_db(conn)
+        if conn and own_conn: close_db(conn, "Cible HARMONISE")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migration des données eau_brute depuis les fichiers CSV")
+    parser.add_argument("--reload-month", metavar="AAAA-MM",
+                        type=lambda v: datetime.strptime(v, '%Y-%m').date(),
+                        help="remplace uniquement la partition de ce mois")
+    parser.add_argument("--on-conflict", choices=['nothing', 'update', 'copy'], default='nothing',
+                        help="relevés déjà présents: ignorés (nothing), mis à jour (update), "
+                             "ou contrôle par SELECT avant COPY (copy)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="nombre de processus de lecture des fichiers (parallèle si > 1)")
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS,
+                        help="nombre de connexions d'écriture en mode parallèle")
+    parser.add_argument("--force", action="store_true",
+                        help="retraite tous les fichiers, y compris ceux déjà chargés et inchangés")
+    parser.add_argument("--resume", action="store_true",
+                        help="reprend les fichiers interrompus après leur dernier lot validé")
+    parser.add_argument("--replay-rejects", action="store_true",
+                        help="retraite seulement les lignes en quarantaine (après correction des captages ou des alias)")
+    parser.add_argument("--fuzzy", action="store_true",
+                        help="rapproche les noms inconnus par similarité de trigrammes (chaque rapprochement est journalisé)")
+    args = parser.parse_args()
+    set_fuzzy_matching(args.fuzzy)
+
     logging.info("Début migration des données eau_brute")
     try:
-        migrate_eau_brute()
+        migrate_eau_brute(reload_month=args.reload_month, on_conflict=args.on_conflict,
+                          workers=args.workers, writers=args.writers, force=args.force,
+                          resume=args.resume, replay_rejects=args.replay_rejects)
         logging.info("Migration réussie")
     except Exception as e:
-        logging.critical(f"Échec migration: {str(e)}")
\ No newline at end of file
+        logging.critical(f"Échec migration: {str(e)}")
+    finally:
+        close_pools()
@@ -2,173 +2,522 @@ import os
 import csv
 import psycopg2
 import logging
+import time
+import argparse
 from datetime import datetime
+from bulk_copy import copy_rows, upsert_rows
+from batch_writer import write_isolated, merge_counts
+from partitions import is_partitioned, ensure_month_partitions, replace_month_partition, month_start
+from db import DB_CONFIG_TARGET, connect_db, close_db, close_pools
+from manifest import IngestionManifest
+from checkpoints import FileCheckpoint, batches, DEFAULT_BATCH_ROWS
+from parallel_ingest import ingest_files, merge_stats, DEFAULT_WRITERS
+from resolvers import get_resolver, log_resolver_stats
+from dedup import KeyStore, row_key
+from quarantine import (Quarantine, replay, FORMAT_INVALIDE, QUANTITE_INVALIDE, DATE_INVALIDE,
+                        REFERENCE_MANQUANTE, REFERENCE_INCONNUE, REFUS_BASE)
+from log_config import setup_logging, RowLog
+from metrics import record_file
 
 # Configuration de la base de données
-DB_CONFIG = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Base de données cible (AEP_HARMONISE) : voir db.py
 
 # Configuration du logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('import_eau_distribue.log'),
-        logging.StreamHandler()
-    ]
-)
+setup_logging('import_eau_distribue.log')
 
 # Chemin du dossier contenant les fichiers CSV (répertoire du script)
 DOSSIER_CSV = os.path.dirname(os.path.abspath(__file__))
 
-def connect_db(config):
-    try:
-        conn = psycopg2.connect(**config)
-        conn.autocommit = False
-        logging.info("Connexion à la base de données réussie")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Échec de la connexion à la base de données: {e}")
-        raise
-
 def get_point_dist_id(conn, ref_borne):
-    """Trouve l'ID du point de distribution basé sur son ref borne"""
+    """Trouve l'ID du point de distribution basé sur son ref borne, en mémoire"""
     if not ref_borne:
         return None
-        
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT id_point_dist 
-                FROM point_de_distribution 
-                WHERE ref_borne = %s
-                LIMIT 1;
-            """, (ref_borne.strip(),))
-            result = cur.fetchone()
-            return result[0] if result else None
-    except psycopg2.Error as e:
-        logging.error(f"Erreur lors de la recherche du point de distribution '{ref_borne}': {e}")
-        return None
+    return get_resolver(conn, 'point_de_distribution').resolve(ref_borne)
 
-def import_csv_to_db():
-    """Importe les données des fichiers CSV vers la table eau_distribue"""
-    stats = {
-        'total_files': 0,
+def _file_stats():
+    return {
         'total_rows': 0,
         'inserted': 0,
         'skipped': 0,
         'errors': 0,
+        'rejected': 0,
         'points_not_found': 0,
-        'null_dates': 0
+        'null_dates': 0,
+        'duplicates': 0,
+        'updated': 0,
+        'other_month': 0,
+        'hash_duplicates': 0
     }
+
+def parse_rows(filename, rows, stats):
+    """Valide des lignes CSV numérotées [(ligne, [quantite, date, ref_borne])].
+    Retourne (enregistrements (ligne, quantite, date, ref_borne), rejets (ligne, motif, ligne brute, détail)).
+    """
+    records = []
+    rejects = []
+    null_date_log = RowLog(filename, 'à date vide (enregistrée(s) comme NULL)')
+
+    for row_num, row in rows:
+        try:
+            stats['total_rows'] += 1
+            
+            # Vérification du format de la ligne
+            if len(row) < 3:
+                stats['skipped'] += 1
+                rejects.append((row_num, FORMAT_INVALIDE, row, f"{len(row)} colonne(s)"))
+                logging.warning(f"{filename} ligne {row_num}: Format invalide (attendu: quantite,date,ref_borne)")
+                continue
+            
+            # Extraction des valeurs
+            quantite = row[0].strip()
+            date_str = row[1].strip() if len(row) > 1 else ''
+            ref_borne = row[2].strip() if len(row) > 2 else ''
+            
+            # Validation de la quantité
+            try:
+                quantite = float(quantite) if quantite else None
+            except ValueError:
+                stats['skipped'] += 1
+                rejects.append((row_num, QUANTITE_INVALIDE, row, quantite))
+                logging.warning(f"{filename} ligne {row_num}: Quantité invalide '{quantite}'")
+                continue
+            
+            # Traitement de la date (peut être vide)
+            date = None
+            if date_str:
+                try:
+                    date = datetime.strptime(date_str, '%Y-%m-%d').date()
+                except ValueError:
+                    stats['skipped'] += 1
+                    rejects.append((row_num, DATE_INVALIDE, row, date_str))
+                    logging.warning(f"{filename} ligne {row_num}: Date invalide '{date_str}' (format attendu: AAAA-MM-JJ)")
+                    continue
+            else:
+                stats['null_dates'] += 1
+                null_date_log.log("%s ligne %s: Date vide - sera enregistrée comme NULL", filename, row_num)
+            
+            # Validation du Ref borne
+            if not ref_borne:
+                stats['skipped'] += 1
+                rejects.append((row_num, REFERENCE_MANQUANTE, row, None))
+                logging.warning(f"{filename} ligne {row_num}: Ref borne manquant")
+                continue
+
+            records.append((row_num, quantite, date, ref_borne))
+            
+        except Exception as e:
+            stats['errors'] += 1
+            rejects.append((row_num, FORMAT_INVALIDE, row, str(e)))
+            logging.error(f"{filename} ligne {row_num}: Erreur - {str(e)}")
+            continue
+
+    if null_date_log.count:
+        null_date_log.summary()
+    return records, rejects
+
+def parse_csv_file(file_path):
+    """Lit et valide un fichier CSV, sans accès à la base (exécutable dans un processus
+    de l'ingestion parallèle). Retourne (enregistrements (ligne, quantite, date, ref_borne), stats,
+    rejets (ligne, motif, ligne brute, détail)).
+    """
+    stats = _file_stats()
+    with open(file_path, 'r', encoding='utf-8') as csvfile:
+        records, rejects = parse_rows(os.path.basename(file_path), enumerate(csv.reader(csvfile), 1), stats)
+    return records, stats, rejects
+
+def raw_row(quantite, date, ref_borne):
+    """Ligne CSV brute d'un enregistrement validé (contenu mis en quarantaine)"""
+    return ['' if quantite is None else str(quantite), date.isoformat() if date else '', ref_borne]
+
+def quarantine_rejects(quarantine, file_path, rejects):
+    """Met en quarantaine les lignes rejetées à la lecture (contenu brut de la ligne CSV)"""
+    if quarantine is not None:
+        for line, reason, row, detail in rejects:
+            quarantine.add(reason, row, file_path, line, detail)
+
+def quarantine_refused(quarantine, file_path, records, lines, rejected):
+    """Met en quarantaine les lignes refusées par la base (rejected de write_isolated ;
+    lines : numéro de ligne de chaque ligne écrite)"""
+    if quarantine is None or not rejected:
+        return
+    by_line = {record[0]: record for record in records}
+    for position, _, message in rejected:
+        line = lines[position]
+        quarantine.add(REFUS_BASE, raw_row(*by_line[line][1:]), file_path, line, message)
+
+def prepare_rows(conn, filename, records, stats, keys=None, reload_month=None, reload_keys=None,
+                 quarantine=None, file_path=None, lines=None):
+    """Écarte les doublons par empreinte, résout les points de distribution (en mémoire)
+    et filtre le mois rechargé. Retourne (lignes (quantite, date, id_point_dist), empreintes retenues).
+    quarantine : les points de distribution inconnus y sont mis avec leur fichier et leur ligne.
+    lines : complétée par les numéros de ligne des lignes retenues, dans le même ordre.
+    """
+    pending_rows = []
+    file_keys = []
+    for row_num, quantite, date, ref_borne in records:
+        try:
+            # Dédoublonnage par empreinte, sans requête en base
+            key = None
+            if keys is not None:
+                key = row_key(ref_borne, date, quantite)
+                if keys.seen_in_run(key):
+                    stats['hash_duplicates'] += 1
+                    continue
+
+            # Recherche de l'ID du point de distribution
+            id_point_dist = get_point_dist_id(conn, ref_borne)
+            if not id_point_dist:
+                stats['points_not_found'] += 1
+                logging.warning(f"{filename} ligne {row_num}: Point de distribution '{ref_borne}' non trouvé")
+                if quarantine is not None:
+                    quarantine.add(REFERENCE_INCONNUE, raw_row(quantite, date, ref_borne), file_path, row_num,
+                                   f"Point de distribution inconnu: {ref_borne}")
+                continue
+            
+            # Mode rechargement : lignes hors du mois rechargé ignorées
+            if reload_month and month_start(date) != reload_month:
+                stats['other_month'] += 1
+                continue
+            if reload_month:
+                # La partition rechargée porte la contrainte unique : doublons écartés ici
+                if (id_point_dist, date) in reload_keys:
+                    stats['duplicates'] += 1
+                    continue
+                reload_keys.add((id_point_dist, date))
+            
+            # Mise en attente pour l'insertion en masse
+            pending_rows.append((quantite, date, id_point_dist))
+            if lines is not None:
+                lines.append(row_num)
+            if key is not None:
+                keys.add(key)
+                file_keys.append(key)
+            
+        except Exception as e:
+            stats['errors'] += 1
+            logging.error(f"{filename} ligne {row_num}: Erreur - {str(e)}")
+            continue
+
+    return pending_rows, file_keys
+
+def write_rows(cur, rows, on_conflict='nothing', create_partitions=True):
+    """Écrit les lignes (quantite, date, id_point_dist) ; retourne {'inserted', 'updated', 'duplicates'}"""
+    # Partitions mensuelles manquantes créées avant l'écriture
+    if create_partitions and is_partitioned(cur, 'eau_distribue'):
+        ensure_month_partitions(cur, 'eau_distribue', [r[1] for r in rows])
+    if on_conflict == 'copy':
+        # Insertion par COPY de toutes les lignes valides du fichier
+        return {'inserted': copy_rows(cur, 'eau_distribue', ('quantite', 'date', 'id_point_dist'), rows),
+                'updated': 0, 'duplicates': 0}
+    # Insertion idempotente : les relevés déjà en base sont ignorés ou mis à jour.
+    # Tri sur la clé : des écrivains concurrents verrouillent les lignes dans le même ordre
+    rows = sorted(rows, key=lambda r: (r[2], str(r[1])))
+    counts = upsert_rows(
+        cur, 'eau_distribue', ('quantite', 'date', 'id_point_dist'), rows,
+        ('id_point_dist', 'date'), on_conflict
+    )
+    return {'inserted': counts['inserted'], 'updated': counts['updated'], 'duplicates': counts['skipped']}
+
+def record_file_metrics(file_path, stats, seconds=None):
+    """Lignes du fichier pour le rapport d'exécution (voir metrics.py)"""
+    record_file(file_path, read=stats['total_rows'], written=stats['inserted'] + stats['updated'],
+                rejected=stats['skipped'] + stats['points_not_found'] + stats['rejected'] + stats['errors'],
+                seconds=seconds, input_dir=DOSSIER_CSV)
+
+def log_file_stats(filename, stats):
+    logging.info(f"Fichier {filename} traité - {stats['total_rows']} lignes analysées, "
+                 f"{stats['hash_duplicates']} doublon(s) entre fichiers")
+
+def _ingest_parallel(conn, file_paths, keys, reload_month, reload_rows, reload_keys, on_conflict, workers, writers,
+                     quarantine=None):
+    """Lecture des fichiers dans workers processus, écriture par writers connexions"""
+    with conn.cursor() as cur:
+        partitioned = is_partitioned(cur, 'eau_distribue')
+    file_keys = {}
+    refused_keys = {}
+
+    def prepare(file_path, parsed):
+        records, file_stats, rejects = parsed
+        lines = []
+        rows, file_keys[file_path] = prepare_rows(conn, os.path.basename(file_path), records, file_stats,
+                                                  keys, reload_month, reload_keys, quarantine, file_path, lines)
+        # Rejets du fichier validés ici, avant l'envoi aux écrivains
+        with conn.cursor() as cur:
+            if quarantine is not None:
+                if not reload_month:
+                    quarantine.forget_file(cur, file_path)
+                quarantine_rejects(quarantine, file_path, rejects)
+                quarantine.flush(cur)
+            if reload_month:
+                reload_rows.extend(rows)
+            elif partitioned:
+                # Partitions créées ici, une seule fois, avant l'envoi aux écrivains
+                ensure_month_partitions(cur, 'eau_distribue', [r[1] for r in rows])
+        conn.commit()
+        if reload_month:
+            return None, file_stats
+        return (file_path, records, rows, lines), file_stats
+
+    def write(writer_conn, batch):
+        # Lignes refusées isolées comme en séquentiel, mises en quarantaine dans la transaction de l'écrivain
+        if batch is None:
+            return {}
+        file_path, records, rows, lines = batch
+        with writer_conn.cursor() as cur:
+            written, rejected = write_isolated(
+                cur, lambda c, part: write_rows(c, part, on_conflict, create_partitions=False), rows,
+                label=os.path.basename(file_path)
+            )
+            refused = Quarantine(writer_conn, 'eau_distribue') if quarantine is not None else None
+            quarantine_refused(refused, file_path, records, lines, rejected)
+            if refused is not None:
+                refused.flush(cur)
+        if keys is not None and rejected:
+            # Empreintes des relevés refusés non retenues : ils seront relus
+            positions = {position for position, _, _ in rejected}
+            refused_keys[file_path] = [file_keys[file_path][i] for i in positions]
+            file_keys[file_path] = [key for i, key in enumerate(file_keys[file_path]) if i not in positions]
+        counts = merge_counts(written)
+        counts['rejected'] = len(rejected)
+        return counts
+
+    def on_written(file_path, success):
+        if keys is not None:
+            keys.discard(refused_keys.pop(file_path, ()))
+            if success:
+                keys.commit(file_keys.pop(file_path, ()))
+            else:
+                keys.discard(file_keys.pop(file_path, ()))
+
+    results, failures = ingest_files(os.path.abspath(__file__), 'parse_csv_file', file_paths,
+                                     prepare, write, workers, writers, on_written)
+    if quarantine is not None:
+        # Rejets écrits par les écrivains, comptés avec ceux de l'étape
+        quarantine.stats[REFUS_BASE] += sum(file_stats['rejected'] for file_stats in results.values())
+    return results, failures
+
+def replay_file(conn, cur, file_path, entries, quarantine, on_conflict='nothing'):
+    """Retraite les lignes en quarantaine d'un fichier (voir quarantine.replay) : la ligne CSV
+    brute est revalidée, résolue et écrite ; les lignes encore rejetées y retournent.
+    Le dédoublonnage par empreinte ne s'applique pas : l'écriture reste idempotente par la clé."""
+    filename = os.path.basename(file_path)
+    stats = _file_stats()
+    records, rejects = parse_rows(filename, ((entry.source_line, entry.payload) for entry in entries), stats)
+    quarantine_rejects(quarantine, file_path, rejects)
+    lines = []
+    pending_rows, _ = prepare_rows(conn, filename, records, stats, quarantine=quarantine,
+                                   file_path=file_path, lines=lines)
+    written, rejected = write_isolated(cur, lambda c, rows: write_rows(c, rows, on_conflict), pending_rows,
+                                       label=f"{filename} (rejeu)")
+    for key, value in merge_counts(written).items():
+        stats[key] += value
+    stats['rejected'] += len(rejected)
+    quarantine_refused(quarantine, file_path, records, lines, rejected)
+    return stats
+
+def import_csv_to_db(reload_month=None, on_conflict='nothing', conn=None, dedup=True,
+                     workers=1, writers=DEFAULT_WRITERS, force=False, resume=False, replay_rejects=False):
+    """Importe les données des fichiers CSV vers la table eau_distribue
+
+    on_conflict: 'nothing' / 'update' écrivent par INSERT ... ON CONFLICT sur la clé
+    (id_point_dist, date), ce qui rend les réimports idempotents ; 'copy' insère sans contrôle.
+
+    Avec reload_month, seules les lignes de ce mois sont retenues et la partition
+    correspondante est remplacée en une fois après lecture de tous les fichiers.
+
+    dedup: les relevés identiques (ref_borne, date, quantite) de plusieurs fichiers de
+    l'exécution sont écartés avant écriture (voir dedup.py) ; les relevés des exécutions
+    précédentes le sont par la clé unique.
+
+    workers > 1 : les fichiers sont lus et validés en parallèle (un processus par fichier)
+    puis écrits par au plus writers connexions, une transaction par fichier.
+
+    Mode incrémental (défaut) : seuls les fichiers nouveaux ou modifiés depuis leur dernier
+    chargement sont traités (voir manifest.py) ; force retraite tous les fichiers. Le
+    rechargement mensuel relit toujours tous les fichiers.
+
+    En lecture séquentielle, chaque fichier est écrit par lots avec point de reprise ;
+    resume repart du dernier lot validé des fichiers interrompus (voir checkpoints.py).
+    Une ligne refusée par la base y est écartée seule, sans annuler le lot (voir batch_writer.py).
+
+    Les lignes rejetées (format, quantité, date, point de distribution inconnu, refus de la
+    base) sont mises en quarantaine avec leur contenu brut (voir quarantine.py) ;
+    replay_rejects ne retraite que ces lignes, en une transaction.
+    """
+    reload_rows = []
+    reload_keys = set()  # (id_point_dist, date) retenus pour le mois rechargé
+    stats = dict(_file_stats(), total_files=0, files={})
+    keys = None
+    quarantine = None
+    if dedup and not replay_rejects:
+        keys = KeyStore()
     
-    conn = None
+    own_conn = conn is None  # connexion fournie par le pipeline ou ouverte ici
     try:
         # 1. Connexion à la base de données
-        conn = connect_db(DB_CONFIG)
+        if own_conn:
+            conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
+
+        if replay_rejects:
+            stats = replay(conn, 'eau_distribue',
+                           lambda cur, file_path, entries, quarantine:
+                               replay_file(conn, cur, file_path, entries, quarantine, on_conflict),
+                           written_keys=('inserted', 'updated'))
+            log_resolver_stats('point_de_distribution')
+            return stats
+        quarantine = Quarantine(conn, 'eau_distribue')
         
-        # 2. Parcours des fichiers CSV dans le dossier
-        for filename in os.listdir(DOSSIER_CSV):
-            if not filename.lower().endswith('.csv'):
-                continue
-                
-            filepath = os.path.join(DOSSIER_CSV, filename)
-            stats['total_files'] += 1
-            logging.info(f"Traitement du fichier: {filename}")
-            
-            with open(filepath, 'r', encoding='utf-8') as csvfile:
-                csv_reader = csv.reader(csvfile)
+        # 2. Fichiers CSV du dossier, dans l'ordre des noms
+        file_paths = [os.path.join(DOSSIER_CSV, filename) for filename in sorted(os.listdir(DOSSIER_CSV))
+                      if filename.lower().endswith('.csv')]
+        stats['total_files'] = len(file_paths)
+
+        # Fichiers déjà chargés et inchangés écartés (sauf rechargement mensuel)
+        manifest = None
+        if not reload_month:
+            manifest = IngestionManifest(conn, 'eau_distribue', force=force)
+            file_paths = manifest.select(file_paths)
+
+        if workers > 1:
+            results, failures = _ingest_parallel(conn, file_paths, keys, reload_month, reload_rows, reload_keys,
+                                                 on_conflict, workers, writers, quarantine)
+            for file_path, file_stats in results.items():
+                stats['files'][os.path.basename(file_path)] = file_stats
+                log_file_stats(os.path.basename(file_path), file_stats)
+                record_file_metrics(file_path, file_stats)
+                if manifest:
+                    manifest.record(file_path, file_stats)
+            conn.commit()
+            stats['errors'] += len(failures)
+        else:
+            for file_path in file_paths:
+                filename = os.path.basename(file_path)
+                logging.info(f"Traitement du fichier: {filename}")
+                started = time.perf_counter()
+                try:
+                    records, file_stats, rejects = parse_csv_file(file_path)
                 
-                with conn.cursor() as cur:
-                    for row_num, row in enumerate(csv_reader, 1):
-                        try:
-                            stats['total_rows'] += 1
-                            
-                            # Vérification du format de la ligne
-                            if len(row) < 3:
-                                stats['skipped'] += 1
-                                logging.warning(f"{filename} ligne {row_num}: Format invalide (attendu: quantite,date,ref_borne)")
-                                continue
-                            
-                            # Extraction des valeurs
-                            quantite = row[0].strip()
-                            date_str = row[1].strip() if len(row) > 1 else ''
-                            ref_borne = row[2].strip() if len(row) > 2 else ''
-                            
-                            # Validation de la quantité
-                            try:
-                                quantite = float(quantite) if quantite else None
-                            except ValueError:
-                                stats['skipped'] += 1
-                                logging.warning(f"{filename} ligne {row_num}: Quantité invalide '{quantite}'")
-                                continue
-                            
-                            # Traitement de la date (peut être vide)
-                            date = None
-                            if date_str:
-                                try:
-                                    date = datetime.strptime(date_str, '%Y-%m-%d').date()
-                                except ValueError:
-                                    stats['skipped'] += 1
-                                    logging.warning(f"{filename} ligne {row_num}: Date invalide '{date_str}' (format attendu: AAAA-MM-JJ)")
+                    with conn.cursor() as cur:
+                        if reload_month:
+                            # Écriture différée : la partition du mois est remplacée après le dernier fichier
+                            quarantine_rejects(quarantine, file_path, rejects)
+                            pending_rows, file_keys = prepare_rows(conn, filename, records, file_stats,
+                                                                   keys, reload_month, reload_keys,
+                                                                   quarantine=quarantine, file_path=file_path)
+                            quarantine.flush(cur)
+                            reload_rows.extend(pending_rows)
+                            if keys is not None:
+                                keys.commit(file_keys)
+                        else:
+                            # Écriture par lots, chacun validé avec son point de reprise
+                            checkpoint = FileCheckpoint(conn, 'eau_distribue', file_path, resume=resume,
+                                                        manifest=manifest)
+                            if checkpoint.next_batch == 0:
+                                quarantine.forget_file(cur, file_path)
+                            # Rejets de lecture des lots déjà validés : réécrits à l'identique
+                            quarantine_rejects(quarantine, file_path, rejects)
+                            for batch_index, start, batch in batches(records, DEFAULT_BATCH_ROWS):
+                                if checkpoint.skip(batch_index):
                                     continue
-                            else:
-                                stats['null_dates'] += 1
-                                logging.info(f"{filename} ligne {row_num}: Date vide - sera enregistrée comme NULL")
-                            
-                            # Validation du Ref borne
-                            if not ref_borne:
-                                stats['skipped'] += 1
-                                logging.warning(f"{filename} ligne {row_num}: Ref borne manquant")
-                                continue
-                            
-                            # Recherche de l'ID du point de distribution
-                            id_point_dist = get_point_dist_id(conn, ref_borne)
-                            if not id_point_dist:
-                                stats['points_not_found'] += 1
-                                logging.warning(f"{filename} ligne {row_num}: Point de distribution '{ref_borne}' non trouvé")
-                                continue
-                            
-                            # Insertion dans la base de données
-                            cur.execute("""
-                                INSERT INTO eau_distribue (
-                                    quantite, date, id_point_dist
-                                ) VALUES (
-                                    %s, %s, %s
+                                lines = []
+                                pending_rows, file_keys = prepare_rows(conn, filename, batch, file_stats, keys,
+                                                                       quarantine=quarantine, file_path=file_path,
+                                                                       lines=lines)
+                                written, rejected = write_isolated(
+                                    cur, lambda c, rows: write_rows(c, rows, on_conflict), pending_rows,
+                                    label=f"{filename} lot {batch_index}"
                                 )
-                            """, (quantite, date, id_point_dist))
-                            
-                            stats['inserted'] += 1
-                            
-                        except Exception as e:
-                            stats['errors'] += 1
-                            logging.error(f"{filename} ligne {row_num}: Erreur - {str(e)}")
-                            conn.rollback()
-                            continue
-                    
-                    conn.commit()
-                    logging.info(f"Fichier {filename} traité - {row_num} lignes analysées")
+                                for key, value in merge_counts(written).items():
+                                    file_stats[key] += value
+                                file_stats['rejected'] += len(rejected)
+                                quarantine_refused(quarantine, file_path, batch, lines, rejected)
+                                if keys is not None and rejected:
+                                    # Empreintes des relevés refusés non retenues : ils seront relus
+                                    refused = {position for position, _, _ in rejected}
+                                    keys.discard([file_keys[i] for i in refused])
+                                    file_keys = [key for i, key in enumerate(file_keys) if i not in refused]
+                                checkpoint.save(cur, batch_index, start + len(batch), batch)
+                                quarantine.flush(cur)
+                                conn.commit()
+                                if keys is not None:
+                                    keys.commit(file_keys)
+                            checkpoint.clear(cur)
+                            quarantine.flush(cur)
+                            file_stats['resumed_from'] = checkpoint.next_row
+                            if manifest:
+                                manifest.record(file_path, file_stats)  # même transaction que le dernier lot
+                        conn.commit()
+                    stats['files'][filename] = file_stats
+                    log_file_stats(filename, file_stats)
+                    record_file_metrics(file_path, file_stats, time.perf_counter() - started)
+                except Exception as e:
+                    # Fichier abandonné (lots déjà validés conservés) ; les fichiers suivants sont traités
+                    conn.rollback()
+                    quarantine.discard()
+                    if keys is not None:
+                        keys.discard()
+                    logging.error(f"Échec traitement fichier {filename}: {e}")
+                    stats['errors'] += 1
+                    continue
+
+        # 3. Fusion des statistiques par fichier, dans l'ordre des noms de fichiers
+        merge_stats(stats, stats['files'])
 
+        if reload_month:
+            with conn.cursor() as cur:
+                if not is_partitioned(cur, 'eau_distribue'):
+                    raise RuntimeError("Le rechargement mensuel nécessite une table eau_distribue partitionnée")
+                stats['inserted'] = replace_month_partition(
+                    cur, 'eau_distribue', reload_month, ('quantite', 'date', 'id_point_dist'), reload_rows
+                )
+            conn.commit()
+
+        stats['quarantined'] = sum(quarantine.stats.values())
+        quarantine.log_summary()
         logging.info(f"Import terminé. Statistiques: {stats}")
+        log_resolver_stats('point_de_distribution')
+        return stats
 
     except Exception as e:
         if conn: conn.rollback()
+        if quarantine is not None:
+            quarantine.discard()
         logging.error(f"ERREUR GLOBALE: {str(e)}", exc_info=True)
         raise
     finally:
-        if conn: conn.close()
-        logging.info("Connexion à la base de données fermée")
+        if conn and own_conn: close_db(conn, "Cible HARMONISE")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import des volumes distribués depuis les fichiers CSV")
+    parser.add_argument("--reload-month", metavar="AAAA-MM",
+                        type=lambda v: datetime.strptime(v, '%Y-%m').date(),
+                        help="remplace uniquement la partition de ce mois")
+    parser.add_argument("--on-conflict", choices=['nothing', 'update', 'copy'], default='nothing',
+                        help="relevés déjà présents: ignorés (nothing), mis à jour (update), "
+                             "ou insertion sans contrôle (copy)")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="désactive le dédoublonnage par empreinte (ref_borne, date, quantite)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="nombre de processus de lecture des fichiers (parallèle si > 1)")
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS,
+                        help="nombre de connexions d'écriture en mode parallèle")
+    parser.add_argument("--force", action="store_true",
+                        help="retraite tous les fichiers, y compris ceux déjà chargés et inchangés")
+    parser.add_argument("--resume", action="store_true",
+                        help="reprend les fichiers interrompus après leur dernier lot validé")
+    parser.add_argument("--replay-rejects", action="store_true",
+                        help="retraite uniquement les lignes en quarantaine (après correction des références)")
+    args = parser.parse_args()
+
     logging.info(f"Début de l'import depuis le dossier: {DOSSIER_CSV}")
     
     try:
-        import_csv_to_db()
+        import_csv_to_db(reload_month=args.reload_month, on_conflict=args.on_conflict,
+                         dedup=not args.no_dedup,
+                         workers=args.workers, writers=args.writers, force=args.force,
+                         resume=args.resume, replay_rejects=args.replay_rejects)
         logging.info("Import terminé avec succès")
     except Exception as e:
-        logging.critical(f"Échec de l'import: {str(e)}")
\ No newline at end of file
+        logging.critical(f"Échec de l'import: {str(e)}")
+    finally:
+        close_pools()
@@ -1,19 +1,26 @@
+import argparse
+import logging
+import re
 import psycopg2
 from psycopg2 import sql
+from migrations import migrate, detect_drift, VERSION_TABLE_SQL
+from db import DB_CONFIG_TARGET
+from log_config import setup_logging
 
-DB_CONFIG = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+setup_logging()
 
-SQL_COMMANDS = [
-    """
-    CREATE EXTENSION IF NOT EXISTS postgis;
-    """,
-    """
+# Réinitialisation complète (option --reset uniquement) : supprime toutes les données
+RESET_COMMANDS = [
+    """
+    DROP TABLE IF EXISTS schema_migrations;
+    DROP TABLE IF EXISTS schema_layout;
+    DROP TABLE IF EXISTS reference_alias;
+    DROP TABLE IF EXISTS ingestion_manifest;
+    DROP TABLE IF EXISTS ingestion_checkpoint;
+    DROP TABLE IF EXISTS sync_watermark;
+    DROP TABLE IF EXISTS sync_etat_source;
+    DROP TABLE IF EXISTS id_mapping;
+    DROP TABLE IF EXISTS ingestion_quarantine;
     DROP TABLE IF EXISTS eau_distribue CASCADE;
     DROP TABLE IF EXISTS eau_traite CASCADE;
     DROP TABLE IF EXISTS eau_brute CASCADE;
@@ -31,6 +38,14 @@ SQL_COMMANDS = [
     DROP TABLE IF EXISTS quartier CASCADE;
     DROP TABLE IF EXISTS commune CASCADE;
     DROP TYPE IF EXISTS type_point_distr CASCADE;
+    """
+]
+
+# Étapes de migration, numérotées par leur position (voir migrations.py) :
+# liste en ajout seul, toute évolution du schéma s'ajoute à la fin.
+SQL_COMMANDS = [
+    """
+    CREATE EXTENSION IF NOT EXISTS postgis;
     """,
     """
     CREATE TYPE type_point_distr AS ENUM (
@@ -318,30 +333,453 @@ SQL_COMMANDS = [
         ADD CONSTRAINT fk_distep_pointdist
         FOREIGN KEY (id_point_dist) REFERENCES point_de_distribution (id_point_dist)
         ON DELETE CASCADE ON UPDATE CASCADE;
+    """,
+    """
+    -- Clés naturelles des volumes : un seul relevé par captage et par jour.
+    -- Les doublons issus des rechargements précédents sont supprimés (le plus ancien est conservé).
+    DELETE FROM eau_brute a USING eau_brute b
+        WHERE a.id_capt = b.id_capt AND a.date = b.date AND a.id_prod_eb > b.id_prod_eb;
+    ALTER TABLE eau_brute
+        ADD CONSTRAINT uq_eau_brute_capt_date UNIQUE (id_capt, date);
+    """,
+    """
+    DELETE FROM eau_traite a USING eau_traite b
+        WHERE a.id_station = b.id_station AND a.date = b.date AND a.id_prod_et > b.id_prod_et;
+    ALTER TABLE eau_traite
+        ADD CONSTRAINT uq_eau_traite_station_date UNIQUE (id_station, date);
+    """,
+    """
+    DELETE FROM eau_distribue a USING eau_distribue b
+        WHERE a.id_point_dist = b.id_point_dist AND a.date = b.date AND a.id_distr_ep > b.id_distr_ep;
+    ALTER TABLE eau_distribue
+        ADD CONSTRAINT uq_eau_distribue_pointdist_date UNIQUE (id_point_dist, date);
+    """,
+    """
+    -- Alias de libellés (orthographes des fichiers CSV/Excel -> libellé de la table de référence)
+    CREATE TABLE reference_alias (
+        reference VARCHAR(30) NOT NULL,
+        alias VARCHAR(100) NOT NULL,
+        libelle VARCHAR(100) NOT NULL,
+        PRIMARY KEY (reference, alias)
+    );
+    INSERT INTO reference_alias (reference, alias, libelle)
+        VALUES ('captage', 'VATOSOLA', 'BARRAGE 1 - VATOSOLA');
+    """,
+    """
+    -- Fichiers chargés par les scripts 3, 8, 9, 10, 11 et 12 (voir manifest.py)
+    CREATE TABLE ingestion_manifest (
+        stage VARCHAR(50) NOT NULL,
+        path VARCHAR(500) NOT NULL,
+        size BIGINT NOT NULL,
+        mtime TIMESTAMP NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        stats JSONB,
+        ingested_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (stage, path)
+    );
+    """,
+    """
+    -- Dernier lot validé des fichiers en cours de chargement (voir checkpoints.py)
+    CREATE TABLE ingestion_checkpoint (
+        stage VARCHAR(50) NOT NULL,
+        path VARCHAR(500) NOT NULL,
+        batch_index INTEGER NOT NULL,
+        row_offset INTEGER NOT NULL,
+        batch_hash CHAR(64) NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (stage, path)
+    );
+    """,
+    """
+    -- État de la synchronisation incrémentale des tables source (voir sync.py)
+    CREATE TABLE sync_watermark (
+        source_system VARCHAR(50) NOT NULL,
+        source_table VARCHAR(100) NOT NULL,
+        watermark BIGINT,
+        row_count INTEGER NOT NULL DEFAULT 0,
+        synced_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (source_system, source_table)
+    );
+    CREATE TABLE sync_etat_source (
+        source_system VARCHAR(50) NOT NULL,
+        source_table VARCHAR(100) NOT NULL,
+        source_key TEXT NOT NULL,
+        row_hash CHAR(32),
+        target_id INTEGER NOT NULL,
+        synced_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (source_system, source_table, source_key)
+    );
+    """,
+    """
+    -- Correspondance clé source -> id cible, remplie par chaque migration (voir id_mapping.py)
+    CREATE TABLE id_mapping (
+        source_system VARCHAR(50) NOT NULL,
+        source_table VARCHAR(100) NOT NULL,
+        source_key TEXT NOT NULL,
+        target_table VARCHAR(100) NOT NULL,
+        target_id INTEGER NOT NULL,
+        mapped_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (source_system, source_table, source_key)
+    );
+    CREATE INDEX idx_id_mapping_target ON id_mapping (target_table, target_id);
+    """,
+    """
+    -- Lignes rejetées par les chargeurs de fichiers, rejouables (voir quarantine.py)
+    CREATE TABLE ingestion_quarantine (
+        id_quarantine SERIAL PRIMARY KEY,
+        stage VARCHAR(50) NOT NULL,
+        source_file VARCHAR(500) NOT NULL,
+        source_line INTEGER NOT NULL,
+        reason VARCHAR(50) NOT NULL,
+        detail TEXT,
+        payload JSONB NOT NULL,
+        rejected_at TIMESTAMP NOT NULL DEFAULT now(),
+        UNIQUE (stage, source_file, source_line)
+    );
+    CREATE INDEX idx_ingestion_quarantine_reason ON ingestion_quarantine (stage, reason);
+    """,
+    """
+    -- Clés naturelles des volumes sans exception pour les dates NULL (PostgreSQL >= 15) :
+    -- un relevé sans date par captage, station ou point, rechargé sur place comme les autres.
+    -- Les doublons à date (ou point) NULL accumulés jusqu'ici sont supprimés (le plus ancien est conservé).
+    DELETE FROM eau_brute WHERE id_prod_eb IN (
+        SELECT id_prod_eb FROM (
+            SELECT id_prod_eb, ROW_NUMBER() OVER (PARTITION BY id_capt, date ORDER BY id_prod_eb) AS rang
+            FROM eau_brute WHERE date IS NULL
+        ) doublons WHERE rang > 1
+    );
+    ALTER TABLE eau_brute
+        DROP CONSTRAINT uq_eau_brute_capt_date,
+        ADD CONSTRAINT uq_eau_brute_capt_date UNIQUE NULLS NOT DISTINCT (id_capt, date);
+    DELETE FROM eau_traite WHERE id_prod_et IN (
+        SELECT id_prod_et FROM (
+            SELECT id_prod_et, ROW_NUMBER() OVER (PARTITION BY id_station, date ORDER BY id_prod_et) AS rang
+            FROM eau_traite WHERE date IS NULL
+        ) doublons WHERE rang > 1
+    );
+    ALTER TABLE eau_traite
+        DROP CONSTRAINT uq_eau_traite_station_date,
+        ADD CONSTRAINT uq_eau_traite_station_date UNIQUE NULLS NOT DISTINCT (id_station, date);
+    DELETE FROM eau_distribue WHERE id_distr_ep IN (
+        SELECT id_distr_ep FROM (
+            SELECT id_distr_ep, ROW_NUMBER() OVER (PARTITION BY id_point_dist, date ORDER BY id_distr_ep) AS rang
+            FROM eau_distribue WHERE date IS NULL OR id_point_dist IS NULL
+        ) doublons WHERE rang > 1
+    );
+    ALTER TABLE eau_distribue
+        DROP CONSTRAINT uq_eau_distribue_pointdist_date,
+        ADD CONSTRAINT uq_eau_distribue_pointdist_date UNIQUE NULLS NOT DISTINCT (id_point_dist, date);
     """
 ]
 
-def create_database_schema():
-    """Crée la structure de la base de données AEP_HARMONISE."""
-    conn = None
+# Variante partitionnée des tables de volumes : partitionnement mensuel par RANGE sur date,
+# les partitions mensuelles étant créées par les chargeurs (voir partitions.py) et les dates
+# NULL tombant dans la partition DEFAULT. Une clé primaire sur une table partitionnée doit
+# inclure la clé de partition (ici nullable) : l'identifiant SERIAL est donc conservé sans PK.
+# Ces textes remplacent les étapes CREATE TABLE correspondantes sous le même numéro : la
+# disposition choisie à la création est enregistrée dans schema_layout et réutilisée par
+# toutes les mises à jour suivantes (les empreintes de schema_migrations restent stables).
+# Une base déjà créée n'est pas convertie : changer de disposition demande --reset.
+PARTITIONED_COMMANDS = {
+    "eau_brute": """
+    CREATE TABLE eau_brute (
+        id_prod_eb SERIAL,
+        quantite NUMERIC,
+        date DATE,
+        id_capt INTEGER NOT NULL
+    ) PARTITION BY RANGE (date);
+    CREATE TABLE eau_brute_default PARTITION OF eau_brute DEFAULT;
+    """,
+    "eau_traite": """
+    CREATE TABLE eau_traite (
+        id_prod_et SERIAL,
+        quantite NUMERIC,
+        date DATE,
+        id_station INTEGER NOT NULL
+    ) PARTITION BY RANGE (date);
+    CREATE TABLE eau_traite_default PARTITION OF eau_traite DEFAULT;
+    """,
+    "eau_distribue": """
+    CREATE TABLE eau_distribue (
+        id_distr_ep SERIAL,
+        quantite NUMERIC,
+        date DATE,
+        id_point_dist INTEGER
+    ) PARTITION BY RANGE (date);
+    CREATE TABLE eau_distribue_default PARTITION OF eau_distribue DEFAULT;
+    """
+}
+
+LAYOUT_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_layout (
+        name VARCHAR(50) PRIMARY KEY,
+        value VARCHAR(50) NOT NULL,
+        chosen_at TIMESTAMP NOT NULL DEFAULT now()
+    );
+"""
+
+def _layout_name(partitioned):
+    return 'partitionnee' if partitioned else 'simple'
+
+def resolve_layout(cursor, partitioned=None):
+    """Disposition des tables de volumes (True : partitionnées), dans la transaction de
+    l'appelant.
+
+    La disposition enregistrée dans schema_layout l'emporte ; à défaut, elle est lue dans
+    le catalogue (base créée avant schema_layout), puis prise de partitioned (nouvelle
+    base, non partitionnée si None) et enregistrée. Une demande contraire à la disposition
+    de la base est refusée : la conversion d'une base chargée n'est pas prise en charge.
+    """
+    cursor.execute(LAYOUT_TABLE_SQL)
+    cursor.execute("SELECT value FROM schema_layout WHERE name = 'volumes';")
+    row = cursor.fetchone()
+    if row:
+        current = row[0] == _layout_name(True)
+    else:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = 'eau_brute' AND relkind IN ('r', 'p');")
+        existing = cursor.fetchone()
+        current = existing[0] == 'p' if existing else bool(partitioned)
+        cursor.execute("INSERT INTO schema_layout (name, value) VALUES ('volumes', %s);",
+                       (_layout_name(current),))
+    if partitioned is not None and partitioned != current:
+        raise RuntimeError(f"Tables de volumes en disposition '{_layout_name(current)}' dans cette base : "
+                           f"conversion non prise en charge, utiliser --reset pour la reconstruire")
+    return current
+
+def build_sql_commands(partitioned=False):
+    """Retourne SQL_COMMANDS, avec les tables de volumes partitionnées si demandé"""
+    if not partitioned:
+        return list(SQL_COMMANDS)
+    commands = []
+    for command in SQL_COMMANDS:
+        match = re.search(r"CREATE TABLE (\w+) \(", command)
+        if match and match.group(1) in PARTITIONED_COMMANDS:
+            commands.append(PARTITIONED_COMMANDS[match.group(1)])
+        else:
+            commands.append(command)
+    return commands
+
+# Index de recherche construits APRÈS le chargement (phase post-load) :
+# - GIST sur quartier.geom pour les ST_Contains de find_quartier_id
+# - index d'expression UPPER(TRIM(...)) pour les recherches par libellé
+# - B-tree sur les clés de recherche et (date, id) des tables de volumes
+# - BRIN sur les colonnes date (tables de volumes remplies par ordre chronologique)
+# {concurrently} est remplacé par 'CONCURRENTLY' en mode construction concurrente.
+INDEX_COMMANDS = [
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_quartier_geom
+        ON quartier USING GIST (geom);
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_captage_libelle_norm
+        ON captage ((UPPER(TRIM(libelle_capt))));
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_station_libelle_norm
+        ON station_traitement ((UPPER(TRIM(libelle))));
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_reservoir_libelle_norm
+        ON reservoir ((UPPER(TRIM(libelle))));
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_pointdist_ref_borne
+        ON point_de_distribution (ref_borne);
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_noeudcons_troncon
+        ON noeud_consommation (troncon);
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_eau_brute_date_capt
+        ON eau_brute (date, id_capt);
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_eau_traite_date_station
+        ON eau_traite (date, id_station);
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_eau_distribue_date_pointdist
+        ON eau_distribue (date, id_point_dist);
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_eau_brute_date_brin
+        ON eau_brute USING BRIN (date);
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_eau_traite_date_brin
+        ON eau_traite USING BRIN (date);
+    """,
+    """
+    CREATE INDEX {concurrently} IF NOT EXISTS idx_eau_distribue_date_brin
+        ON eau_distribue USING BRIN (date);
+    """
+]
+
+# Tables dont les statistiques sont recalculées après la construction des index
+INDEXED_TABLES = [
+    "quartier", "captage", "station_traitement", "reservoir",
+    "point_de_distribution", "noeud_consommation",
+    "eau_brute", "eau_traite", "eau_distribue"
+]
+
+def index_is_invalid(cursor, index):
+    """Vrai si l'index existe mais est marqué INVALID (pg_index.indisvalid)"""
+    cursor.execute("""
+        SELECT NOT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid);
+    """, (index,))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+def create_indexes(concurrently=False, tables=None, conn=None):
+    """Construit les index de recherche (phase post-chargement).
+
+    En mode concurrent (CREATE INDEX CONCURRENTLY), les tables restent accessibles en
+    écriture pendant la construction ; chaque commande s'exécute alors hors transaction.
+    Une construction concurrente interrompue laisse un index INVALID que IF NOT EXISTS
+    ignorerait : il est supprimé puis reconstruit.
+    tables: limite la construction (et l'ANALYZE) aux index de ces tables, ex: ['quartier']
+    avant l'affectation spatiale des captages, stations et réservoirs.
+    conn: connexion fournie par le pipeline (non fermée ici, erreurs propagées).
+    """
+    own_conn = conn is None
     cursor = None
+    autocommit = None
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        if own_conn:
+            conn = psycopg2.connect(**DB_CONFIG_TARGET)
+        # CREATE INDEX CONCURRENTLY est interdit dans un bloc de transaction
+        autocommit = conn.autocommit
+        conn.autocommit = concurrently
         cursor = conn.cursor()
-        
-        for i, command in enumerate(SQL_COMMANDS):
-            print(f"Exécution de la commande SQL #{i+1}...")
-            cursor.execute(command)
-            
-        conn.commit()
-        print("Schéma créé avec succès avec les nouvelles relations.")
+
+        cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'p';")
+        partitioned_tables = {r[0] for r in cursor.fetchall()}
+
+        for i, command in enumerate(INDEX_COMMANDS):
+            table = re.search(r"\bON (\w+)", command).group(1)
+            if tables is not None and table not in tables:
+                continue
+            print(f"Construction de l'index #{i+1}...")
+            # CONCURRENTLY n'est pas supporté sur une table partitionnée
+            use_concurrently = concurrently and table not in partitioned_tables
+            index = re.search(r"IF NOT EXISTS (\w+)", command).group(1)
+            if index_is_invalid(cursor, index):
+                print(f"Index {index} invalide (construction interrompue) : suppression avant reconstruction")
+                cursor.execute(sql.SQL("DROP INDEX {} IF EXISTS {}").format(
+                    sql.SQL("CONCURRENTLY" if use_concurrently else ""), sql.Identifier(index)))
+            cursor.execute(command.format(concurrently="CONCURRENTLY" if use_concurrently else ""))
+
+        for table in INDEXED_TABLES:
+            if tables is None or table in tables:
+                cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+
+        if not concurrently:
+            conn.commit()
+        print("Index construits avec succès.")
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Erreur: {error}")
+        if conn and not concurrently: conn.rollback()
+        if not own_conn:
+            raise
+    finally:
+        if cursor: cursor.close()
+        if conn and autocommit is not None: conn.autocommit = autocommit
+        if conn and own_conn: conn.close()
+
+def create_database_schema(with_indexes=False, concurrently=False, partitioned=None, reset=False,
+                           conn=None):
+    """Met la structure de la base de données AEP_HARMONISE à jour.
+
+    Seules les étapes de SQL_COMMANDS pas encore enregistrées dans schema_migrations
+    sont appliquées ; les données déjà chargées sont conservées.
+    reset: supprime d'abord toutes les tables (reconstruction complète, données perdues).
+    partitioned: crée eau_brute, eau_traite et eau_distribue partitionnées par mois (True)
+    ou non (False) ; None reprend la disposition de la base (voir resolve_layout).
+    with_indexes: enchaîne la phase d'indexation ; à laisser à False avant un chargement
+    en masse, puis lancer create_indexes() (option --indexes) une fois les données chargées.
+    conn: connexion fournie par le pipeline (non fermée ici).
+    """
+    own_conn = conn is None
+    cursor = None
+    try:
+        if own_conn:
+            conn = psycopg2.connect(**DB_CONFIG_TARGET)
+        cursor = conn.cursor()
+
+        if reset:
+            for command in RESET_COMMANDS:
+                print("Suppression des tables existantes...")
+                cursor.execute(command)
+
+        layout = resolve_layout(cursor, partitioned)
+        applied = migrate(conn, build_sql_commands(layout))
+        if applied:
+            print(f"Schéma mis à jour: {len(applied)} étape(s) appliquée(s) (#{applied[0]} à #{applied[-1]}).")
+        else:
+            print("Schéma déjà à jour, aucune étape à appliquer.")
         
     except (Exception, psycopg2.DatabaseError) as error:
         print(f"Erreur: {error}")
         if conn: conn.rollback()
+        if not own_conn:
+            raise
+        return
     finally:
         if cursor: cursor.close()
+        if conn and own_conn: conn.close()
+
+    if with_indexes:
+        create_indexes(concurrently=concurrently)
+
+def check_schema(partitioned=None):
+    """Affiche les étapes en attente et la dérive du schéma, sans rien modifier"""
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_CONFIG_TARGET)
+        with conn.cursor() as cursor:
+            layout = resolve_layout(cursor, partitioned)
+        print(f"Tables de volumes: disposition '{_layout_name(layout)}'.")
+        pending = migrate(conn, build_sql_commands(layout), dry_run=True)
+        print(f"{len(pending)} étape(s) en attente.")
+        with conn.cursor() as cursor:
+            cursor.execute(VERSION_TABLE_SQL)
+            drift = detect_drift(cursor, build_sql_commands(layout))
+        conn.rollback()
+        for message in drift:
+            print(f"Dérive: {message}")
+        if not drift:
+            print("Aucune dérive détectée.")
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Erreur: {error}")
+    finally:
         if conn: conn.close()
 
 if __name__ == "__main__":
-    create_database_schema()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Création de la base AEP_HARMONISE")
+    parser.add_argument("--indexes", action="store_true",
+                        help="construit uniquement les index (à lancer après les chargements)")
+    parser.add_argument("--with-indexes", action="store_true",
+                        help="crée le schéma puis construit immédiatement les index")
+    parser.add_argument("--concurrently", action="store_true",
+                        help="construit les index avec CREATE INDEX CONCURRENTLY")
+    parser.add_argument("--partitioned", action="store_const", const=True, default=None,
+                        help="partitionne eau_brute, eau_traite et eau_distribue par mois (nouvelle base "
+                             "ou --reset ; sinon la disposition enregistrée dans la base est reprise)")
+    parser.add_argument("--reset", action="store_true",
+                        help="supprime toutes les tables avant de recréer le schéma (perte des données)")
+    parser.add_argument("--check", action="store_true",
+                        help="affiche les étapes en attente et la dérive du schéma sans rien modifier")
+    args = parser.parse_args()
+
+    if args.check:
+        check_schema(partitioned=args.partitioned)
+    elif args.indexes:
+        create_indexes(concurrently=args.concurrently)
+    else:
+        create_database_schema(with_indexes=args.with_indexes, concurrently=args.concurrently,
+                               partitioned=args.partitioned, reset=args.reset)
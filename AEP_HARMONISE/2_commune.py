@@ -1,51 +1,20 @@
 import psycopg2
-import psycopg2.extras # Pour DictCursor
+import argparse
 import logging
 from psycopg2 import sql
+from bulk_copy import copy_rows_returning
+from db import DB_CONFIG_TARGET, DB_CONFIG_SOURCE_EAURIZON, SOURCE_ITERSIZE, connect_db, close_db, stream_query
+from sync import SourceSync, SYNC_MODES, DEFAULT_SYNC_MODE
+from id_mapping import record_mappings
+from metrics import record_rows
+from log_config import setup_logging, set_verbosity, RowLog, VERBOSITY_LEVELS, DEFAULT_VERBOSITY
 
 #Configuration
-# Base de données CIBLE
-DB_CONFIG_TARGET = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
-
-# Base de données SOURCE
-DB_CONFIG_SOURCE_EAURIZON = {
-    "database": "AEP_EAURIZON",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Bases de données CIBLE (AEP_HARMONISE) et SOURCE (AEP_EAURIZON) : voir db.py
 
 #Logging
 # Configuration du logging pour afficher les informations
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-#Fonctions Utilitaires
-def connect_db(config, name):
-    """Établit une connexion à une base de données."""
-    try:
-        conn = psycopg2.connect(**config)
-        # Autocommit False par défaut, c'est ce qu'on veut pour contrôler la transaction
-        logging.info(f"Connecté à la base de données '{name}' ({config['database']})")
-        return conn
-    except psycopg2.DatabaseError as e:
-        logging.error(f"Erreur de connexion à '{name}': {e}")
-        raise
-
-def close_db(conn, name, cursor=None):
-    """Ferme le curseur et la connexion."""
-    if cursor:
-        cursor.close()
-    if conn:
-        db_name = conn.dsn.split('dbname=')[1].split(' ')[0]
-        conn.close()
-        logging.info(f"Connexion à '{name}' ({db_name}) fermée.")
+setup_logging()
 
 #Fonction de Migration pour Commune
 
@@ -53,20 +22,34 @@ def close_db(conn, name, cursor=None):
 # Clé: Identifiant unique de la source (gid ici), Valeur: Nouvel id_com dans la cible
 id_mapping_commune = {}
 
-def migrate_commune(source_conn, target_conn):
-    """Migre les données de AEP_EAURIZON.commune vers AEP_HARMONISE.commune."""
+def migrate_commune(source_conn, target_conn, itersize=SOURCE_ITERSIZE, sync_mode=DEFAULT_SYNC_MODE,
+                    delete_missing=False):
+    """Migre les données de AEP_EAURIZON.commune vers AEP_HARMONISE.commune.
+
+    La table source est lue en flux (curseur serveur, lots de itersize lignes).
+    sync_mode: 'full' (toute la table), 'watermark' (gid supérieurs au dernier gid migré)
+    ou 'hash' (lignes nouvelles ou modifiées), voir sync.py.
+    delete_missing: supprime les communes disparues de la source (non référencées).
+
+    Retourne le mapping gid source -> id_com (vide si la transaction a été annulée) ;
+    il couvre toutes les communes synchronisées, y compris celles des exécutions précédentes.
+    """
     logging.info("--- Début Migration: commune ---")
-    # Utiliser DictCursor pour accéder aux colonnes par leur nom
-    source_cursor = source_conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     target_cursor = target_conn.cursor()
 
     processed_count = 0
     inserted_count = 0
+    updated_count = 0
+    deleted_count = 0
     error_count = 0
 
     try:
-        # 1. Sélectionner les données de la table source
-        source_cursor.execute("""
+        # 1. Lire les données de la table source en flux (accès aux colonnes par row.nom),
+        #    restreintes aux lignes à synchroniser
+        sync = SourceSync(target_conn, 'AEP_EAURIZON', 'commune', 'gid', sync_mode, watermark_column='gid',
+                          delete_missing=delete_missing)
+        sync_condition, sync_params = sync.plan(source_conn)
+        rows = stream_query(source_conn, """
             SELECT
                 gid,        -- Pour référence/mapping
                 cod_dist,
@@ -77,89 +60,84 @@ def migrate_commune(source_conn, target_conn):
                 nom_maire,
                 densite,    -- double precision (pour nb_habitant)
                 geom        -- geometry
-            FROM commune;
-        """)
-        rows = source_cursor.fetchall()
-        logging.info(f"Trouvé {len(rows)} lignes dans AEP_EAURIZON.commune.")
-
-        # 2. Préparer la requête d'insertion pour la table cible
-        # Utilisation de psycopg2.sql pour une construction sûre
-        sql_insert = sql.SQL("""
-            INSERT INTO commune (
-                code_dist, code_com, lib_com, cat_com, area_km2,
-                nom_maire, nb_habitant, geom
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s
-            ) RETURNING id_com; -- Récupérer le nouvel ID généré
-        """) 
-
-        # 3. Itérer sur chaque ligne source, transformer et insérer
+            FROM commune
+            WHERE """ + sync_condition + ";", sync_params, itersize=itersize, name='source_commune')
+
+        # 2. Colonnes écrites dans la table cible (par COPY en lots)
+        target_columns = (
+            'code_dist', 'code_com', 'lib_com', 'cat_com', 'area_km2',
+            'nom_maire', 'nb_habitant', 'geom'
+        )
+        pending_gids = []
+        pending_rows = []
+
+        # 3. Itérer sur chaque ligne source et transformer
         for row in rows:
             processed_count += 1
             try:
                 #Transformations et validations
                 # code_dist: VARCHAR(20) <- character varying(254)
-                code_dist_val = row['cod_dist']
+                code_dist_val = row.cod_dist
                 if code_dist_val and len(code_dist_val) > 20:
-                    logging.warning(f"Source gid={row['gid']}: 'cod_dist' ('{code_dist_val}') tronqué à 20 caractères.")
+                    logging.warning(f"Source gid={row.gid}: 'cod_dist' ('{code_dist_val}') tronqué à 20 caractères.")
                     code_dist_val = code_dist_val[:20]
 
                 # code_com: VARCHAR(10) NOT NULL <- double precision
                 code_com_val = None
-                if row['cod_com'] is not None:
+                if row.cod_com is not None:
                      # Convertit le float en string. Gère les '.0' si présents.
-                     code_com_str = str(row['cod_com'])
+                     code_com_str = str(row.cod_com)
                      if code_com_str.endswith('.0'):
                          code_com_str = code_com_str[:-2]
 
                      if len(code_com_str) > 10:
-                         logging.warning(f"Source gid={row['gid']}: 'cod_com' ('{code_com_str}') tronqué à 10 caractères.")
+                         logging.warning(f"Source gid={row.gid}: 'cod_com' ('{code_com_str}') tronqué à 10 caractères.")
                          code_com_val = code_com_str[:10]
                      else:
                          code_com_val = code_com_str
                 else:
-                    logging.error(f"Source gid={row['gid']}: 'cod_com' est NULL. Ligne ignorée car la cible est NOT NULL.")
+                    logging.error(f"Source gid={row.gid}: 'cod_com' est NULL. Ligne ignorée car la cible est NOT NULL.")
                     error_count += 1
                     continue 
 
                 # lib_com: VARCHAR(50) <- character varying(254)
-                lib_com_val = row['lib_com']
+                lib_com_val = row.lib_com
                 if lib_com_val and len(lib_com_val) > 50:
-                    logging.warning(f"Source gid={row['gid']}, code_com={code_com_val}: 'lib_com' ('{lib_com_val}') tronqué à 50 caractères.")
+                    logging.warning(f"Source gid={row.gid}, code_com={code_com_val}: 'lib_com' ('{lib_com_val}') tronqué à 50 caractères.")
                     lib_com_val = lib_com_val[:50]
 
                 # cat_com: VARCHAR(30) <- character varying(20)
-                cat_com_val = row['cat_com']
+                cat_com_val = row.cat_com
                 if cat_com_val and len(cat_com_val) > 30:
-                     logging.warning(f"Source gid={row['gid']}: 'cat_com' ('{cat_com_val}') tronqué à 30 caractères.")
+                     logging.warning(f"Source gid={row.gid}: 'cat_com' ('{cat_com_val}') tronqué à 30 caractères.")
                      cat_com_val = cat_com_val[:30]
 
 
                 # area_km2: NUMERIC <- numeric
-                area_km2_val = row['area_km2'] 
+                area_km2_val = row.area_km2 
 
                 # nom_maire: VARCHAR(50) <- character varying(254)
-                nom_maire_val = row['nom_maire']
+                nom_maire_val = row.nom_maire
                 if nom_maire_val and len(nom_maire_val) > 50:
-                    logging.warning(f"Source gid={row['gid']}: 'nom_maire' ('{nom_maire_val}') tronqué à 50 caractères.")
+                    logging.warning(f"Source gid={row.gid}: 'nom_maire' ('{nom_maire_val}') tronqué à 50 caractères.")
                     nom_maire_val = nom_maire_val[:50]
 
                 # nb_habitant: INTEGER <- double precision (densite)
                 nb_habitant_val = None
-                if row['densite'] is not None:
+                if row.densite is not None:
                     try:
                         # Conversion simple en entier (tronque la partie décimale)
-                        nb_habitant_val = int(row['densite'])
+                        nb_habitant_val = int(row.densite)
                     except (ValueError, TypeError):
-                        logging.warning(f"Source gid={row['gid']}: Impossible de convertir 'densite' ({row['densite']}) en INTEGER. Mis à NULL.")
+                        logging.warning(f"Source gid={row.gid}: Impossible de convertir 'densite' ({row.densite}) en INTEGER. Mis à NULL.")
                         nb_habitant_val = None
-                # Si row['densite'] est None, nb_habitant_val reste None
+                # Si row.densite est None, nb_habitant_val reste None
 
                 # geom: geometry(MultiPolygon, 29702) <- geometry(MultiPolygon, 29702)
-                geom_val = row['geom'] 
+                geom_val = row.geom 
 
-                #Exécution de l'insertion
-                target_cursor.execute(sql_insert, (
+                pending_gids.append(row.gid)
+                pending_rows.append((
                     code_dist_val,
                     code_com_val,
                     lib_com_val,
@@ -170,27 +148,43 @@ def migrate_commune(source_conn, target_conn):
                     geom_val
                 ))
 
-                # Récupérer le nouvel ID et loguer
-                new_id_com = target_cursor.fetchone()[0]
+            except Exception as ex:
+                logging.error(f"Erreur Python inattendue lors du traitement de la ligne source gid={row.gid}: {ex}")
+                error_count += 1
+
+        logging.info(f"Trouvé {processed_count} lignes dans AEP_EAURIZON.commune.")
+
+        # 4. Insertion en masse (COPY) ; les ids sont restitués dans l'ordre des lignes source.
+        #    Les communes modifiées (mode 'hash') ou déjà chargées (mode 'full') sont mises à jour sur place.
+        if error_count == 0:
+            updates = [(sync.target_id(gid), values) for gid, values in zip(pending_gids, pending_rows) if sync.is_update(gid)]
+            new_gids = [gid for gid in pending_gids if not sync.is_update(gid)]
+            new_rows = [values for gid, values in zip(pending_gids, pending_rows) if not sync.is_update(gid)]
+            new_ids = copy_rows_returning(target_cursor, 'commune', 'id_com', target_columns, new_rows) if new_rows else []
+            inserted_log = RowLog('commune', 'insérée(s)')
+            for gid, row_values, new_id_com in zip(new_gids, new_rows, new_ids):
                 inserted_count += 1
-                logging.info(f"  -> Inséré: Source gid={row['gid']} (code_com='{code_com_val}', lib_com='{lib_com_val}') -> Nouveau id_com={new_id_com}")
+                inserted_log.log("  -> Inséré: Source gid=%s (code_com='%s', lib_com='%s') -> Nouveau id_com=%s",
+                                 gid, row_values[1], row_values[2], new_id_com)
 
                 # Stocker le mapping si nécessaire pour les tables dépendantes
-                id_mapping_commune[row['gid']] = new_id_com
+                id_mapping_commune[gid] = new_id_com
+            inserted_log.summary()
 
-            except psycopg2.Error as e:
-                logging.error(f"Erreur lors de l'insertion de la ligne source gid={row['gid']}: {e}")
-                error_count += 1
-            except Exception as ex:
-                logging.error(f"Erreur Python inattendue lors du traitement de la ligne source gid={row['gid']}: {ex}")
-                error_count += 1
+            updated_count = sync.update_rows(target_cursor, 'commune', 'id_com', target_columns, updates)
+            deleted_count = sync.delete_rows(target_cursor, 'commune', 'id_com')
+            sync.record(target_cursor, list(zip(new_gids, new_ids)), [gid for gid in pending_gids if sync.is_update(gid)])
+            record_mappings(target_cursor, 'AEP_EAURIZON', 'commune', 'commune', zip(new_gids, new_ids))
+            id_mapping_commune.update({int(gid): id_com for gid, id_com in sync.mapping(target_cursor).items()})
 
-        # 4. Valider ou annuler la transaction en fonction des erreurs
+        # 5. Valider ou annuler la transaction en fonction des erreurs
         if error_count == 0:
             target_conn.commit()
+            record_rows(read=processed_count, written=inserted_count + updated_count)
             logging.info("Transaction validée (commit).")
         else:
             target_conn.rollback()
+            id_mapping_commune.clear()
             logging.warning(f"Transaction annulée (rollback) car {error_count} erreur(s) se sont produites lors du traitement des lignes.")
             # target_conn.commit()
             # logging.warning(f"Transaction validée (commit), mais {error_count} erreur(s) se sont produites et ont été ignorées.")
@@ -199,20 +193,23 @@ def migrate_commune(source_conn, target_conn):
     except psycopg2.Error as e:
         logging.error(f"Erreur majeure de base de données pendant la migration commune: {e}")
         target_conn.rollback()
+        id_mapping_commune.clear()
     except Exception as e:
         logging.error(f"Erreur Python inattendue pendant la migration commune: {e}")
         target_conn.rollback()
+        id_mapping_commune.clear()
     finally:
         logging.info(f"--- Fin Migration: commune ---")
-        logging.info(f"Statistiques: Lignes traitées={processed_count}, Insérées={inserted_count}, Erreurs={error_count}")
-        if source_cursor:
-            source_cursor.close()
+        logging.info(f"Statistiques: Lignes traitées={processed_count}, Insérées={inserted_count}, "
+                     f"Mises à jour={updated_count}, Supprimées={deleted_count}, Erreurs={error_count}")
         if target_cursor:
             target_cursor.close()
 
+    return id_mapping_commune
+
 
 #Fonction Principale
-def main():
+def main(sync_mode=DEFAULT_SYNC_MODE, delete_missing=False):
     """Orchestre la migration pour la table commune."""
     source_conn = None
     target_conn = None
@@ -223,7 +220,7 @@ def main():
         target_conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
 
         # Exécuter la migration pour la table commune
-        migrate_commune(source_conn, target_conn)
+        migrate_commune(source_conn, target_conn, sync_mode=sync_mode, delete_missing=delete_missing)
 
         logging.info("Migration de la table 'commune' terminée.")
 
@@ -237,4 +234,13 @@ def main():
             close_db(target_conn, "Cible HARMONISE")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Migration des communes EAURIZON")
+    parser.add_argument("--sync", choices=SYNC_MODES, default=DEFAULT_SYNC_MODE,
+                        help="synchronisation: table complète, gid au-delà du filigrane ou comparaison d'empreintes")
+    parser.add_argument("--delete-missing", action="store_true",
+                        help="supprime de la cible les lignes disparues de la source (sauf lignes encore référencées)")
+    parser.add_argument("--verbosity", choices=VERBOSITY_LEVELS, default=DEFAULT_VERBOSITY,
+                        help="messages par ligne insérée: résumé seul, échantillon ou tous")
+    args = parser.parse_args()
+    set_verbosity(args.verbosity)
+    main(sync_mode=args.sync, delete_missing=args.delete_missing)
\ No newline at end of file
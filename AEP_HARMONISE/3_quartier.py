@@ -2,59 +2,48 @@ import psycopg2
 import psycopg2.extras
 import json
 import logging
+import time
 import os
 import re
+import argparse
 from psycopg2 import sql
+from bulk_copy import copy_rows_returning
+from batch_writer import write_isolated
+from id_mapping import record_mappings
+from geojson_stream import iter_features, batched
+from manifest import IngestionManifest
+from quarantine import Quarantine, replay, DONNEE_MANQUANTE, GEOMETRIE_MANQUANTE, REFUS_BASE
+from db import DB_CONFIG_TARGET, connect_db, close_db
+from resolvers import invalidate_resolvers
+from metrics import record_file
+from log_config import setup_logging, set_verbosity, RowLog, VERBOSITY_LEVELS, DEFAULT_VERBOSITY
 
 # --- CONFIGURATION ---
 
-# Configuration de la base de données cible
-DB_CONFIG_TARGET = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Configuration de la base de données cible : voir db.py
 
 # Chemin vers le fichier GeoJSON des quartiers (utilisation de os.path.join pour la portabilité)
 GEOJSON_PATH_QUARTIER = os.path.join("quartier_rhm.geojson")
 
-# Configuration du logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
+# Nombre de features lues puis insérées (COPY) par lot
+GEOJSON_BATCH_SIZE = 500
 
-# --- FONCTIONS UTILITAIRES (inchangées) ---
+# Configuration du logging
+setup_logging()
 
-def connect_db(config, name):
-    """Établit une connexion à une base de données."""
-    try:
-        conn = psycopg2.connect(**config)
-        logging.info(f"Connecté à la base de données '{name}' ({config['database']})")
-        return conn
-    except psycopg2.DatabaseError as e:
-        logging.error(f"Erreur de connexion à '{name}': {e}")
-        raise
 
-def close_db(conn, name, cursor=None):
-    """Ferme le curseur et la connexion."""
-    if cursor:
-        cursor.close()
-    if conn:
-        db_name = conn.dsn.split('dbname=')[1].split(' ')[0]
-        conn.close()
-        logging.info(f"Connexion à '{name}' ({db_name}) fermée.")
+# --- FONCTIONS UTILITAIRES ---
 
 def load_geojson(file_path):
-    """Charge et parse le fichier GeoJSON."""
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        logging.info(f"Fichier GeoJSON chargé: {len(data['features'])} features trouvées dans {file_path}")
-        return data
-    except Exception as e:
-        logging.error(f"Erreur lors du chargement du GeoJSON {file_path}: {e}")
-        raise
+    """Ouvre le fichier GeoJSON en lecture en flux (voir geojson_stream.py).
+
+    Retourne un itérateur de features : le fichier n'est pas chargé en mémoire, les
+    géométries restent en texte GeoJSON brut.
+    """
+    if not os.path.exists(file_path):
+        logging.error(f"Erreur lors du chargement du GeoJSON {file_path}: fichier introuvable")
+        raise FileNotFoundError(file_path)
+    return iter_features(file_path)
 
 def parse_numeric_value(value):
     """Parse une valeur numérique, gère les chaînes vides et les conversions."""
@@ -76,131 +65,228 @@ def parse_numeric_value(value):
         return None
 
 
+def raw_feature(feature):
+    """Feature brute {'id', 'properties', 'geometry'} (contenu mis en quarantaine)"""
+    geometry = feature.get('geometry')
+    if isinstance(geometry, str):
+        geometry = json.loads(geometry)
+    return {'id': feature.get('id'), 'properties': feature.get('properties') or {}, 'geometry': geometry}
+
+def _prepare_feature(feature, position, pending_rows):
+    """Valide une feature et ajoute sa ligne à pending_rows ; retourne le motif de rejet
+    (voir quarantine.py) si elle est ignorée, None sinon."""
+    properties = feature.get('properties') or {}
+    geometry = feature.get('geometry')
+
+    # Utiliser un identifiant unique pour le logging
+    feature_id = properties.get('code_quartier', f'feature_{position}')
+
+    try:
+        # --- Transformations et validations des données ---
+
+        # id_com: INTEGER NOT NULL
+        id_com_val = properties.get('id_com')
+        if id_com_val is None:
+            logging.error(f"Feature '{feature_id}': 'id_com' est NULL. Ligne ignorée.")
+            return DONNEE_MANQUANTE
+
+        # code_quartier: VARCHAR(50) UNIQUE NOT NULL
+        code_quartier_val = properties.get('code_quartier')
+        if code_quartier_val is None:
+            logging.error(f"Feature (id_com={id_com_val}): 'code_quartier' est NULL. Ligne ignorée.")
+            return DONNEE_MANQUANTE
+        code_quartier_val = str(code_quartier_val)[:50]
+
+        # lib_quartier: VARCHAR(50)
+        lib_quartier_val = properties.get('lib_quartier')
+        if lib_quartier_val is not None:
+            lib_quartier_val = str(lib_quartier_val)[:50]
+
+        # area_km2: NUMERIC
+        area_km2_val = parse_numeric_value(properties.get('area_km2'))
+
+        # nb_habitant: INTEGER
+        nb_habitant_val = parse_numeric_value(properties.get('nb_habitant'))
+        if nb_habitant_val is not None:
+            nb_habitant_val = int(nb_habitant_val)
+
+        # geom: texte GeoJSON brut transmis tel quel à ST_GeomFromGeoJSON
+        # (un document déjà décodé fournit un dict, réencodé ici)
+        geom_json = json.dumps(geometry) if isinstance(geometry, dict) else geometry
+        if not geom_json:
+            logging.error(f"Feature '{feature_id}': Géométrie manquante. Ligne ignorée.")
+            return GEOMETRIE_MANQUANTE
+
+        pending_rows.append((
+            id_com_val,
+            code_quartier_val,
+            lib_quartier_val,
+            area_km2_val,
+            nb_habitant_val,
+            geom_json
+        ))
+        return None
+
+    except Exception as ex:
+        logging.error(f"Erreur Python inattendue lors du traitement de la feature '{feature_id}': {ex}")
+        raise
+
+
 # --- FONCTION DE MIGRATION POUR QUARTIER ---
 
-def migrate_quartier_from_geojson(target_conn, geojson_data):
-    """Migre les données du GeoJSON vers la table AEP_HARMONISE.quartier."""
+def _write_features(target_cursor, numbered_features, counts, quartier_mapping, quarantine=None, source_path=None,
+                    inserted_log=None):
+    """Insère par lots de GEOJSON_BATCH_SIZE les features [(position, feature)], dans la
+    transaction de l'appelant ; les features ignorées ou refusées sont mises en quarantaine
+    (avec leur position dans le fichier) si quarantine et source_path sont fournis.
+    counts : compteurs 'processed', 'inserted', 'errors' mis à jour.
+    inserted_log : messages par feature insérée (voir log_config.RowLog)."""
+    if inserted_log is None:
+        inserted_log = RowLog('Quartiers', 'insérée(s)')
+    if source_path is None:
+        quarantine = None
+    # Colonnes écrites par COPY ; la géométrie GeoJSON est convertie côté serveur
+    target_columns = ('id_com', 'code_quartier', 'lib_quartier', 'area_km2', 'nb_habitant', 'geom')
+    geom_expression = {'geom': "ST_SetSRID(ST_GeomFromGeoJSON({}), 29702)"}
+
+    for batch in batched(numbered_features, GEOJSON_BATCH_SIZE):
+        pending_rows = []
+        pending = []  # (position, feature) de chaque ligne de pending_rows
+        for position, feature in batch:
+            counts['processed'] += 1
+            reason = _prepare_feature(feature, position, pending_rows)
+            if reason:
+                counts['errors'] += 1
+                if quarantine is not None:
+                    quarantine.add(reason, raw_feature(feature), source_path, position)
+            else:
+                pending.append((position, feature))
+
+        # Insertion en masse (COPY) des features valides du lot, features refusées isolées
+        written, rejected = write_isolated(
+            target_cursor,
+            lambda cur, rows: copy_rows_returning(cur, 'quartier', 'id_quartier', target_columns, rows,
+                                                  expressions=geom_expression),
+            pending_rows, label="Quartiers"
+        )
+        counts['errors'] += len(rejected)
+        for index, row_values, message in rejected:
+            logging.error(f"Feature code_quartier='{row_values[1]}' refusée par la base: {message}")
+            if quarantine is not None:
+                position, feature = pending[index]
+                quarantine.add(REFUS_BASE, raw_feature(feature), source_path, position, message)
+
+        inserted = [(row_values, new_id) for rows, new_ids in written for row_values, new_id in zip(rows, new_ids)]
+        for row_values, new_id_quartier in inserted:
+            counts['inserted'] += 1
+            quartier_mapping[row_values[1]] = new_id_quartier
+            inserted_log.log("  -> Inséré: Feature code_quartier='%s' -> Nouveau id_quartier=%s",
+                             row_values[1], new_id_quartier)
+        record_mappings(target_cursor, 'GEOJSON', 'quartier', 'quartier',
+                        [(row_values[1], new_id) for row_values, new_id in inserted])
+
+def migrate_quartier_from_geojson(target_conn, geojson_data, manifest=None, source_path=None, quarantine=None):
+    """Migre les données du GeoJSON vers la table AEP_HARMONISE.quartier.
+
+    geojson_data : itérateur de features (load_geojson) ou document GeoJSON déjà chargé.
+    Les features sont insérées par lots de GEOJSON_BATCH_SIZE, dans une seule transaction ;
+    une feature refusée par la base (ex: id_com inconnu) est écartée seule (voir batch_writer.py).
+    manifest, source_path : fichier enregistré dans le manifeste d'ingestion avec les insertions.
+    quarantine : les features ignorées ou refusées du fichier source_path y sont mises, à la
+    place de ses rejets précédents (voir quarantine.py).
+    Retourne le mapping code_quartier -> id_quartier des quartiers insérés.
+    """
     logging.info("--- Début Migration: quartier depuis GeoJSON ---")
+    started = time.perf_counter()
     
     target_cursor = target_conn.cursor()
-    processed_count = 0
-    inserted_count = 0
-    error_count = 0
+    counts = {'processed': 0, 'inserted': 0, 'errors': 0}
+    quartier_mapping = {}
+    inserted_log = RowLog('Quartiers', 'insérée(s)')
 
     try:
-        # Préparer la requête d'insertion
-        # On insère les données et on laisse la BDD générer le 'id_quartier'
-        sql_insert = sql.SQL("""
-            INSERT INTO quartier (
-                id_com, code_quartier, lib_quartier, area_km2, nb_habitant, geom
-            ) VALUES (
-                %s, %s, %s, %s, %s, ST_SetSRID(ST_GeomFromGeoJSON(%s), 29702)
-            ) RETURNING id_quartier;
-        """)
-
-        # Itérer sur chaque feature du GeoJSON
-        for feature in geojson_data['features']:
-            processed_count += 1
-            properties = feature.get('properties', {})
-            geometry = feature.get('geometry', {})
-            
-            # Utiliser un identifiant unique pour le logging
-            feature_id = properties.get('code_quartier', f'feature_{processed_count}')
-
-            try:
-                # --- Transformations et validations des données ---
-                
-                # id_com: INTEGER NOT NULL
-                id_com_val = properties.get('id_com')
-                if id_com_val is None:
-                    logging.error(f"Feature '{feature_id}': 'id_com' est NULL. Ligne ignorée.")
-                    error_count += 1
-                    continue
-                
-                # code_quartier: VARCHAR(50) UNIQUE NOT NULL
-                code_quartier_val = properties.get('code_quartier')
-                if code_quartier_val is None:
-                    logging.error(f"Feature (id_com={id_com_val}): 'code_quartier' est NULL. Ligne ignorée.")
-                    error_count += 1
-                    continue
-                code_quartier_val = str(code_quartier_val)[:50]
-
-                # lib_quartier: VARCHAR(50)
-                lib_quartier_val = properties.get('lib_quartier')
-                if lib_quartier_val is not None:
-                    lib_quartier_val = str(lib_quartier_val)[:50]
-
-                # area_km2: NUMERIC
-                area_km2_val = parse_numeric_value(properties.get('area_km2'))
-
-                # nb_habitant: INTEGER
-                nb_habitant_val = parse_numeric_value(properties.get('nb_habitant'))
-                if nb_habitant_val is not None:
-                    nb_habitant_val = int(nb_habitant_val)
-
-                # geom: conversion de GeoJSON en geometry PostGIS
-                geom_json = json.dumps(geometry) if geometry else None
-                if geom_json is None:
-                    logging.error(f"Feature '{feature_id}': Géométrie manquante. Ligne ignorée.")
-                    error_count += 1
-                    continue
-
-                # Exécution de l'insertion
-                target_cursor.execute(sql_insert, (
-                    id_com_val,
-                    code_quartier_val,
-                    lib_quartier_val,
-                    area_km2_val,
-                    nb_habitant_val,
-                    geom_json
-                ))
-
-                # Récupérer le nouvel ID généré
-                new_id_quartier = target_cursor.fetchone()[0]
-                inserted_count += 1
-                logging.info(f"  -> Inséré: Feature code_quartier='{code_quartier_val}' -> Nouveau id_quartier={new_id_quartier}")
-
-            except psycopg2.Error as e:
-                # En cas d'erreur (ex: id_com non trouvé), on annule la transaction
-                logging.error(f"Erreur PostgreSQL lors de l'insertion de la feature '{feature_id}': {e}")
-                target_conn.rollback()
-                error_count += 1
-                # On arrête le script en cas d'erreur de BDD pour ne pas continuer avec des données potentiellement corrompues
-                raise
-            except Exception as ex:
-                logging.error(f"Erreur Python inattendue lors du traitement de la feature '{feature_id}': {ex}")
-                target_conn.rollback()
-                error_count += 1
-                raise
-        
+        features = geojson_data['features'] if isinstance(geojson_data, dict) else geojson_data
+        if quarantine is not None and source_path:
+            quarantine.forget_file(target_cursor, source_path)
+        _write_features(target_cursor, enumerate(features, 1), counts, quartier_mapping, quarantine, source_path,
+                        inserted_log)
+
         # Si tout s'est bien passé, on valide toutes les insertions
+        if manifest and source_path:
+            manifest.record(source_path, counts)
+        if quarantine is not None:
+            quarantine.flush(target_cursor)
         target_conn.commit()
+        invalidate_resolvers('quartier')  # nouvelles références insérées
+        if source_path:
+            record_file(source_path, read=counts['processed'], written=counts['inserted'],
+                        rejected=counts['errors'], seconds=time.perf_counter() - started)
 
     except Exception as e:
         logging.error(f"Erreur majeure pendant la migration des quartiers: {e}")
         # Assurer un rollback en cas d'erreur critique
         target_conn.rollback()
+        if quarantine is not None:
+            quarantine.discard()
+        quartier_mapping = {}
     finally:
+        inserted_log.summary()
         logging.info(f"--- Fin Migration: quartier depuis GeoJSON ---")
-        logging.info(f"Statistiques: Features traitées={processed_count}, Insérées={inserted_count}, Erreurs={error_count}")
+        logging.info(f"Statistiques: Features traitées={counts['processed']}, Insérées={counts['inserted']}, "
+                     f"Erreurs={counts['errors']}")
         if target_cursor:
             target_cursor.close()
 
+    return quartier_mapping
+
+
+def replay_quartier_rejects(target_conn):
+    """Retraite les features en quarantaine (voir quarantine.replay), à leur position
+    d'origine ; retourne le mapping code_quartier -> id_quartier des quartiers insérés."""
+    quartier_mapping = {}
+
+    def process(cur, source_file, entries, quarantine):
+        counts = {'processed': 0, 'inserted': 0, 'errors': 0}
+        _write_features(cur, [(entry.source_line, entry.payload) for entry in entries], counts,
+                        quartier_mapping, quarantine, source_file)
+        return counts
+
+    replay(target_conn, 'quartier', process)
+    invalidate_resolvers('quartier')
+    return quartier_mapping
+
+def migrate_quartier(target_conn, file_path=GEOJSON_PATH_QUARTIER, force=False, replay_rejects=False):
+    """Migre le fichier GeoJSON des quartiers s'il est nouveau ou modifié (voir manifest.py).
+
+    force : migre le fichier même s'il a déjà été chargé et n'a pas changé.
+    replay_rejects : seules les features en quarantaine sont retraitées (voir quarantine.py).
+    Retourne le mapping code_quartier -> id_quartier des quartiers insérés.
+    """
+    if replay_rejects:
+        return replay_quartier_rejects(target_conn)
+    manifest = IngestionManifest(target_conn, 'quartier', force=force)
+    if not manifest.select([file_path]):
+        logging.info(f"Fichier {file_path} déjà chargé et inchangé : migration des quartiers ignorée")
+        return {}
+    geojson_data = load_geojson(file_path)
+    quarantine = Quarantine(target_conn, 'quartier')
+    quartier_mapping = migrate_quartier_from_geojson(target_conn, geojson_data, manifest=manifest,
+                                                     source_path=file_path, quarantine=quarantine)
+    quarantine.log_summary()
+    return quartier_mapping
+
 
 # --- FONCTION PRINCIPALE ---
 
-def main():
+def main(force=False, replay_rejects=False):
     """Orchestre la migration pour la table quartier depuis GeoJSON."""
     target_conn = None
     try:
-        # Charger le fichier GeoJSON des quartiers
-        geojson_data_quartier = load_geojson(GEOJSON_PATH_QUARTIER)
-        
         # Connexion à la base de données cible
         target_conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
 
-        # Exécuter la migration pour les quartiers
-        migrate_quartier_from_geojson(target_conn, geojson_data_quartier)
+        # Exécuter la migration pour les quartiers (fichier lu en flux)
+        migrate_quartier(target_conn, GEOJSON_PATH_QUARTIER, force=force, replay_rejects=replay_rejects)
 
         logging.info("Migration de la table 'quartier' depuis GeoJSON terminée avec succès.")
 
@@ -214,4 +300,13 @@ def main():
             close_db(target_conn, "Cible HARMONISE")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Migration des quartiers depuis le fichier GeoJSON")
+    parser.add_argument("--force", action="store_true",
+                        help="migre le fichier même s'il a déjà été chargé et n'a pas changé")
+    parser.add_argument("--replay-rejects", action="store_true",
+                        help="retraite uniquement les features en quarantaine (après correction des données)")
+    parser.add_argument("--verbosity", choices=VERBOSITY_LEVELS, default=DEFAULT_VERBOSITY,
+                        help="messages par feature insérée: résumé seul, échantillon ou tous")
+    args = parser.parse_args()
+    set_verbosity(args.verbosity)
+    main(force=args.force, replay_rejects=args.replay_rejects)
\ No newline at end of file
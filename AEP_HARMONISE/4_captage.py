@@ -1,55 +1,23 @@
 import psycopg2
-import psycopg2.extras
+import argparse
 import logging
 from psycopg2 import sql
 import traceback
+from spatial import insert_located, report_orphans, SPATIAL_MODES, DEFAULT_SPATIAL_MODE
+from db import DB_CONFIG_TARGET, DB_CONFIG_SOURCE_JIRAMA, SOURCE_ITERSIZE, connect_db, close_db, stream_query
+from resolvers import invalidate_resolvers
+from sync import SourceSync, SYNC_MODES, DEFAULT_SYNC_MODE
+from id_mapping import record_mappings
+from metrics import record_rows
+from log_config import setup_logging
 
 #  Configuration 
-DB_CONFIG_TARGET = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
-
-DB_CONFIG_SOURCE_JIRAMA = {
-    "database": "AEP_JIRAMA",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Bases de données CIBLE (AEP_HARMONISE) et SOURCE (AEP_JIRAMA) : voir db.py
 
 #  Logging 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('migration_captage.log'),
-        logging.StreamHandler()
-    ]
-)
+setup_logging('migration_captage.log')
 
 #  Fonctions Utilitaires 
-def connect_db(config, name):
-    try:
-        conn = psycopg2.connect(**config)
-        conn.autocommit = False
-        logging.info(f"Connexion réussie à {name} ({config['database']})")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Échec connexion à {name}: {e}")
-        raise
-
-def close_db(conn, name):
-    if conn:
-        try:
-            conn.close()
-            logging.info(f"Connexion à {name} fermée")
-        except psycopg2.Error as e:
-            logging.error(f"Erreur fermeture {name}: {e}")
-
 def format_libelle(original):
     """Convertit le libellé en majuscules et le nettoie"""
     if not original:
@@ -77,89 +45,133 @@ def find_quartier_id(target_cur, geom):
         return None
 
 #  Migration principale 
-def migrate_captage():
-    source_conn = target_conn = None
-    stats = {'total': 0, 'success': 0, 'skipped': 0, 'errors': 0}
+def migrate_captage(source_conn=None, target_conn=None, itersize=SOURCE_ITERSIZE,
+                    spatial_mode=DEFAULT_SPATIAL_MODE, sync_mode=DEFAULT_SYNC_MODE, delete_missing=False):
+    """Connexions fournies par le pipeline ou ouvertes ici si absentes.
+    La source est lue en flux par lots de itersize lignes (curseur serveur).
+    spatial_mode: 'row' (une requête quartier par ligne), 'join' (jointure spatiale unique)
+    ou 'strtree' (index des quartiers en mémoire, voir spatial.py).
+    sync_mode: 'full', 'watermark' (gid) ou 'hash', voir sync.py.
+    delete_missing: supprime les lignes disparues de la source (non référencées), voir sync.py.
+    Retourne le mapping identifiant source -> nouvel identifiant cible."""
+    own_source, own_target = source_conn is None, target_conn is None
+    stats = {'total': 0, 'success': 0, 'updated': 0, 'deleted': 0, 'skipped': 0, 'errors': 0}
     captage_mapping = {}  # Pour stocker les anciens IDs vers nouveaux IDs
 
     try:
         # Connexions
-        source_conn = connect_db(DB_CONFIG_SOURCE_JIRAMA, "Source JIRAMA")
-        target_conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
+        if own_source:
+            source_conn = connect_db(DB_CONFIG_SOURCE_JIRAMA, "Source JIRAMA")
+        if own_target:
+            target_conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
         
-        with source_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as source_cur, \
-             target_conn.cursor() as target_cur, \
+        with target_conn.cursor() as target_cur, \
              target_conn.cursor() as lookup_cur:
 
-            # 1. Récupération données source
-            source_cur.execute("""
+            # 1. Lecture en flux des données source (lignes à synchroniser)
+            sync = SourceSync(target_conn, 'AEP_JIRAMA', 'captage', 'gid', sync_mode, watermark_column='gid',
+                              delete_missing=delete_missing)
+            sync_condition, sync_params = sync.plan(source_conn, "geom IS NOT NULL")
+            source_rows = stream_query(source_conn, """
                 SELECT gid, id_capt, type, geom
                 FROM captage
-                WHERE geom IS NOT NULL;
-            """)
-            stats['total'] = source_cur.rowcount
-            logging.info(f"{stats['total']} captages à migrer")
+                WHERE geom IS NOT NULL AND """ + sync_condition + ";", sync_params, itersize=itersize)
 
-            # 2. Migration
-            for row in source_cur:
+            # 2. Transformation (l'insertion se fait ensuite par COPY en lots)
+            pending_gids = []
+            pending_rows = []
+            for row in source_rows:
+                stats['total'] += 1
                 try:
                     # Vérification géométrie
-                    if not row['geom']:
+                    if not row.geom:
                         stats['skipped'] += 1
                         continue
 
-                    # Recherche quartier
-                    quartier_id = find_quartier_id(lookup_cur, row['geom'])
-                    if not quartier_id:
-                        stats['skipped'] += 1
-                        continue
+                    # Recherche quartier (modes 'join' et 'strtree' : affecté lors de l'insertion)
+                    quartier_id = None
+                    if spatial_mode == 'row':
+                        quartier_id = find_quartier_id(lookup_cur, row.geom)
+                        if not quartier_id:
+                            stats['skipped'] += 1
+                            continue
 
                     # Formatage du libellé
-                    libelle_source = row['id_capt'] or f"CAPT_{row['gid']}"
+                    libelle_source = row.id_capt or f"CAPT_{row.gid}"
                     libelle_final = format_libelle(libelle_source)
                     logging.debug(f"Libellé transformé: {libelle_source} -> {libelle_final}")
 
-                    # Insertion
-                    target_cur.execute("""
-                        INSERT INTO captage (
-                            libelle_capt, type_capt, debit_capt, 
-                            date_mes, geom, id_quartier
-                        ) VALUES (%s, %s, %s, %s, %s, %s)
-                        RETURNING id_capt;
-                    """, (
+                    pending_gids.append(row.gid)
+                    pending_rows.append((
                         libelle_final,
-                        (row['type'] or '')[:60],
+                        (row.type or '')[:60],
                         None,  # debit_capt
                         None,  # date_mes
-                        row['geom'],
+                        row.geom,
                         quartier_id
                     ))
-                    
-                    new_id = target_cur.fetchone()[0]
-                    captage_mapping[row['gid']] = new_id
-                    stats['success'] += 1
-                    logging.debug(f"Migré: {row['gid']} -> {new_id}")
 
                 except Exception as e:
                     stats['errors'] += 1
-                    logging.error(f"Erreur sur captage {row['gid']}: {str(e)}")
+                    logging.error(f"Erreur sur captage {row.gid}: {str(e)}")
                     continue
 
+            logging.info(f"{stats['total']} captages lus dans la source")
+
+            # 3. Insertion en masse, ids restitués dans l'ordre des lignes source ;
+            #    captages modifiés (mode 'hash') ou déjà chargés (mode 'full') mis à jour sur place
+            columns = ('libelle_capt', 'type_capt', 'debit_capt', 'date_mes', 'geom', 'id_quartier')
+            updated_gids = [gid for gid in pending_gids if sync.is_update(gid)]
+            stats['updated'] = sync.update_rows(
+                target_cur, 'captage', 'id_capt', columns,
+                [(sync.target_id(gid), values) for gid, values in zip(pending_gids, pending_rows) if sync.is_update(gid)],
+                locate=True
+            )
+            inserted, orphans = insert_located(
+                target_cur, 'captage', 'id_capt', columns,
+                [gid for gid in pending_gids if not sync.is_update(gid)],
+                [values for gid, values in zip(pending_gids, pending_rows) if not sync.is_update(gid)],
+                spatial_mode
+            )
+            stats['skipped'] += len(orphans)
+            report_orphans('captage(s)', orphans)
+            for gid, _, new_id in inserted:
+                captage_mapping[gid] = new_id
+                stats['success'] += 1
+                logging.debug(f"Migré: {gid} -> {new_id}")
+
+            stats['deleted'] = sync.delete_rows(target_cur, 'captage', 'id_capt')
+            sync.record(target_cur, [(gid, new_id) for gid, _, new_id in inserted], updated_gids)
+            record_mappings(target_cur, 'AEP_JIRAMA', 'captage', 'captage', [(gid, new_id) for gid, _, new_id in inserted])
+            captage_mapping.update({int(gid): new_id for gid, new_id in sync.mapping(target_cur).items()})
+
             target_conn.commit()
+            invalidate_resolvers('captage')  # nouvelles références insérées
+            record_rows(read=stats['total'], written=stats['success'] + stats['updated'],
+                        rejected=stats['skipped'] + stats['errors'])
             logging.info("Migration terminée. Stats: %s", stats)
+            return captage_mapping
 
     except Exception as e:
         if target_conn: target_conn.rollback()
         logging.error(f"ERREUR GLOBALE: {str(e)}", exc_info=True)
         raise
     finally:
-        if source_conn: close_db(source_conn, "Source")
-        if target_conn: close_db(target_conn, "Cible")
+        if source_conn and own_source: close_db(source_conn, "Source")
+        if target_conn and own_target: close_db(target_conn, "Cible")
 
 if __name__ == "__main__":
     logging.info("Début migration captage")
     try:
-        migrate_captage()
+        parser = argparse.ArgumentParser(description="Migration des captages JIRAMA")
+        parser.add_argument("--spatial", choices=SPATIAL_MODES, default=DEFAULT_SPATIAL_MODE,
+                            help="affectation des quartiers: requête par ligne, jointure spatiale unique ou index STRtree en mémoire")
+        parser.add_argument("--sync", choices=SYNC_MODES, default=DEFAULT_SYNC_MODE,
+                            help="synchronisation: table complète, gid au-delà du filigrane ou comparaison d'empreintes")
+        parser.add_argument("--delete-missing", action="store_true",
+                            help="supprime de la cible les lignes disparues de la source (sauf lignes encore référencées)")
+        args = parser.parse_args()
+        migrate_captage(spatial_mode=args.spatial, sync_mode=args.sync, delete_missing=args.delete_missing)
         logging.info("Migration réussie")
     except Exception as e:
         logging.critical("Échec migration: %s", str(e))
\ No newline at end of file
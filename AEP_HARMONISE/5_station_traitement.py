@@ -1,55 +1,23 @@
 import psycopg2
-import psycopg2.extras
+import argparse
 import logging
 from psycopg2 import sql
 import traceback
+from spatial import insert_located, report_orphans, SPATIAL_MODES, DEFAULT_SPATIAL_MODE
+from db import DB_CONFIG_TARGET, DB_CONFIG_SOURCE_JIRAMA, SOURCE_ITERSIZE, connect_db, close_db, stream_query
+from resolvers import invalidate_resolvers
+from sync import SourceSync, SYNC_MODES, DEFAULT_SYNC_MODE
+from id_mapping import record_mappings
+from metrics import record_rows
+from log_config import setup_logging, set_verbosity, RowLog, VERBOSITY_LEVELS, DEFAULT_VERBOSITY
 
 #  Configuration 
-DB_CONFIG_TARGET = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
-
-DB_CONFIG_SOURCE_JIRAMA = {
-    "database": "AEP_JIRAMA",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Bases de données CIBLE (AEP_HARMONISE) et SOURCE (AEP_JIRAMA) : voir db.py
 
 #  Logging 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('migration_station_traitement.log'),
-        logging.StreamHandler()
-    ]
-)
+setup_logging('migration_station_traitement.log')
 
 #  Fonctions Utilitaires 
-def connect_db(config, name):
-    try:
-        conn = psycopg2.connect(**config)
-        conn.autocommit = False
-        logging.info(f"Connexion réussie à {name} ({config['database']})")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Échec connexion à {name}: {e}")
-        raise
-
-def close_db(conn, name):
-    if conn:
-        try:
-            conn.close()
-            logging.info(f"Connexion à {name} fermée")
-        except psycopg2.Error as e:
-            logging.error(f"Erreur fermeture {name}: {e}")
-
 def find_quartier_id(target_cur, geom_point):
     """Trouve l'ID du quartier contenant le point de la station"""
     try:
@@ -76,88 +44,135 @@ def convert_capacite(capacite_str):
         return None
 
 #  Migration principale 
-def migrate_station_traitement():
-    source_conn = target_conn = None
-    stats = {'total': 0, 'success': 0, 'skipped': 0, 'errors': 0}
+def migrate_station_traitement(source_conn=None, target_conn=None, itersize=SOURCE_ITERSIZE,
+                               spatial_mode=DEFAULT_SPATIAL_MODE, sync_mode=DEFAULT_SYNC_MODE, delete_missing=False):
+    """Connexions fournies par le pipeline ou ouvertes ici si absentes.
+    La source est lue en flux par lots de itersize lignes (curseur serveur).
+    spatial_mode: 'row' (une requête quartier par ligne), 'join' (jointure spatiale unique)
+    ou 'strtree' (index des quartiers en mémoire, voir spatial.py).
+    sync_mode: 'full' ou 'hash' (clé source textuelle : pas de mode 'watermark'), voir sync.py.
+    delete_missing: supprime les lignes disparues de la source (non référencées), voir sync.py.
+    Retourne le mapping identifiant source -> nouvel identifiant cible."""
+    own_source, own_target = source_conn is None, target_conn is None
+    station_mapping = {}  # identifiant source -> nouvel identifiant
+    stats = {'total': 0, 'success': 0, 'updated': 0, 'deleted': 0, 'skipped': 0, 'errors': 0}
     
     try:
         # Connexions
-        source_conn = connect_db(DB_CONFIG_SOURCE_JIRAMA, "Source JIRAMA")
-        target_conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
+        if own_source:
+            source_conn = connect_db(DB_CONFIG_SOURCE_JIRAMA, "Source JIRAMA")
+        if own_target:
+            target_conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
         
-        with source_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as source_cur, \
-             target_conn.cursor() as target_cur, \
+        with target_conn.cursor() as target_cur, \
              target_conn.cursor() as lookup_cur:
 
-            # 1. Récupération données source
-            source_cur.execute("""
+            # 1. Lecture en flux des données source (lignes à synchroniser)
+            sync = SourceSync(target_conn, 'AEP_JIRAMA', 'stationTraitement', 'id', sync_mode,
+                              delete_missing=delete_missing)
+            sync_condition, sync_params = sync.plan(source_conn, "geom IS NOT NULL")
+            source_rows = stream_query(source_conn, """
                 SELECT id, elevation, decanteurs, filtres, capacite, geom
                 FROM "stationTraitement"
-                WHERE geom IS NOT NULL;
-            """)
-            stats['total'] = source_cur.rowcount
-            logging.info(f"{stats['total']} stations à migrer")
+                WHERE geom IS NOT NULL AND """ + sync_condition + ";", sync_params, itersize=itersize)
 
-            # 2. Migration
-            for row in source_cur:
+            # 2. Transformation (l'insertion se fait ensuite par COPY en lots)
+            pending = []
+            for row in source_rows:
+                stats['total'] += 1
                 try:
                     # Vérification géométrie
-                    if not row['geom']:
+                    if not row.geom:
                         stats['skipped'] += 1
                         continue
 
-                    # Recherche quartier parent
-                    quartier_id = find_quartier_id(lookup_cur, row['geom'])
-                    if not quartier_id:
-                        stats['skipped'] += 1
-                        logging.warning(f"Aucun quartier trouvé pour la station {row['id']}")
-                        continue
+                    # Recherche quartier parent (modes 'join' et 'strtree' : affecté lors de l'insertion)
+                    quartier_id = None
+                    if spatial_mode == 'row':
+                        quartier_id = find_quartier_id(lookup_cur, row.geom)
+                        if not quartier_id:
+                            stats['skipped'] += 1
+                            logging.warning(f"Aucun quartier trouvé pour la station {row.id}")
+                            continue
 
                     # Conversion des données
-                    capacite_num = convert_capacite(row['capacite'])
-
-                    # Insertion
-                    target_cur.execute("""
-                        INSERT INTO station_traitement (
-                            libelle, elevation, decanteurs, 
-                            filtres, capacite, geom, 
-                            id_quartier
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        RETURNING id_station;
-                    """, (
-                        row['id'][:50],  # libelle (limité à 50 caractères)
-                        row['elevation'],
-                        row['decanteurs'],
-                        row['filtres'],
+                    capacite_num = convert_capacite(row.capacite)
+
+                    pending.append((row.id, (
+                        row.id[:50],  # libelle (limité à 50 caractères)
+                        row.elevation,
+                        row.decanteurs,
+                        row.filtres,
                         capacite_num,
-                        row['geom'],
+                        row.geom,
                         quartier_id
-                    ))
-                    
-                    new_id = target_cur.fetchone()[0]
-                    stats['success'] += 1
-                    logging.info(f"Station migrée: {row['id']} -> {new_id} (Quartier: {quartier_id})")
+                    )))
 
                 except Exception as e:
                     stats['errors'] += 1
-                    logging.error(f"Erreur sur station {row.get('id')}: {str(e)}")
+                    logging.error(f"Erreur sur station {row.id}: {str(e)}")
                     continue
 
+            logging.info(f"{stats['total']} stations lus dans la source")
+
+            # 3. Insertion en masse, ids restitués dans l'ordre des lignes source ;
+            #    stations modifiées (mode 'hash') ou déjà chargées (mode 'full') mises à jour sur place
+            columns = ('libelle', 'elevation', 'decanteurs', 'filtres', 'capacite', 'geom', 'id_quartier')
+            updates = [(source_id, values) for source_id, values in pending if sync.is_update(source_id)]
+            pending = [(source_id, values) for source_id, values in pending if not sync.is_update(source_id)]
+            stats['updated'] = sync.update_rows(
+                target_cur, 'station_traitement', 'id_station', columns,
+                [(sync.target_id(source_id), values) for source_id, values in updates], locate=True
+            )
+            inserted, orphans = insert_located(
+                target_cur, 'station_traitement', 'id_station', columns,
+                [source_id for source_id, _ in pending], [values for _, values in pending], spatial_mode
+            )
+            stats['skipped'] += len(orphans)
+            report_orphans('station(s)', orphans)
+            migrated_log = RowLog('station_traitement', 'migrée(s)')
+            for source_id, values, new_id in inserted:
+                station_mapping[source_id] = new_id
+                stats['success'] += 1
+                migrated_log.log("Station migrée: %s -> %s (Quartier: %s)", source_id, new_id, values[-1])
+            migrated_log.summary()
+
+            stats['deleted'] = sync.delete_rows(target_cur, 'station_traitement', 'id_station')
+            sync.record(target_cur, [(source_id, new_id) for source_id, _, new_id in inserted],
+                        [source_id for source_id, _ in updates])
+            record_mappings(target_cur, 'AEP_JIRAMA', 'stationTraitement', 'station_traitement', [(source_id, new_id) for source_id, _, new_id in inserted])
+            station_mapping.update(sync.mapping(target_cur))
+
             target_conn.commit()
+            invalidate_resolvers('station_traitement')  # nouvelles références insérées
+            record_rows(read=stats['total'], written=stats['success'] + stats['updated'],
+                        rejected=stats['skipped'] + stats['errors'])
             logging.info("Migration terminée. Stats: %s", stats)
+            return station_mapping
 
     except Exception as e:
         if target_conn: target_conn.rollback()
         logging.error(f"ERREUR GLOBALE: {str(e)}", exc_info=True)
         raise
     finally:
-        if source_conn: close_db(source_conn, "Source")
-        if target_conn: close_db(target_conn, "Cible")
+        if source_conn and own_source: close_db(source_conn, "Source")
+        if target_conn and own_target: close_db(target_conn, "Cible")
 
 if __name__ == "__main__":
     logging.info("Début migration station_traitement")
     try:
-        migrate_station_traitement()
+        parser = argparse.ArgumentParser(description="Migration des stations de traitement JIRAMA")
+        parser.add_argument("--spatial", choices=SPATIAL_MODES, default=DEFAULT_SPATIAL_MODE,
+                            help="affectation des quartiers: requête par ligne, jointure spatiale unique ou index STRtree en mémoire")
+        parser.add_argument("--sync", choices=[m for m in SYNC_MODES if m != 'watermark'], default=DEFAULT_SYNC_MODE,
+                            help="synchronisation: table complète ou comparaison d'empreintes")
+        parser.add_argument("--verbosity", choices=VERBOSITY_LEVELS, default=DEFAULT_VERBOSITY,
+                            help="messages par station migrée: résumé seul, échantillon ou tous")
+        parser.add_argument("--delete-missing", action="store_true",
+                            help="supprime de la cible les lignes disparues de la source (sauf lignes encore référencées)")
+        args = parser.parse_args()
+        set_verbosity(args.verbosity)
+        migrate_station_traitement(spatial_mode=args.spatial, sync_mode=args.sync, delete_missing=args.delete_missing)
         logging.info("Migration réussie")
     except Exception as e:
         logging.critical("Échec migration: %s", str(e))
\ No newline at end of file
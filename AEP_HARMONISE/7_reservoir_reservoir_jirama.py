@@ -3,63 +3,32 @@
 import psycopg2
 import logging
 from psycopg2 import sql
+from db import DB_CONFIG_TARGET, connect_db, close_db
+from resolvers import get_resolver
+from id_mapping import lookup_ids
+from metrics import record_rows
+from log_config import setup_logging
 
 #  Configuration 
-DB_CONFIG = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Base de données cible (AEP_HARMONISE) : voir db.py
 
 #  Logging 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('remplissage_reservoir_reservoir.log'),
-        logging.StreamHandler()
-    ]
-)
+setup_logging('remplissage_reservoir_reservoir.log')
 
 #  Fonctions Utilitaires 
-def connect_db(config):
-    try:
-        conn = psycopg2.connect(**config)
-        conn.autocommit = False
-        logging.info("Connexion à la base de données réussie")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Échec de connexion à la base de données: {e}")
-        raise
-
-def close_db(conn):
-    if conn:
-        try:
-            conn.close()
-            logging.info("Connexion à la base de données fermée")
-        except psycopg2.Error as e:
-            logging.error(f"Erreur lors de la fermeture de la connexion: {e}")
-
 def get_reservoir_id(cur, libelle):
-    """Récupère l'ID d'un réservoir par son libellé (insensible à la casse et aux espaces)"""
-    try:
-        cur.execute("""
-            SELECT id_reservoir FROM reservoir 
-            WHERE UPPER(TRIM(libelle)) = UPPER(TRIM(%s))
-        """, (libelle,))
-        result = cur.fetchone()
-        return result[0] if result else None
-    except psycopg2.Error as e:
-        logging.error(f"Erreur lors de la recherche du réservoir {libelle}: {e}")
-        return None
+    """Récupère l'ID d'un réservoir par son libellé (insensible à la casse et aux espaces).
+    La table reservoir est chargée une fois en mémoire (voir resolvers.py)."""
+    return get_resolver(cur.connection, 'reservoir').resolve(libelle)
 
 #  Remplissage des relations 
-def fill_reservoir_reservoir_relations():
-    conn = None
+def fill_reservoir_reservoir_relations(conn=None, reservoir_ids=None):
+    """reservoir_ids: {LIBELLE: id_reservoir} déjà connu du pipeline ; sinon les libellés sont
+    résolus en une requête par la table id_mapping (voir id_mapping.py), puis par libellé"""
+    own_conn = conn is None  # connexion fournie par le pipeline ou ouverte ici
     try:
-        conn = connect_db(DB_CONFIG)
+        if own_conn:
+            conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
         cur = conn.cursor()
 
         # Liste des relations à créer (source, destination)
@@ -71,11 +40,16 @@ def fill_reservoir_reservoir_relations():
 
         stats = {'total': len(relations), 'success': 0, 'errors': 0}
 
+        if reservoir_ids is None:
+            libelles = {libelle for relation in relations for libelle in relation}
+            reservoir_ids = {key.strip().upper(): reservoir_id for key, reservoir_id in
+                             lookup_ids(cur, 'AEP_JIRAMA', 'Reservoir', libelles, ignore_case=True).items()}
+
         for source_libelle, dest_libelle in relations:
             try:
                 # Récupération des IDs
-                source_id = get_reservoir_id(cur, source_libelle)
-                dest_id = get_reservoir_id(cur, dest_libelle)
+                source_id = reservoir_ids.get(source_libelle.strip().upper()) or get_reservoir_id(cur, source_libelle)
+                dest_id = reservoir_ids.get(dest_libelle.strip().upper()) or get_reservoir_id(cur, dest_libelle)
 
                 if not source_id:
                     logging.error(f"Réservoir source non trouvé: {source_libelle}")
@@ -116,14 +90,16 @@ def fill_reservoir_reservoir_relations():
                 continue
 
         conn.commit()
+        record_rows(read=stats['total'], written=stats['success'], rejected=stats['errors'])
         logging.info(f"Remplissage terminé. Statistiques: {stats}")
+        return stats
 
     except Exception as e:
         if conn: conn.rollback()
         logging.error(f"ERREUR GLOBALE: {str(e)}", exc_info=True)
         raise
     finally:
-        if conn: close_db(conn)
+        if conn and own_conn: close_db(conn, "Cible HARMONISE")
 
 if __name__ == "__main__":
     logging.info("Début du remplissage des relations réservoir-réservoir")
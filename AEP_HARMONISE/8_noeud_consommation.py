@@ -2,79 +2,83 @@ import os
 import json
 import psycopg2
 import logging
+import time
+import argparse
 from psycopg2.extras import Json
+from bulk_copy import copy_rows_returning
+from batch_writer import write_isolated
+from id_mapping import record_mappings
+from manifest import IngestionManifest
+from geojson_stream import iter_features, geometry_type, geometry_member, batched
+from db import DB_CONFIG_TARGET, connect_db, close_db
+from resolvers import invalidate_resolvers
+from metrics import record_file
+from quarantine import Quarantine, DONNEE_MANQUANTE, GEOMETRIE_MANQUANTE, REFUS_BASE
+from log_config import setup_logging, set_verbosity, RowLog, VERBOSITY_LEVELS, DEFAULT_VERBOSITY
 
 # Configuration
-DB_CONFIG = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Base de données cible (AEP_HARMONISE) : voir db.py
 
 GEOJSON_FILE = "noeud_consommation.geojson"
 SRID = 29702
 
+# Nombre de features lues puis insérées (COPY) par lot
+GEOJSON_BATCH_SIZE = 1000
+
 # Configuration du logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('migration_noeud_consommation.log'),
-        logging.StreamHandler()
-    ]
-)
-
-def connect_db(config):
-    try:
-        conn = psycopg2.connect(**config)
-        conn.autocommit = False
-        logging.info("Connexion à la base de données réussie")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Échec de la connexion à la base de données: {e}")
-        raise
+setup_logging('migration_noeud_consommation.log')
 
 def load_geojson(file_path):
-    """Charge les données depuis le fichier GeoJSON"""
+    """Itère en flux sur les features du fichier GeoJSON (voir geojson_stream.py).
+
+    Le type FeatureCollection est vérifié à la lecture ; les géométries restent en texte brut.
+    """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            
-        if data.get('type') != 'FeatureCollection':
-            raise ValueError("Le fichier GeoJSON doit être de type FeatureCollection")
-            
-        features = data.get('features', [])
-        logging.info(f"Fichier GeoJSON chargé: {len(features)} features trouvées")
-        return features
-        
+        yield from iter_features(file_path)
     except Exception as e:
         logging.error(f"Erreur lors du chargement du GeoJSON: {e}")
         raise
 
 def transform_geometry(feature):
-    """Transforme la géométrie GeoJSON en WKT"""
+    """Vérifie que la géométrie est un Point 2D et la retourne en texte GeoJSON brut"""
     try:
         geometry = feature.get('geometry')
-        if not geometry or geometry.get('type') != 'Point':
+        if isinstance(geometry, dict):  # feature déjà décodée
+            geometry = json.dumps(geometry)
+        if not geometry or geometry_type(geometry) != 'Point':
             raise ValueError("Geometry manquante ou n'est pas un Point")
-            
-        coordinates = geometry.get('coordinates')
+
+        coordinates = geometry_member(geometry, 'coordinates')
         if not coordinates or len(coordinates) != 2:
             raise ValueError("Coordonnées invalides")
-            
-        lon, lat = coordinates
-        return f"POINT({lon} {lat})"
-        
+
+        return geometry
+
     except Exception as e:
         logging.error(f"Erreur de transformation de la géométrie: {e}")
         raise
 
-def migrate_noeud_consommation():
-    """Migre les données de noeud_consommation depuis le GeoJSON"""
-    conn = None
-    stats = {'total': 0, 'inserted': 0, 'errors': 0, 'skipped': 0}
+def raw_feature(feature):
+    """Feature brute {'id', 'properties', 'geometry'} (contenu mis en quarantaine)"""
+    geometry = feature.get('geometry')
+    if isinstance(geometry, str):
+        geometry = json.loads(geometry)
+    return {'id': feature.get('id'), 'properties': feature.get('properties') or {}, 'geometry': geometry}
+
+def migrate_noeud_consommation(conn=None, force=False):
+    """Migre les données de noeud_consommation depuis le GeoJSON
+
+    Mode incrémental (défaut) : le fichier n'est relu que s'il est nouveau ou modifié
+    depuis son dernier chargement (voir manifest.py) ; force le relit dans tous les cas.
+
+    Chaque lot est écrit sous SAVEPOINT (voir batch_writer.py) : une feature refusée par la
+    base n'annule pas le lot. Les features ignorées ou refusées sont mises en quarantaine
+    avec leur position dans le fichier (voir quarantine.py).
+    """
+    own_conn = conn is None  # connexion fournie par le pipeline ou ouverte ici
+    stats = {'total': 0, 'inserted': 0, 'errors': 0, 'skipped': 0, 'rejected': 0}
+    quarantine = None
+    started = time.perf_counter()
     
     try:
         # Chemin complet du fichier GeoJSON
@@ -84,68 +88,122 @@ def migrate_noeud_consommation():
         if not os.path.exists(geojson_path):
             raise FileNotFoundError(f"Fichier GeoJSON introuvable: {geojson_path}")
         
-        # Chargement des données
+        # Lecture en flux : le fichier n'est pas chargé en mémoire
         features = load_geojson(geojson_path)
-        stats['total'] = len(features)
-        
-        if stats['total'] == 0:
-            logging.warning("Aucune donnée à migrer dans le fichier GeoJSON")
-            return stats
-        
+
         # Connexion à la base
-        conn = connect_db(DB_CONFIG)
-        
+        if own_conn:
+            conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
+
+        manifest = IngestionManifest(conn, 'noeud_consommation', force=force)
+        if not manifest.select([geojson_path]):
+            logging.info(f"Fichier {geojson_path} déjà chargé et inchangé : migration ignorée")
+            return stats
+
+        quarantine = Quarantine(conn, 'noeud_consommation')
+        inserted_log = RowLog('noeud_consommation', 'insérée(s)')
+        skipped_log = RowLog('noeud_consommation', 'ignorée(s) (libelle manquant)', level=logging.WARNING)
         with conn.cursor() as cursor:
-            for feature in features:
-                try:
-                    # Extraction des propriétés
-                    properties = feature.get('properties', {})
-                    libelle = properties.get('libelle')
-                    troncon = properties.get('id_troncon') or None  # NULL si manquant
-                    
-                    # Validation des données obligatoires
-                    if not libelle:
-                        stats['skipped'] += 1
-                        logging.warning(f"Feature ignorée (libelle manquant): {properties}")
+            quarantine.forget_file(cursor, geojson_path)  # fichier relu en entier
+            for batch in batched(enumerate(features, 1), GEOJSON_BATCH_SIZE):
+                pending_rows = []
+                pending = []  # (position, feature, id de la feature) de chaque ligne de pending_rows
+                for position, feature in batch:
+                    stats['total'] += 1
+                    try:
+                        # Extraction des propriétés
+                        properties = feature.get('properties') or {}
+                        libelle = properties.get('libelle')
+                        troncon = properties.get('id_troncon') or None  # NULL si manquant
+
+                        # Validation des données obligatoires
+                        if not libelle:
+                            stats['skipped'] += 1
+                            skipped_log.log("Feature ignorée (libelle manquant): %s", properties)
+                            quarantine.add(DONNEE_MANQUANTE, raw_feature(feature), geojson_path, position,
+                                           "libelle manquant")
+                            continue
+
+                        # Vérification de la géométrie (texte GeoJSON brut, non réencodé)
+                        geom_json = transform_geometry(feature)
+
+                        # Mise en attente pour l'insertion en masse (avec gestion NULL pour troncon)
+                        pending_rows.append((libelle, troncon, geom_json))
+                        pending.append((position, feature, properties.get('id', feature.get('id'))))
+
+                    except Exception as e:
+                        stats['errors'] += 1
+                        feature_id = properties.get('id', 'inconnu')
+                        logging.error(f"Erreur sur la feature {feature_id}: {str(e)}")
+                        quarantine.add(GEOMETRIE_MANQUANTE, raw_feature(feature), geojson_path, position, str(e))
                         continue
-                    
-                    # Préparation de la géométrie
-                    geom_wkt = transform_geometry(feature)
-                    
-                    # Insertion dans la base (avec gestion NULL pour troncon)
-                    cursor.execute("""
-                        INSERT INTO noeud_consommation (libelle, troncon, geom)
-                        VALUES (%s, %s, ST_Transform(ST_SetSRID(ST_GeomFromText(%s), 4326), %s))
-                        RETURNING id_noeud_cons;
-                    """, (libelle, troncon, geom_wkt, SRID))
-                    
-                    inserted_id = cursor.fetchone()[0]
+
+                # Insertion du lot par COPY, features refusées isolées ; la géométrie GeoJSON
+                # (WGS84) est reprojetée côté serveur
+                written, rejected = write_isolated(
+                    cursor,
+                    lambda cur, rows: copy_rows_returning(
+                        cur, 'noeud_consommation', 'id_noeud_cons', ('libelle', 'troncon', 'geom'), rows,
+                        expressions={'geom': f"ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON({{}}), 4326), {SRID})"}
+                    ),
+                    pending_rows, label="noeud_consommation"
+                )
+                stats['rejected'] += len(rejected)
+                for index, _, message in rejected:
+                    position, feature, _ = pending[index]
+                    quarantine.add(REFUS_BASE, raw_feature(feature), geojson_path, position, message)
+
+                # Lignes écrites dans l'ordre du lot, sans les features refusées
+                refused = {index for index, _, _ in rejected}
+                kept = [entry for index, entry in enumerate(pending) if index not in refused]
+                inserted_ids = [new_id for _, new_ids in written for new_id in new_ids]
+                for (_, feature, _), inserted_id in zip(kept, inserted_ids):
                     stats['inserted'] += 1
-                    logging.info(f"Noeud inséré - ID: {inserted_id}, Libellé: {libelle}")
-                    
-                except Exception as e:
-                    stats['errors'] += 1
-                    conn.rollback()  # Annule seulement la transaction courante
-                    feature_id = properties.get('id', 'inconnu')
-                    logging.error(f"Erreur sur la feature {feature_id}: {str(e)}")
-                    continue
-            
+                    inserted_log.log("Noeud inséré - ID: %s, Libellé: %s", inserted_id,
+                                     (feature.get('properties') or {}).get('libelle'))
+                record_mappings(cursor, 'GEOJSON', 'noeud_consommation', 'noeud_consommation',
+                                zip((key for _, _, key in kept), inserted_ids))
+
+            inserted_log.summary()
+            if skipped_log.count:
+                skipped_log.summary()
+
+            if stats['total'] == 0:
+                logging.warning("Aucune donnée à migrer dans le fichier GeoJSON")
+                return stats
+
+            quarantine.flush(cursor)
+            manifest.record(geojson_path, stats)
             conn.commit()
-            logging.info(f"Migration terminée. Statistiques: Total={stats['total']}, Insérés={stats['inserted']}, Erreurs={stats['errors']}, Ignorés={stats['skipped']}")
+            quarantine.log_summary()
+            invalidate_resolvers('noeud_consommation')  # nouvelles références insérées
+            record_file(geojson_path, read=stats['total'], written=stats['inserted'],
+                        rejected=stats['errors'] + stats['skipped'] + stats['rejected'],
+                        seconds=time.perf_counter() - started)
+            logging.info(f"Migration terminée. Statistiques: Total={stats['total']}, Insérés={stats['inserted']}, Erreurs={stats['errors']}, Ignorés={stats['skipped']}, Refusés={stats['rejected']}")
             return stats
             
     except Exception as e:
         if conn: conn.rollback()
+        if quarantine is not None:
+            quarantine.discard()
         logging.error(f"ERREUR GLOBALE: {str(e)}", exc_info=True)
         raise
     finally:
-        if conn: conn.close()
-        logging.info("Connexion à la base de données fermée")
+        if conn and own_conn: close_db(conn, "Cible HARMONISE")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migration des noeuds de consommation depuis le fichier GeoJSON")
+    parser.add_argument("--force", action="store_true",
+                        help="relit le fichier même s'il a déjà été chargé et n'a pas changé")
+    parser.add_argument("--verbosity", choices=VERBOSITY_LEVELS, default=DEFAULT_VERBOSITY,
+                        help="messages par feature insérée ou ignorée: résumé seul, échantillon ou tous")
+    args = parser.parse_args()
+    set_verbosity(args.verbosity)
+
     logging.info("Début de la migration des noeuds tronçons depuis GeoJSON")
     try:
-        results = migrate_noeud_consommation()
+        results = migrate_noeud_consommation(force=args.force)
         if results['errors'] == 0:
             logging.info("Migration terminée avec succès")
         else:
@@ -2,40 +2,36 @@ import os
 import pandas as pd
 import psycopg2
 import logging
+import time
+import argparse
 from datetime import datetime
 from typing import Dict, Optional
+from bulk_copy import copy_rows
+from batch_writer import write_isolated, total
+from manifest import IngestionManifest
+from checkpoints import FileCheckpoint
+from quarantine import Quarantine, replay, REFERENCE_MANQUANTE, REFUS_BASE
+from excel_reader import HeaderCache, HEADER_CACHE_FILE, DEFAULT_CHUNK_SIZE, iter_chunks
+from db import DB_CONFIG_TARGET, connect_db, close_db
+from resolvers import get_resolver, set_fuzzy_matching, invalidate_resolvers, log_resolver_stats
+from metrics import record_file
+from log_config import setup_logging
 
 # Configuration de la base de données
-DB_CONFIG = {
-    "database": "AEP_HARMONISE",
-    "user": "postgres",
-    "password": "*******",
-    "host": "localhost",
-    "port": "5432"
-}
+# Base de données cible (AEP_HARMONISE) : voir db.py
 
 # Configuration du logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('import_excel_points_distribution.log'),
-        logging.StreamHandler()
-    ]
-)
+setup_logging('import_excel_points_distribution.log')
 
 # Chemin du dossier contenant les fichiers Excel (répertoire du script)
 DOSSIER_EXCEL = os.path.dirname(os.path.abspath(__file__))
 
-def connect_db(config):
-    try:
-        conn = psycopg2.connect(**config)
-        conn.autocommit = False
-        logging.info("Connexion à la base de données réussie")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Échec de la connexion à la base de données: {e}")
-        raise
+# Valeurs de l'énumération type_point_distr et type retenu par défaut
+TYPES_POINT_DISTR = ("BORNE FONTAINE", "BORNE PARTICULIER")
+TYPE_PAR_DEFAUT = "BORNE PARTICULIER"
+
+# Nombre de valeurs non résolues citées dans le journal
+WARNING_SAMPLE_SIZE = 20
 
 def load_excel_mapping(xlsx_path: str) -> Dict[str, str]:
     """
@@ -54,13 +50,10 @@ def load_excel_mapping(xlsx_path: str) -> Dict[str, str]:
             col_borne = df.columns[0]
             col_troncon = df.columns[1] if len(df.columns) > 1 else df.columns[0]
         
-        mapping = {}
-        for _, row in df.iterrows():
-            num = row.get(col_borne)
-            att = row.get(col_troncon)
-            if pd.isna(num) or pd.isna(att):
-                continue
-            mapping[str(num).strip()] = str(att).strip()
+        # Paires complètes seulement ; en cas de doublon, la dernière ligne l'emporte
+        refs, troncons = df[col_borne], df[col_troncon]
+        complete = refs.notna() & troncons.notna()
+        mapping = dict(zip(refs[complete].str.strip(), troncons[complete].str.strip()))
         
         logging.info(f"{len(mapping)} mappings chargés")
         return mapping
@@ -69,222 +62,313 @@ def load_excel_mapping(xlsx_path: str) -> Dict[str, str]:
         logging.error(f"Erreur lors de la lecture du fichier de mapping: {e}")
         return {}
 
-def find_noeud_cons_id(conn, troncon: str) -> Optional[int]:
-    """
-    Trouve l'ID du noeud_consommation correspondant au tronçon
-    """
-    if not troncon or pd.isna(troncon):
-        return None
-    
-    try:
-        with conn.cursor() as cur:
-            normalized = troncon.replace(" - ", "->")
-            cur.execute("""
-                SELECT id_noeud_cons FROM noeud_consommation 
-                WHERE troncon = %s LIMIT 1
-            """, (normalized,))
-            result = cur.fetchone()
-            if result:
-                return result[0]
-            
-            if " - " in troncon:
-                parts = [p.strip() for p in troncon.split(" - ")]
-                if len(parts) == 2:
-                    for variant in [f"{parts[0]}->{parts[1]}", f"{parts[1]}->{parts[0]}"]:
-                        cur.execute("""
-                            SELECT id_noeud_cons FROM noeud_consommation 
-                            WHERE troncon = %s LIMIT 1
-                        """, (variant,))
-                        result = cur.fetchone()
-                        if result:
-                            return result[0]
-            return None
-            
-    except Exception as e:
-        logging.error(f"Erreur lors de la recherche du noeud_consommation: {e}")
-        return None
+def clean_text(column):
+    """Colonne en texte sans espaces de début/fin (None pour les cellules vides)"""
+    cleaned = column.astype(str).str.strip().where(column.notna())
+    return cleaned.where(cleaned != "")
 
-def get_quartier_id(conn, quartier_name):
-    """Trouve l'ID du quartier en ajoutant 'FKT ' devant le nom"""
-    if not quartier_name or pd.isna(quartier_name):
-        return None
-        
-    try:
-        quartier_name = str(quartier_name).strip()
-        search_name = f"FKT {quartier_name}"
-        
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT id_quartier 
-                FROM quartier 
-                WHERE lib_quartier ILIKE %s
-                LIMIT 1;
-            """, (search_name,))
-            result = cur.fetchone()
-            return result[0] if result else None
-    except psycopg2.Error as e:
-        logging.error(f"Erreur lors de la recherche du quartier '{quartier_name}': {e}")
-        return None
-
-def process_excel_file(excel_file, conn, mapping_data):
-    """Traite un fichier Excel et importe les données"""
-    stats = {
+def normalize_types(df):
+    """Type de chaque ligne, ramené à l'énumération type_point_distr"""
+    if 'Type' not in df.columns:
+        return pd.Series(TYPE_PAR_DEFAUT, index=df.index)
+    types = df['Type'].astype(str).str.strip().str.upper().where(df['Type'].notna(), TYPE_PAR_DEFAUT)
+    unknown = ~types.isin(TYPES_POINT_DISTR)
+    if unknown.any():
+        counts = types[unknown].value_counts()
+        listed = ', '.join(f"'{value}' ({count})" for value, count in counts.head(WARNING_SAMPLE_SIZE).items())
+        logging.warning(f"{int(unknown.sum())} ligne(s) de type inconnu, remplacé par '{TYPE_PAR_DEFAUT}': {listed}")
+    return types.where(~unknown, TYPE_PAR_DEFAUT)
+
+def resolve_column(conn, reference, values):
+    """Ids de référence d'une colonne : chaque valeur distincte est résolue une fois (alias,
+    libellé exact, rapprochement approché si activé), puis rattachée aux lignes par jointure"""
+    resolved = get_resolver(conn, reference).resolve_many(values.dropna().unique())
+    frame = pd.DataFrame({
+        'value': pd.Series(list(resolved.keys()), dtype=object),
+        'ref_id': pd.array(list(resolved.values()), dtype='Int64'),
+    })
+    merged = values.astype(object).rename('value').to_frame().merge(frame, on='value', how='left')
+    return merged['ref_id'].set_axis(values.index)
+
+def _column_values(series):
+    """Valeurs Python d'une colonne d'ids (None pour les valeurs manquantes)"""
+    return [int(v) if pd.notna(v) else None for v in series]
+
+def raw_record(df, index):
+    """Ligne Excel brute {colonne: valeur} (contenu mis en quarantaine)"""
+    return {str(column): (None if pd.isna(value) else value) for column, value in df.loc[index].items()}
+
+def records_frame(entries):
+    """Lignes Excel reconstituées depuis la quarantaine (index d'origine : ligne - 2)"""
+    return pd.DataFrame([entry.payload for entry in entries],
+                        index=[entry.source_line - 2 for entry in entries])
+
+def transform_chunk(conn, df, mapping_data, stats, quarantine=None, file_path=None):
+    """Lignes à insérer (type, ref_borne, id_quartier, id_noeud_cons) d'un lot de lignes Excel,
+    et index des lignes Excel retenues (dans le même ordre).
+    quarantine : les lignes sans Ref borne y sont mises avec leur fichier et leur ligne."""
+    # 🔹 Transformation par colonnes entières (pas de traitement ligne à ligne)
+    ref_borne = clean_text(df['Ref_borne'])
+    kept = ref_borne.notna()
+    skipped = int((~kept).sum())
+    stats['skipped'] += skipped
+    if skipped:
+        missing_index = df.index[~kept.to_numpy()]
+        lines = ', '.join(str(i + 2) for i in missing_index[:WARNING_SAMPLE_SIZE])
+        logging.warning(f"{skipped} ligne(s) sans Ref borne ignorée(s): lignes {lines}")
+        if quarantine is not None:
+            for index in missing_index:
+                quarantine.add(REFERENCE_MANQUANTE, raw_record(df, index), file_path, int(index) + 2)
+    df, ref_borne = df[kept], ref_borne[kept]
+
+    # Quartiers : résolution des noms distincts puis jointure
+    quartier_name = clean_text(df['Cartier'])
+    id_quartier = resolve_column(conn, 'quartier', quartier_name)
+    missing = quartier_name.notna() & id_quartier.isna()
+    not_found = int(missing.sum())
+    stats['quartier_not_found'] += not_found
+    if not_found:
+        counts = quartier_name[missing].value_counts()
+        listed = ', '.join(f"'{name}' ({count})" for name, count in counts.head(WARNING_SAMPLE_SIZE).items())
+        logging.warning(f"{not_found} ligne(s) de quartier non trouvé dans la base: {listed}")
+
+    # Noeuds de consommation : tronçon du fichier de mapping, puis résolution
+    troncon = ref_borne.map(mapping_data)
+    id_noeud_cons = resolve_column(conn, 'noeud_consommation', troncon)
+    stats['noeud_cons_found'] += int((troncon.notna() & id_noeud_cons.notna()).sum())
+    stats['noeud_cons_not_found'] += int((troncon.notna() & id_noeud_cons.isna()).sum())
+
+    # 🔹 Déterminer le type à partir du fichier Excel
+    type_borne = normalize_types(df)
+
+    return list(zip(
+        type_borne.tolist(),
+        ref_borne.tolist(),
+        _column_values(id_quartier),
+        _column_values(id_noeud_cons),
+    )), df.index
+
+def write_chunk(cur, df, pending_rows, index, stats, label, quarantine=None, file_path=None):
+    """Insère les lignes d'un lot par COPY (geom et population restent NULL) ; les lignes
+    refusées par la base sont isolées (voir batch_writer.py) et mises en quarantaine"""
+    written, rejected = write_isolated(
+        cur,
+        lambda c, rows: copy_rows(c, 'point_de_distribution',
+                                  ('type', 'ref_borne', 'id_quartier', 'id_noeud_cons'), rows),
+        pending_rows, label=label
+    )
+    stats['inserted'] += total(written)
+    stats['rejected'] += len(rejected)
+    if quarantine is not None:
+        for position, _, message in rejected:
+            quarantine.add(REFUS_BASE, raw_record(df, index[position]), file_path,
+                           int(index[position]) + 2, message)
+
+def _file_stats():
+    return {
         'total': 0,
         'inserted': 0,
         'skipped': 0,
         'errors': 0,
+        'rejected': 0,
         'quartier_not_found': 0,
         'noeud_cons_found': 0,
         'noeud_cons_not_found': 0
     }
+
+def process_excel_file(excel_file, conn, mapping_data, chunk_size=DEFAULT_CHUNK_SIZE,
+                       manifest=None, resume=False, quarantine=None, restart=False):
+    """Traite un fichier Excel et importe les données (lecture et insertion par lots)
+
+    Chaque lot est validé avec son point de reprise (voir checkpoints.py) ; resume repart
+    après le dernier lot validé. Le fichier est enregistré dans manifest avec son dernier lot.
+    La table n'ayant pas de clé naturelle, un fichier interrompu qui ne peut pas être repris
+    est refusé (les lots validés seraient dupliqués), sauf si restart le recharge quand même.
+    Une ligne refusée par la base est écartée seule (voir batch_writer.py), sans annuler le lot.
+    Les lignes sans Ref borne ou refusées sont mises en quarantaine (voir quarantine.py).
+    """
+    stats = _file_stats()
     
     try:
-        df = pd.read_excel(excel_file)
-        stats['total'] = len(df)
-        logging.info(f"Fichier {os.path.basename(excel_file)} chargé: {stats['total']} enregistrements trouvés")
-
+        checkpoint = FileCheckpoint(conn, 'point_de_distribution', excel_file, resume=resume,
+                                    restartable=False, restart=restart, manifest=manifest)
         with conn.cursor() as cur:
-            for index, row in df.iterrows():
-                try:
-                    ref_borne = str(row['Ref_borne']).strip() if not pd.isna(row['Ref_borne']) else None
-                    if not ref_borne:
-                        stats['skipped'] += 1
-                        logging.warning(f"Ligne {index+2}: Ref borne - ignorée")
-                        continue
-
-                    quartier_name = str(row['Cartier']).strip() if not pd.isna(row['Cartier']) else None
-                    id_quartier = get_quartier_id(conn, quartier_name)
-                    
-                    if quartier_name and not id_quartier:
-                        stats['quartier_not_found'] += 1
-                        logging.warning(f"Ligne {index+2}: Quartier '{quartier_name}' non trouvé dans la base")
-
-                    id_noeud_cons = None
-                    if ref_borne in mapping_data:
-                        troncon = mapping_data[ref_borne]
-                        id_noeud_cons = find_noeud_cons_id(conn, troncon)
-                        if id_noeud_cons:
-                            stats['noeud_cons_found'] += 1
-                        else:
-                            stats['noeud_cons_not_found'] += 1
-
-                    # 🔹 Déterminer le type à partir du fichier Excel
-                    type_borne = str(row['Type']).strip().upper() if not pd.isna(row.get('Type')) else "BORNE PARTICULIER"
-                    if type_borne not in ["BORNE FONTAINE", "BORNE PARTICULIER"]:
-                        logging.warning(f"Ligne {index+2}: Type inconnu '{type_borne}', remplacé par 'BORNE PARTICULIER'")
-                        type_borne = "BORNE PARTICULIER"
-
-                    # 🔹 Insertion dans la base avec le bon type
-                    cur.execute("""
-                        INSERT INTO point_de_distribution (
-                            type, geom, ref_borne, population,
-                            id_quartier, id_noeud_cons
-                        ) VALUES (
-                            %s, NULL, %s, NULL, %s, %s
-                        )
-                    """, (
-                        type_borne,
-                        ref_borne, 
-                        id_quartier,
-                        id_noeud_cons
-                    ))
-
-                    stats['inserted'] += 1
-                    if (index + 1) % 100 == 0:
-                        conn.commit()
-                        logging.info(f"{index+1} lignes traitées...")
-
-                except Exception as e:
-                    stats['errors'] += 1
-                    logging.error(f"Erreur ligne {index+2}: {str(e)}")
-                    conn.rollback()
+            if quarantine is not None and checkpoint.next_batch == 0:
+                quarantine.forget_file(cur, excel_file)
+            for batch_index, df in enumerate(iter_chunks(excel_file, chunk_size)):
+                stats['total'] += len(df)
+                if checkpoint.skip(batch_index):
                     continue
+                pending_rows, index = transform_chunk(conn, df, mapping_data, stats, quarantine, excel_file)
 
+                # 🔹 Insertion par COPY (geom et population restent NULL), lignes refusées isolées
+                write_chunk(cur, df, pending_rows, index, stats,
+                            f"{os.path.basename(excel_file)} lot {batch_index}", quarantine, excel_file)
+                checkpoint.save(cur, batch_index, int(df.index[-1]) + 1, df.itertuples(index=False, name=None))
+                if quarantine is not None:
+                    quarantine.flush(cur)
+                conn.commit()
+                logging.info(f"{stats['total']} lignes traitées...")
+
+            checkpoint.clear(cur)
+            if manifest:
+                manifest.record(excel_file, stats)
             conn.commit()
-            logging.info(f"Fichier {os.path.basename(excel_file)} traité. Stats: {stats}")
+            invalidate_resolvers('point_de_distribution')  # nouvelles références insérées
+            logging.info(f"Fichier {os.path.basename(excel_file)} traité ({stats['total']} enregistrements). Stats: {stats}")
             return stats
 
     except Exception as e:
         conn.rollback()
+        if quarantine is not None:
+            quarantine.discard()
         logging.error(f"ERREUR lors du traitement du fichier {excel_file}: {str(e)}", exc_info=True)
         raise
 
-def find_mapping_file(directory: str) -> Optional[str]:
-    """Trouve le fichier Excel de mapping dans le répertoire"""
-    for filename in os.listdir(directory):
+def find_mapping_file(directory: str, header_cache: Optional[HeaderCache] = None) -> Optional[str]:
+    """Trouve le fichier Excel de mapping dans le répertoire (d'après l'en-tête seul)"""
+    if header_cache is None:
+        header_cache = HeaderCache(os.path.join(directory, HEADER_CACHE_FILE))
+    for filename in sorted(os.listdir(directory)):
         if filename.lower().endswith(('.xlsx', '.xls')):
             try:
-                df = pd.read_excel(os.path.join(directory, filename), nrows=1)
-                cols = [c.strip().lower() for c in df.columns]
+                cols = [c.strip().lower() for c in header_cache.header(os.path.join(directory, filename))]
                 if any("ref_borne" in c or "borne" in c for c in cols) and \
                    any("tronçon" in c or "troncon" in c for c in cols):
                     return os.path.join(directory, filename)
-            except:
+            except Exception as e:
+                logging.warning(f"En-tête illisible pour {filename}: {e}")
                 continue
     return None
 
-def import_excel_files():
-    """Importe tous les fichiers Excel du dossier"""
+def replay_file(conn, cur, excel_file, entries, quarantine, mapping_data):
+    """Retraite les lignes en quarantaine d'un fichier Excel (voir quarantine.replay) ;
+    les lignes encore rejetées y retournent"""
+    stats = _file_stats()
+    df = records_frame(entries)
+    stats['total'] = len(df)
+    pending_rows, index = transform_chunk(conn, df, mapping_data, stats, quarantine, excel_file)
+    write_chunk(cur, df, pending_rows, index, stats, f"{os.path.basename(excel_file)} (rejeu)",
+                quarantine, excel_file)
+    invalidate_resolvers('point_de_distribution')
+    return stats
+
+def load_mapping_data(directory):
+    """Fichier de mapping ref_borne -> tronçon du dossier : (mapping, nom du fichier ou None)"""
+    header_cache = HeaderCache(os.path.join(directory, HEADER_CACHE_FILE))
+    mapping_file = find_mapping_file(directory, header_cache)
+    header_cache.save()
+    logging.info(f"En-têtes Excel: {header_cache.stats['hits']} lu(s) depuis le cache, "
+                 f"{header_cache.stats['reads']} fichier(s) ouvert(s)")
+    if not mapping_file:
+        logging.warning("Aucun fichier de mapping trouvé dans le répertoire")
+        return {}, None
+    return load_excel_mapping(mapping_file), os.path.basename(mapping_file)
+
+def import_excel_files(conn=None, force=False, resume=False, replay_rejects=False, restart=False):
+    """Importe tous les fichiers Excel du dossier
+
+    Mode incrémental (défaut) : seuls les fichiers nouveaux ou modifiés depuis leur dernier
+    chargement sont traités (voir manifest.py) ; force retraite tous les fichiers.
+    resume : les fichiers interrompus repartent après leur dernier lot validé.
+    restart : les fichiers interrompus sont rechargés depuis le début (lots validés dupliqués).
+    replay_rejects : seules les lignes en quarantaine sont retraitées (voir quarantine.py).
+    """
     global_stats = {
         'total_files': 0,
         'total_rows': 0,
         'total_inserted': 0,
         'total_skipped': 0,
         'total_errors': 0,
+        'total_rejected': 0,
         'total_quartier_not_found': 0,
         'total_noeud_cons_found': 0,
         'total_noeud_cons_not_found': 0
     }
+    quarantine = None
     
-    conn = None
+    own_conn = conn is None  # connexion fournie par le pipeline ou ouverte ici
     try:
-        conn = connect_db(DB_CONFIG)
+        if own_conn:
+            conn = connect_db(DB_CONFIG_TARGET, "Cible HARMONISE")
         
-        mapping_file = find_mapping_file(DOSSIER_EXCEL)
-        if not mapping_file:
-            logging.warning("Aucun fichier de mapping trouvé dans le répertoire")
-            mapping_data = {}
-        else:
-            mapping_data = load_excel_mapping(mapping_file)
+        mapping_data, mapping_name = load_mapping_data(DOSSIER_EXCEL)
+
+        if replay_rejects:
+            stats = replay(conn, 'point_de_distribution',
+                           lambda cur, excel_file, entries, quarantine:
+                               replay_file(conn, cur, excel_file, entries, quarantine, mapping_data))
+            log_resolver_stats('quartier', 'noeud_consommation')
+            return stats
+        quarantine = Quarantine(conn, 'point_de_distribution')
         
-        for filename in os.listdir(DOSSIER_EXCEL):
-            if not filename.lower().endswith(('.xlsx', '.xls')) or filename == os.path.basename(mapping_file):
-                continue
-                
-            filepath = os.path.join(DOSSIER_EXCEL, filename)
+        file_paths = [os.path.join(DOSSIER_EXCEL, filename) for filename in sorted(os.listdir(DOSSIER_EXCEL))
+                      if filename.lower().endswith(('.xlsx', '.xls')) and filename != mapping_name]
+
+        # Fichiers déjà chargés et inchangés écartés
+        manifest = IngestionManifest(conn, 'point_de_distribution', force=force)
+        file_paths = manifest.select(file_paths)
+
+        for filepath in file_paths:
+            filename = os.path.basename(filepath)
             global_stats['total_files'] += 1
             logging.info(f"\nDébut du traitement du fichier: {filename}")
             
+            started = time.perf_counter()
             try:
-                stats = process_excel_file(filepath, conn, mapping_data)
+                stats = process_excel_file(filepath, conn, mapping_data, manifest=manifest, resume=resume,
+                                           quarantine=quarantine, restart=restart)
                 global_stats['total_rows'] += stats['total']
                 global_stats['total_inserted'] += stats['inserted']
                 global_stats['total_skipped'] += stats['skipped']
                 global_stats['total_errors'] += stats['errors']
+                global_stats['total_rejected'] += stats['rejected']
                 global_stats['total_quartier_not_found'] += stats['quartier_not_found']
                 global_stats['total_noeud_cons_found'] += stats['noeud_cons_found']
                 global_stats['total_noeud_cons_not_found'] += stats['noeud_cons_not_found']
+                record_file(filepath, read=stats['total'], written=stats['inserted'],
+                            rejected=stats['skipped'] + stats['rejected'] + stats['errors'],
+                            seconds=time.perf_counter() - started, input_dir=DOSSIER_EXCEL)
                 
             except Exception as e:
                 global_stats['total_errors'] += 1
                 logging.error(f"Échec du traitement du fichier {filename}: {str(e)}")
                 continue
 
+        global_stats['total_quarantined'] = sum(quarantine.stats.values())
+        quarantine.log_summary()
         logging.info(f"\nImport global terminé. Statistiques globales: {global_stats}")
+        log_resolver_stats('quartier', 'noeud_consommation')
+        return global_stats
 
     except Exception as e:
         if conn: conn.rollback()
         logging.error(f"ERREUR GLOBALE: {str(e)}", exc_info=True)
         raise
     finally:
-        if conn: conn.close()
-        logging.info("Connexion à la base de données fermée")
+        if conn and own_conn: close_db(conn, "Cible HARMONISE")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import des points de distribution depuis les fichiers Excel")
+    parser.add_argument("--force", action="store_true",
+                        help="retraite tous les fichiers, y compris ceux déjà chargés et inchangés")
+    parser.add_argument("--resume", action="store_true",
+                        help="reprend les fichiers interrompus après leur dernier lot validé")
+    parser.add_argument("--restart", action="store_true",
+                        help="recharge depuis le début les fichiers interrompus (les lots déjà validés "
+                             "sont insérés une seconde fois)")
+    parser.add_argument("--replay-rejects", action="store_true",
+                        help="retraite uniquement les lignes en quarantaine (après correction des références)")
+    parser.add_argument("--fuzzy", action="store_true",
+                        help="rapproche les noms inconnus par similarité de trigrammes (chaque rapprochement est journalisé)")
+    args = parser.parse_args()
+    set_fuzzy_matching(args.fuzzy)
+
     logging.info(f"Début de l'import depuis le dossier: {DOSSIER_EXCEL}")
     
     try:
-        import_excel_files()
+        import_excel_files(force=args.force, resume=args.resume, replay_rejects=args.replay_rejects,
+                           restart=args.restart)
         logging.info("Import terminé avec succès")
     except Exception as e:
         logging.critical(f"Échec de l'import: {str(e)}")
@@ -0,0 +1,67 @@
+# --- ÉCRITURE PAR LOTS AVEC ISOLEMENT DES LIGNES EN ERREUR ---
+# Un lot est écrit en une fois (COPY, INSERT ... SELECT) sous un SAVEPOINT. Si le serveur
+# refuse le lot (contrainte, valeur invalide, géométrie illisible), seul le lot est annulé
+# (ROLLBACK TO SAVEPOINT) : il est coupé en deux et chaque moitié est réécrite, jusqu'à
+# isoler les lignes fautives une à une. Les lignes valides sont écrites, les lignes
+# refusées sont retournées avec le message d'erreur ; la transaction reste utilisable.
+# Pour k lignes fautives dans un lot de n lignes : environ 2·k·log2(n) écritures de plus.
+
+import logging
+import psycopg2
+
+# Erreurs imputables aux données d'une ligne (les autres erreurs interrompent l'écriture)
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.InternalError)
+REJECT_SAMPLE_SIZE = 20
+
+
+def _error_message(error):
+    """Première ligne du message PostgreSQL"""
+    message = getattr(error, 'pgerror', None) or str(error)
+    return message.strip().splitlines()[0] if message.strip() else type(error).__name__
+
+def write_isolated(cur, write, rows, label=None):
+    """Écrit rows par write(cur, lignes) sous SAVEPOINT, en isolant les lignes refusées.
+
+    Retourne (results, rejected) :
+      - results : [(lignes écrites, résultat de write)] dans l'ordre de rows ;
+      - rejected : [(position dans rows, ligne, message d'erreur)].
+    """
+    rows = list(rows)
+    results, rejected = [], []
+    # Pile de tranches (début, fin) à écrire, traitées dans l'ordre des lignes
+    pending = [(0, len(rows))] if rows else []
+    while pending:
+        start, end = pending.pop()
+        part = rows[start:end]
+        cur.execute("SAVEPOINT lot_isole")
+        try:
+            result = write(cur, part)
+        except ROW_ERRORS as e:
+            cur.execute("ROLLBACK TO SAVEPOINT lot_isole")
+            cur.execute("RELEASE SAVEPOINT lot_isole")
+            if end - start == 1:
+                rejected.append((start, part[0], _error_message(e)))
+            else:
+                middle = (start + end) // 2
+                pending.extend([(middle, end), (start, middle)])
+            continue
+        cur.execute("RELEASE SAVEPOINT lot_isole")
+        results.append((part, result))
+
+    if rejected:
+        sample = '; '.join(f"#{position}: {message}" for position, _, message in rejected[:REJECT_SAMPLE_SIZE])
+        more = f" (+{len(rejected) - REJECT_SAMPLE_SIZE} autres)" if len(rejected) > REJECT_SAMPLE_SIZE else ""
+        logging.warning(f"{label or 'Lot'}: {len(rejected)} ligne(s) refusée(s) sur {len(rows)}: {sample}{more}")
+    return results, rejected
+
+def total(results):
+    """Somme des résultats numériques de write_isolated (nombre de lignes écrites)"""
+    return sum(result for _, result in results)
+
+def merge_counts(results):
+    """Somme, clé par clé, des résultats {compteur: valeur} de write_isolated"""
+    counts = {}
+    for _, result in results:
+        for key, value in result.items():
+            counts[key] = counts.get(key, 0) + value
+    return counts
@@ -0,0 +1,349 @@
+# --- ÉCRITURE EN MASSE VIA COPY ... FROM STDIN ---
+# Module partagé par les scripts de migration : remplace les INSERT ligne par ligne
+# par des COPY en lots, tout en restituant les ids SERIAL dans l'ordre d'entrée.
+
+import io
+import re
+import struct
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+from psycopg2 import sql
+
+# Taille des lots envoyés en un seul COPY
+DEFAULT_CHUNK_SIZE = 10000
+
+# Format COPY par défaut ('text' ou 'binary')
+DEFAULT_FORMAT = 'text'
+
+# En-tête et fin du format COPY binaire de PostgreSQL
+_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_BINARY_TRAILER = struct.pack('!h', -1)
+
+# Bit EWKB indiquant la présence d'un SRID
+_EWKB_SRID_FLAG = 0x20000000
+
+
+#  Utilitaires
+def chunked(rows, chunk_size):
+    """Découpe un itérable en listes de chunk_size éléments au plus"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def get_column_types(cur, table):
+    """Retourne {colonne: type SQL} pour une table (format_type, ex: 'geometry(Point,29702)')"""
+    cur.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass
+          AND a.attnum > 0
+          AND NOT a.attisdropped;
+    """, (table,))
+    return dict(cur.fetchall())
+
+def reserve_ids(cur, table, id_column, count):
+    """Réserve count valeurs de la séquence SERIAL de table.id_column, en ordre croissant"""
+    if count <= 0:
+        return []
+    cur.execute("""
+        SELECT nextval(pg_get_serial_sequence(%s, %s))
+        FROM generate_series(1, %s);
+    """, (table, id_column, count))
+    return sorted(r[0] for r in cur.fetchall())
+
+def to_ewkb(value, srid=None):
+    """Convertit une géométrie (hex EWKB, WKB bytes) en EWKB bytes, en injectant le SRID si absent"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = bytes.fromhex(value)
+    value = bytes(value)
+    if srid is None or len(value) < 5:
+        return value
+    fmt = '<I' if value[0] == 1 else '>I'
+    geom_type = struct.unpack(fmt, value[1:5])[0]
+    if geom_type & _EWKB_SRID_FLAG:
+        return value
+    return (value[:1]
+            + struct.pack(fmt, geom_type | _EWKB_SRID_FLAG)
+            + struct.pack(fmt[0] + 'i', srid)
+            + value[5:])
+
+
+#  Encodage format texte
+def _text_escape(value):
+    """Sérialise une valeur Python pour le format COPY texte"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # Géométrie WKB/EWKB : PostGIS accepte la forme hexadécimale en entrée texte
+        return bytes(value).hex()
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    text = str(value)
+    return (text.replace('\\', '\\\\')
+                .replace('\t', '\\t')
+                .replace('\n', '\\n')
+                .replace('\r', '\\r'))
+
+def _encode_text(rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_text_escape(v) for v in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+#  Encodage format binaire
+def _encode_numeric(value):
+    """Encode une valeur en NUMERIC binaire (chiffres en base 10000)"""
+    d = value if isinstance(value, Decimal) else Decimal(str(value))
+    if d.is_nan():
+        return struct.pack('!hhHh', 0, 0, 0xC000, 0)
+    if d.is_infinite():
+        return struct.pack('!hhHh', 0, 0, 0xF000 if d < 0 else 0xD000, 0)
+
+    sign, digits, exp = d.as_tuple()
+    s = ''.join(map(str, digits))
+    dscale = max(-exp, 0)
+    if exp >= 0:
+        int_part, frac_part = s + '0' * exp, ''
+    else:
+        s = s.rjust(-exp + 1, '0')
+        int_part, frac_part = s[:exp], s[exp:]
+
+    int_part = int_part.lstrip('0')
+    int_part = '0' * ((-len(int_part)) % 4) + int_part
+    frac_part = frac_part + '0' * ((-len(frac_part)) % 4)
+    groups = [int(int_part[i:i + 4]) for i in range(0, len(int_part), 4)]
+    weight = len(groups) - 1
+    groups += [int(frac_part[i:i + 4]) for i in range(0, len(frac_part), 4)]
+
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+
+    return (struct.pack('!hhHh', len(groups), weight, 0x4000 if sign else 0, dscale)
+            + struct.pack('!%dh' % len(groups), *groups))
+
+def _encode_date(value):
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    if isinstance(value, datetime):
+        value = value.date()
+    return struct.pack('!i', (value - date(2000, 1, 1)).days)
+
+def _encode_str(value):
+    return str(value).encode('utf-8')
+
+def _binary_encoder(type_name):
+    """Retourne la fonction d'encodage binaire pour un type SQL (format_type)"""
+    if type_name in ('integer', 'serial'):
+        return lambda v: struct.pack('!i', int(v))
+    if type_name in ('bigint', 'bigserial'):
+        return lambda v: struct.pack('!q', int(v))
+    if type_name == 'smallint':
+        return lambda v: struct.pack('!h', int(v))
+    if type_name == 'double precision':
+        return lambda v: struct.pack('!d', float(v))
+    if type_name == 'real':
+        return lambda v: struct.pack('!f', float(v))
+    if type_name == 'boolean':
+        return lambda v: b'\x01' if v else b'\x00'
+    if type_name.startswith('numeric'):
+        return _encode_numeric
+    if type_name == 'date':
+        return _encode_date
+    if type_name.startswith('geometry'):
+        match = re.search(r',\s*(\d+)\)', type_name)
+        srid = int(match.group(1)) if match else None
+        return lambda v: to_ewkb(v, srid)
+    # text, character varying(n), enum : la représentation binaire est le texte UTF-8
+    return _encode_str
+
+def _encode_binary(rows, encoders):
+    buffer = io.BytesIO()
+    buffer.write(_BINARY_HEADER)
+    field_count = struct.pack('!h', len(encoders))
+    for row in rows:
+        buffer.write(field_count)
+        for encode, value in zip(encoders, row):
+            if value is None:
+                buffer.write(struct.pack('!i', -1))
+            else:
+                data = encode(value)
+                buffer.write(struct.pack('!i', len(data)))
+                buffer.write(data)
+    buffer.write(_BINARY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+#  COPY
+def _copy_chunk(cur, table, columns, chunk, fmt, encoders=None):
+    """Envoie un lot de lignes dans table via un seul COPY ... FROM STDIN"""
+    options = sql.SQL(" WITH (FORMAT binary)") if fmt == 'binary' else sql.SQL("")
+    statement = sql.SQL("COPY {} ({}) FROM STDIN{}").format(
+        sql.Identifier(table),
+        sql.SQL(', ').join(sql.Identifier(c) for c in columns),
+        options
+    )
+    buffer = _encode_binary(chunk, encoders) if fmt == 'binary' else _encode_text(chunk)
+    cur.copy_expert(statement, buffer)
+
+def _write(cur, table, columns, rows, id_column, fmt, chunk_size, expressions):
+    """Écrit rows dans table (directement ou via une table de transit) et retourne les ids réservés"""
+    if fmt not in ('text', 'binary'):
+        raise ValueError(f"Format COPY inconnu: {fmt}")
+
+    columns = list(columns)
+    copy_columns = ([id_column] if id_column else []) + columns
+    target_types = get_column_types(cur, table) if (fmt == 'binary' or expressions) else {}
+
+    copy_table = table
+    if expressions:
+        # Les colonnes calculées (ex: ST_GeomFromGeoJSON) transitent en texte par une table temporaire
+        copy_table = f"_copy_{table}"
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(copy_table)))
+        cur.execute(sql.SQL("CREATE TEMP TABLE {} ({})").format(
+            sql.Identifier(copy_table),
+            sql.SQL(', ').join(
+                sql.SQL("{} {}").format(
+                    sql.Identifier(c),
+                    sql.SQL('text' if c in expressions else target_types[c])
+                ) for c in copy_columns
+            )
+        ))
+        if fmt == 'binary':
+            target_types = {c: ('text' if c in expressions else t) for c, t in target_types.items()}
+        insert_select = sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+            sql.Identifier(table),
+            sql.SQL(', ').join(sql.Identifier(c) for c in copy_columns),
+            sql.SQL(', ').join(
+                sql.SQL(expressions[c]).format(sql.Identifier(c)) if c in expressions else sql.Identifier(c)
+                for c in copy_columns
+            ),
+            sql.Identifier(copy_table)
+        )
+
+    encoders = [_binary_encoder(target_types[c]) for c in copy_columns] if fmt == 'binary' else None
+
+    ids = []
+    written = 0
+    for chunk in chunked(rows, chunk_size):
+        if id_column:
+            chunk_ids = reserve_ids(cur, table, id_column, len(chunk))
+            chunk = [(new_id,) + tuple(row) for new_id, row in zip(chunk_ids, chunk)]
+            ids.extend(chunk_ids)
+        _copy_chunk(cur, copy_table, copy_columns, chunk, fmt, encoders)
+        if expressions:
+            cur.execute(insert_select)
+            cur.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(copy_table)))
+        written += len(chunk)
+        logging.debug(f"COPY {table}: {written} lignes écrites")
+
+    if expressions:
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(copy_table)))
+    return ids if id_column else written
+
+def copy_rows(cur, table, columns, rows, fmt=DEFAULT_FORMAT, chunk_size=DEFAULT_CHUNK_SIZE,
+              expressions=None):
+    """Écrit rows (itérable de tuples alignés sur columns) dans table par COPY en lots.
+
+    expressions: {colonne: gabarit SQL} appliqué côté serveur, ex:
+        {'geom': "ST_SetSRID(ST_GeomFromGeoJSON({}), 29702)"}
+    Retourne le nombre de lignes écrites.
+    """
+    return _write(cur, table, columns, rows, None, fmt, chunk_size, expressions)
+
+def copy_rows_returning(cur, table, id_column, columns, rows, fmt=DEFAULT_FORMAT,
+                        chunk_size=DEFAULT_CHUNK_SIZE, expressions=None):
+    """Comme copy_rows, mais réserve les ids SERIAL de id_column et les retourne dans l'ordre d'entrée"""
+    return _write(cur, table, columns, rows, id_column, fmt, chunk_size, expressions)
+
+
+#  Écriture idempotente (INSERT ... ON CONFLICT)
+def upsert_rows(cur, table, columns, rows, conflict_columns, on_conflict='nothing',
+                fmt=DEFAULT_FORMAT, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Écrit rows par lots : COPY dans une table temporaire puis un seul
+    INSERT ... SELECT ... ON CONFLICT par lot.
+
+    on_conflict: 'nothing' (lignes déjà présentes ignorées) ou 'update' (colonnes hors
+    clé mises à jour si elles diffèrent). Les compteurs sont lus dans le résultat de
+    l'instruction : {'inserted': n, 'updated': n, 'skipped': n}.
+    """
+    if on_conflict not in ('nothing', 'update'):
+        raise ValueError(f"Mode ON CONFLICT inconnu: {on_conflict}")
+
+    columns = list(columns)
+    key_positions = [columns.index(c) for c in conflict_columns]
+    update_columns = [c for c in columns if c not in conflict_columns]
+    staging = f"_upsert_{table}"
+
+    target_types = get_column_types(cur, table)
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} ({})").format(
+        sql.Identifier(staging),
+        sql.SQL(', ').join(
+            sql.SQL("{} {}").format(sql.Identifier(c), sql.SQL(target_types[c])) for c in columns
+        )
+    ))
+    encoders = [_binary_encoder(target_types[c]) for c in columns] if fmt == 'binary' else None
+
+    if on_conflict == 'nothing':
+        action = sql.SQL("DO NOTHING")
+    else:
+        action = sql.SQL("DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})").format(
+            sql.SQL(', ').join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c)) for c in update_columns
+            ),
+            sql.SQL(', ').join(sql.SQL("t.{}").format(sql.Identifier(c)) for c in update_columns),
+            sql.SQL(', ').join(sql.SQL("EXCLUDED.{}").format(sql.Identifier(c)) for c in update_columns)
+        )
+    # xmax = 0 distingue une ligne insérée d'une ligne mise à jour
+    statement = sql.SQL("""
+        WITH written AS (
+            INSERT INTO {table} AS t ({columns})
+            SELECT {columns} FROM {staging}
+            ON CONFLICT ({keys}) {action}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM written
+    """).format(
+        table=sql.Identifier(table),
+        columns=sql.SQL(', ').join(sql.Identifier(c) for c in columns),
+        staging=sql.Identifier(staging),
+        keys=sql.SQL(', ').join(sql.Identifier(c) for c in conflict_columns),
+        action=action
+    )
+
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    for chunk in chunked(rows, chunk_size):
+        if on_conflict == 'update':
+            # Une même clé ne peut être mise à jour deux fois par instruction : la dernière l'emporte
+            unique_rows = {tuple(row[i] for i in key_positions): row for row in chunk}
+            counts['skipped'] += len(chunk) - len(unique_rows)
+            chunk = list(unique_rows.values())
+        _copy_chunk(cur, staging, columns, chunk, fmt, encoders)
+        cur.execute(statement)
+        inserted, updated = cur.fetchone()
+        counts['inserted'] += inserted
+        counts['updated'] += updated
+        counts['skipped'] += len(chunk) - inserted - updated
+        cur.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(staging)))
+
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+    return counts
@@ -0,0 +1,117 @@
+# --- POINTS DE REPRISE DES CHARGEMENTS DE FICHIERS ---
+# Les chargeurs de fichiers volumineux (9 Excel, 10, 11 et 12 CSV) écrivent chaque fichier
+# par lots, une transaction par lot. Après chaque lot, la table ingestion_checkpoint reçoit,
+# dans la même transaction que les données : le numéro du lot, le nombre de lignes du
+# fichier consommées et l'empreinte du lot. Un fichier entièrement chargé perd son point de
+# reprise (et entre dans le manifeste, voir manifest.py).
+# En mode reprise (--resume), un fichier interrompu repart après son dernier lot validé,
+# à condition que son contenu n'ait pas changé depuis ; sinon il est repris depuis le début.
+# L'empreinte du fichier n'est calculée qu'au besoin (comparaison en reprise, premier lot
+# enregistré), une seule fois, et partagée avec le manifeste quand il est fourni.
+# Une table sans clé naturelle (point_de_distribution) ne peut pas être rechargée ainsi : les
+# lots déjà validés seraient insérés une seconde fois. Ses fichiers interrompus sont refusés
+# (restartable=False) tant que la reprise n'est pas possible ou qu'un redémarrage explicite
+# (restart=True) n'est pas demandé.
+
+import os
+import logging
+import hashlib
+from manifest import file_hash
+
+DEFAULT_BATCH_ROWS = 5000
+
+
+def batch_hash(rows):
+    """Empreinte SHA-256 d'un lot de lignes source"""
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update('\x1f'.join('' if v is None else str(v) for v in row).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def batches(rows, batch_rows=DEFAULT_BATCH_ROWS):
+    """(numéro de lot, position de début, lignes) d'une liste découpée en lots"""
+    for index, start in enumerate(range(0, len(rows), batch_rows)):
+        yield index, start, rows[start:start + batch_rows]
+
+
+class FileCheckpoint:
+    """Point de reprise d'un fichier pour une étape.
+
+    next_batch / next_row : premier lot et première ligne à traiter (0 sans reprise).
+    restartable=False : un fichier interrompu qui ne peut pas être repris lève RuntimeError,
+    sauf si restart=True (point de reprise abandonné, le fichier repart du début).
+    manifest : IngestionManifest de l'étape, dont l'empreinte du fichier est réutilisée.
+    Sans la table ingestion_checkpoint, le fichier est traité du début et rien n'est
+    enregistré.
+    """
+
+    def __init__(self, conn, stage, file_path, resume=False, restartable=True, restart=False, manifest=None):
+        self.stage = stage
+        self.path = os.path.abspath(file_path)
+        self.available = False
+        self.manifest = manifest
+        self._content_hash = None
+        self.next_batch = 0
+        self.next_row = 0
+        self._load(conn, resume, restartable or restart)
+
+    @property
+    def content_hash(self):
+        """Empreinte du fichier (celle du manifeste s'il est fourni), calculée au premier usage"""
+        if self._content_hash is None:
+            self._content_hash = (self.manifest.content_hash(self.path) if self.manifest
+                                  else file_hash(self.path))
+        return self._content_hash
+
+    def _load(self, conn, resume, restartable):
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('ingestion_checkpoint') IS NOT NULL;")
+            self.available = cur.fetchone()[0]
+            if not self.available:
+                return
+            cur.execute("""
+                SELECT batch_index, row_offset, batch_hash, content_hash FROM ingestion_checkpoint
+                WHERE stage = %s AND path = %s;
+            """, (self.stage, self.path))
+            saved = cur.fetchone()
+        if saved is None:
+            return
+        batch_index, row_offset, saved_batch_hash, content_hash = saved
+        unchanged = resume and content_hash == self.content_hash
+        if not restartable and not unchanged:
+            raise RuntimeError(f"Fichier {self.path}: chargement précédent interrompu au lot {batch_index} ; "
+                               f"le reprendre depuis le début insérerait une seconde fois les lots validés "
+                               f"(--resume si le fichier est inchangé, --restart pour le recharger quand même)")
+        if not resume:
+            logging.warning(f"Fichier {self.path}: chargement précédent interrompu au lot {batch_index}, "
+                            f"repris depuis le début (--resume pour repartir du dernier lot validé)")
+        elif not unchanged:
+            logging.warning(f"Fichier {self.path} modifié depuis l'interruption : repris depuis le début")
+        else:
+            self.next_batch, self.next_row = batch_index + 1, row_offset
+            logging.info(f"Fichier {self.path}: reprise après le lot {batch_index} "
+                         f"(ligne {row_offset}, empreinte {saved_batch_hash[:12]})")
+
+    def skip(self, batch_index):
+        """Lot déjà validé lors d'une exécution précédente"""
+        return batch_index < self.next_batch
+
+    def save(self, cur, batch_index, row_offset, rows):
+        """Enregistre le lot dans la transaction de ses données (à valider par l'appelant)"""
+        if not self.available:
+            return
+        cur.execute("""
+            INSERT INTO ingestion_checkpoint (stage, path, batch_index, row_offset, batch_hash, content_hash)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (stage, path) DO UPDATE SET
+                batch_index = EXCLUDED.batch_index, row_offset = EXCLUDED.row_offset,
+                batch_hash = EXCLUDED.batch_hash, content_hash = EXCLUDED.content_hash,
+                updated_at = now();
+        """, (self.stage, self.path, batch_index, row_offset, batch_hash(rows), self.content_hash))
+
+    def clear(self, cur):
+        """Fichier entièrement chargé : le point de reprise est supprimé"""
+        if self.available:
+            cur.execute("DELETE FROM ingestion_checkpoint WHERE stage = %s AND path = %s;",
+                        (self.stage, self.path))
@@ -0,0 +1,126 @@
+# --- CONNEXIONS PARTAGÉES ---
+# Configuration des bases (cible et sources), ouverture/fermeture des connexions et
+# pools psycopg2 réutilisés par le pipeline (pipeline.py) entre les étapes.
+# Les lectures des bases sources passent par stream_query (curseur serveur nommé).
+# Les curseurs comptent leurs allers-retours avec le serveur (voir metrics.py).
+
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.pool
+import psycopg2.extras
+from metrics import CountingCursor, count_round_trips
+
+# Base de données CIBLE
+DB_CONFIG_TARGET = {
+    "database": "AEP_HARMONISE",
+    "user": "postgres",
+    "password": "*******",
+    "host": "localhost",
+    "port": "5432"
+}
+
+# Bases de données SOURCES
+DB_CONFIG_SOURCE_EAURIZON = {
+    "database": "AEP_EAURIZON",
+    "user": "postgres",
+    "password": "*******",
+    "host": "localhost",
+    "port": "5432"
+}
+
+DB_CONFIG_SOURCE_JIRAMA = {
+    "database": "AEP_JIRAMA",
+    "user": "postgres",
+    "password": "*******",
+    "host": "localhost",
+    "port": "5432"
+}
+
+# Nombre maximal de connexions par pool
+POOL_MAX_CONNECTIONS = 8
+
+# Nombre de lignes rapatriées par aller-retour lors des lectures en flux
+SOURCE_ITERSIZE = 2000
+
+_pools = {}
+_cursor_ids = itertools.count(1)
+_pools_lock = threading.Lock()
+
+
+#  Connexions simples (scripts lancés seuls)
+def connect_db(config, name=None):
+    """Établit une connexion à une base de données (autocommit désactivé)."""
+    name = name or config['database']
+    try:
+        conn = psycopg2.connect(**config, cursor_factory=CountingCursor)
+        conn.autocommit = False
+        logging.info(f"Connecté à la base de données '{name}' ({config['database']})")
+        return conn
+    except psycopg2.Error as e:
+        logging.error(f"Erreur de connexion à '{name}': {e}")
+        raise
+
+def close_db(conn, name=None, cursor=None):
+    """Ferme le curseur et la connexion."""
+    if cursor:
+        cursor.close()
+    if conn:
+        try:
+            conn.close()
+            logging.info(f"Connexion à '{name or conn.info.dbname}' fermée.")
+        except psycopg2.Error as e:
+            logging.error(f"Erreur fermeture {name}: {e}")
+
+
+#  Lecture en flux des sources
+def stream_query(conn, query, params=None, itersize=SOURCE_ITERSIZE, name=None):
+    """Itère sur le résultat d'une requête via un curseur serveur nommé.
+
+    Les lignes (namedtuple, accès row.colonne) sont rapatriées par lots de itersize :
+    la mémoire reste constante quelle que soit la taille de la table source et le
+    traitement commence dès le premier lot. Le curseur vit dans la transaction
+    courante de conn et est fermé à la fin de l'itération.
+    """
+    name = name or f"flux_{next(_cursor_ids)}"
+    with conn.cursor(name=name, cursor_factory=psycopg2.extras.NamedTupleCursor) as cur:
+        cur.itersize = itersize
+        cur.execute(query, params)
+        count_round_trips()
+        for position, row in enumerate(cur):
+            if position % itersize == 0:
+                count_round_trips()  # lot suivant rapatrié du serveur
+            yield row
+
+
+#  Pools (pipeline)
+def get_pool(config, maxconn=POOL_MAX_CONNECTIONS):
+    """Retourne le pool de connexions de la base décrite par config (créé au premier appel)"""
+    key = (config['host'], config['port'], config['database'], config['user'])
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = psycopg2.pool.ThreadedConnectionPool(1, maxconn, cursor_factory=CountingCursor, **config)
+            logging.info(f"Pool de connexions ouvert sur '{config['database']}' (max {maxconn})")
+        return _pools[key]
+
+@contextmanager
+def pooled_connection(config):
+    """Emprunte une connexion au pool ; rollback si la transaction n'a pas été validée"""
+    pool = get_pool(config)
+    conn = pool.getconn()
+    conn.autocommit = False
+    try:
+        yield conn
+    finally:
+        if not conn.closed:
+            conn.rollback()
+        pool.putconn(conn)
+
+def close_pools():
+    """Ferme toutes les connexions de tous les pools"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
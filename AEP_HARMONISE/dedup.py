@@ -0,0 +1,50 @@
+# --- DÉDOUBLONNAGE DES RELEVÉS PAR EMPREINTE ---
+# Un même export de compteurs se retrouve souvent dans plusieurs fichiers CSV. Chaque relevé
+# est réduit à une empreinte de 8 octets de (ref_borne, date, quantite) ; les empreintes vues
+# pendant l'exécution écartent les doublons entre fichiers, sans requête en base.
+# Rien n'est conservé d'une exécution à l'autre : les relevés déjà chargés sont écartés par
+# la clé unique (id_point_dist, date) de eau_distribue (INSERT ... ON CONFLICT), qui reste
+# exacte après une réinitialisation, un remplacement de partition ou une suppression en cascade.
+
+import hashlib
+
+KEY_BYTES = 8
+
+
+def row_key(ref_borne, date, quantite):
+    """Empreinte 64 bits d'un relevé (ref_borne normalisé, date ISO, quantité)"""
+    ref = ' '.join(str(ref_borne).upper().split()) if ref_borne else ''
+    day = date.isoformat() if date else ''
+    quantity = repr(float(quantite)) if quantite is not None else ''
+    digest = hashlib.blake2b(f"{ref}|{day}|{quantity}".encode('utf-8'), digest_size=KEY_BYTES).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class KeyStore:
+    """Empreintes des relevés de l'exécution courante.
+
+    Les empreintes d'un fichier sont d'abord en attente, puis validées (commit) quand le
+    fichier a été écrit en base, ou abandonnées (discard) en cas d'échec. Plusieurs fichiers
+    peuvent être en attente en même temps (ingestion parallèle) : commit et discard
+    acceptent alors les empreintes du fichier concerné.
+    """
+
+    def __init__(self):
+        self.current = set()        # validées pendant l'exécution
+        self.pending = set()        # fichier en cours
+
+    def seen_in_run(self, key):
+        """Relevé déjà rencontré pendant cette exécution (fichier courant compris)"""
+        return key in self.current or key in self.pending
+
+    def add(self, key):
+        self.pending.add(key)
+
+    def commit(self, keys=None):
+        keys = self.pending if keys is None else set(keys)
+        self.current |= keys
+        self.pending -= keys
+
+    def discard(self, keys=None):
+        keys = self.pending if keys is None else set(keys)
+        self.pending -= keys
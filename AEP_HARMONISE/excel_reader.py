@@ -0,0 +1,121 @@
+# --- LECTURE DES CLASSEURS EXCEL ---
+# Accès aux fichiers .xlsx de 9_point_de_distribution_particulier.py :
+#   - l'en-tête (première ligne) est lu seul, en mode lecture seule d'openpyxl, pour
+#     reconnaître le rôle d'un fichier sans charger le classeur ;
+#   - les en-têtes sont gardés en cache sur disque par chemin, date de modification et
+#     taille : un fichier inchangé n'est pas rouvert lors des exécutions suivantes ;
+#   - les lignes de données sont lues en flux, par lots de DataFrame.
+# Les anciens fichiers .xls (non lus par openpyxl) passent par pandas.read_excel.
+
+import os
+import json
+import logging
+import pandas as pd
+
+DEFAULT_CHUNK_SIZE = 5000
+HEADER_CACHE_FILE = ".excel_entetes.json"
+
+
+def _import_openpyxl():
+    try:
+        import openpyxl
+    except ImportError as e:
+        raise ImportError("La lecture des fichiers .xlsx nécessite openpyxl (pip install openpyxl)") from e
+    return openpyxl
+
+def _is_xls(file_path):
+    return file_path.lower().endswith('.xls')
+
+def _column_names(values):
+    """Noms de colonnes de la première ligne (cellule vide -> 'Unnamed: i', comme pandas)"""
+    return [str(v) if v is not None else f"Unnamed: {i}" for i, v in enumerate(values)]
+
+
+#  En-têtes
+def read_header(file_path):
+    """Noms de colonnes de la première feuille, en ne lisant que la première ligne"""
+    if _is_xls(file_path):
+        return [str(c) for c in pd.read_excel(file_path, nrows=0).columns]
+    openpyxl = _import_openpyxl()
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        first_row = next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), ())
+        return _column_names(first_row)
+    finally:
+        wb.close()
+
+
+class HeaderCache:
+    """En-têtes des classeurs, mémorisés sur disque par (chemin, mtime, taille)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.stats = {'hits': 0, 'reads': 0}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Cache des en-têtes Excel illisible ({path}), ignoré: {e}")
+
+    def header(self, file_path):
+        """En-tête du fichier, relu seulement s'il a changé depuis la dernière lecture"""
+        key = os.path.abspath(file_path)
+        st = os.stat(file_path)
+        signature = [st.st_mtime_ns, st.st_size]
+        entry = self.entries.get(key)
+        if entry and entry['signature'] == signature:
+            self.stats['hits'] += 1
+            return entry['header']
+        header = read_header(file_path)
+        self.entries[key] = {'signature': signature, 'header': header}
+        self.dirty = True
+        self.stats['reads'] += 1
+        return header
+
+    def save(self):
+        """Enregistre le cache (écriture atomique), s'il a changé"""
+        if not self.dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+#  Lignes de données
+def iter_chunks(file_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """DataFrame successifs d'au plus chunk_size lignes de la première feuille.
+
+    L'index de chaque ligne est son numéro de ligne Excel moins 2 (comme un DataFrame
+    lu par pandas.read_excel), pour les messages d'erreur ; les lignes vides sont omises.
+    """
+    if _is_xls(file_path):
+        df = pd.read_excel(file_path)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+        return
+
+    openpyxl = _import_openpyxl()
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        columns = _column_names(next(rows, ()))
+        width = len(columns)
+        records, index = [], []
+        for position, values in enumerate(rows):
+            if all(v is None for v in values):
+                continue
+            values = tuple(values[:width]) + (None,) * (width - len(values))
+            records.append(values)
+            index.append(position)
+            if len(records) >= chunk_size:
+                yield pd.DataFrame.from_records(records, columns=columns, index=index)
+                records, index = [], []
+        if records:
+            yield pd.DataFrame.from_records(records, columns=columns, index=index)
+    finally:
+        wb.close()
@@ -0,0 +1,173 @@
+# --- LECTURE EN FLUX DES FICHIERS GEOJSON ---
+# Les FeatureCollection (quartiers, noeuds de consommation) sont lues par morceaux : chaque
+# feature est extraite du flux dès qu'elle est complète, sans charger tout le fichier.
+# Seules les propriétés sont décodées ; la géométrie est transmise telle quelle (texte
+# GeoJSON brut) à ST_GeomFromGeoJSON côté serveur, sans aller-retour json.loads/json.dumps.
+
+import re
+import json
+import logging
+
+DEFAULT_READ_SIZE = 1 << 16
+
+# Prochain caractère significatif hors chaîne / dans une chaîne
+_STRUCTURE = re.compile(r'[{}\[\]":,]')
+_STRING_END = re.compile(r'["\\]')
+
+
+class GeoJSONStreamError(ValueError):
+    pass
+
+
+def _skip_string(buf, pos):
+    """Position suivant la fin de la chaîne commencée en buf[pos-1], ou None si incomplète"""
+    while True:
+        match = _STRING_END.search(buf, pos)
+        if match is None:
+            return None
+        if match.group() == '\\':
+            pos = match.end() + 1
+            if pos > len(buf):
+                return None
+            continue
+        return match.end()
+
+
+def _object_members(text):
+    """{clé: texte JSON brut de la valeur} des membres de premier niveau d'un objet JSON"""
+    members = {}
+    depth = 0
+    pos = 0
+    key = None
+    last_string = None
+    value_start = None
+    while True:
+        match = _STRUCTURE.search(text, pos)
+        if match is None:
+            raise GeoJSONStreamError("Objet JSON incomplet")
+        char, pos = match.group(), match.end()
+        if char == '"':
+            end = _skip_string(text, pos)
+            if end is None:
+                raise GeoJSONStreamError("Chaîne JSON non terminée")
+            if depth == 1 and value_start is None:
+                last_string = json.loads(text[pos - 1:end])
+            pos = end
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                if key is not None:
+                    members[key] = text[value_start:match.start()].strip()
+                return members
+        elif char == ':' and depth == 1:
+            key, value_start = last_string, pos
+        elif char == ',' and depth == 1:
+            members[key] = text[value_start:match.start()].strip()
+            key, value_start = None, None
+
+
+def _raw_features(f, read_size):
+    """Texte brut de chaque feature du tableau 'features' (type du document vérifié en fin de lecture)"""
+    buf = ''
+    pos = 0
+    depth = 0
+    last_string = None
+    key = None
+    in_features = False
+    feature_start = None
+    doc_type = {}
+    eof = False
+
+    while True:
+        match = _STRUCTURE.search(buf, pos)
+        if match is None or (match.group() == '"' and _skip_string(buf, match.end()) is None):
+            if eof:
+                break
+            # Conserver uniquement la partie utile du tampon (feature en cours)
+            keep = feature_start if feature_start is not None else (match.start() if match else len(buf))
+            buf, pos = buf[keep:], (match.start() - keep if match else len(buf) - keep)
+            if feature_start is not None:
+                feature_start = 0
+            chunk = f.read(read_size)
+            if not chunk:
+                eof = True
+            buf += chunk
+            continue
+
+        char, pos = match.group(), match.end()
+        if char == '"':
+            end = _skip_string(buf, pos)
+            if depth == 1 and feature_start is None:
+                last_string = json.loads(buf[pos - 1:end])
+                if key == 'type':
+                    doc_type['type'] = last_string
+            pos = end
+        elif char in '{[':
+            depth += 1
+            if depth == 2 and char == '[' and key == 'features':
+                in_features = True
+            elif depth == 3 and in_features and char == '{':
+                feature_start = match.start()
+        elif char in '}]':
+            depth -= 1
+            if depth == 2 and in_features and char == '}' and feature_start is not None:
+                yield buf[feature_start:pos]
+                feature_start = None
+            elif depth == 1 and in_features:
+                in_features = False
+        elif char == ':' and depth == 1:
+            key = last_string
+        elif char == ',' and depth == 1:
+            key = None
+
+    if depth != 0:
+        raise GeoJSONStreamError("Fichier GeoJSON tronqué")
+    if doc_type.get('type') != 'FeatureCollection':
+        raise GeoJSONStreamError("Le fichier GeoJSON doit être de type FeatureCollection")
+
+
+def iter_features(file_path, read_size=DEFAULT_READ_SIZE):
+    """Itère sur les features d'une FeatureCollection, une à la fois.
+
+    Chaque feature est un dict {'type', 'id', 'properties', 'geometry'} où properties est
+    décodé et geometry est le texte GeoJSON brut de la géométrie (None si absente ou null).
+    """
+    count = 0
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for raw in _raw_features(f, read_size):
+            members = _object_members(raw)
+            geometry = members.get('geometry')
+            count += 1
+            yield {
+                'type': json.loads(members['type']) if 'type' in members else None,
+                'id': json.loads(members['id']) if 'id' in members else None,
+                'properties': json.loads(members['properties']) if members.get('properties') else {},
+                'geometry': geometry if geometry and geometry != 'null' else None,
+            }
+    logging.info(f"Fichier GeoJSON lu en flux: {count} features dans {file_path}")
+
+
+def geometry_member(raw_geometry, member):
+    """Membre décodé d'une géométrie brute (ex: 'type'), sans décoder les autres membres"""
+    if not raw_geometry:
+        return None
+    members = _object_members(raw_geometry)
+    return json.loads(members[member]) if member in members else None
+
+def geometry_type(raw_geometry):
+    """Type d'une géométrie brute (ex: 'Point'), sans décoder les coordonnées"""
+    return geometry_member(raw_geometry, 'type')
+
+
+def batched(iterable, size):
+    """Regroupe un itérable en listes de size éléments au plus"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
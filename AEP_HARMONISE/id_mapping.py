@@ -0,0 +1,81 @@
+# --- CORRESPONDANCE DES IDENTIFIANTS SOURCE -> CIBLE ---
+# Chaque migration enregistre, dans la même transaction que ses insertions, la
+# correspondance (système source, table source, clé source) -> id cible de chaque ligne
+# insérée dans la table id_mapping :
+#   - AEP_EAURIZON.commune (gid), AEP_JIRAMA.captage (gid), AEP_JIRAMA.stationTraitement (id),
+#     AEP_JIRAMA.Reservoir (id_reservoir) ;
+#   - GEOJSON.quartier (code_quartier), GEOJSON.noeud_consommation (id de la feature).
+# Les étapes suivantes et la synchronisation incrémentale (sync.py) retrouvent les ids
+# cibles par une seule jointure sur cette table, au lieu d'une recherche par libellé.
+
+import logging
+from bulk_copy import copy_rows
+
+MAPPING_COLUMNS = ('source_system', 'source_table', 'source_key', 'target_table', 'target_id')
+
+
+def mapping_available(cur):
+    """Table id_mapping présente (schéma migré)"""
+    cur.execute("SELECT to_regclass('id_mapping') IS NOT NULL;")
+    return cur.fetchone()[0]
+
+def record_mappings(cur, source_system, source_table, target_table, pairs):
+    """Enregistre en masse les correspondances [(clé source, id cible)] (dans la transaction
+    de l'appelant) ; une clé déjà connue pointe ensuite vers le nouvel id"""
+    rows = [(source_system, source_table, str(key), target_table, target_id)
+            for key, target_id in pairs if key is not None]
+    if not rows or not mapping_available(cur):
+        return 0
+    cur.execute("DROP TABLE IF EXISTS _id_mapping")
+    cur.execute("CREATE TEMP TABLE _id_mapping AS SELECT {} FROM id_mapping WITH NO DATA".format(', '.join(MAPPING_COLUMNS)))
+    copy_rows(cur, '_id_mapping', MAPPING_COLUMNS, rows)
+    # Une clé présente deux fois dans le lot : la dernière ligne insérée l'emporte
+    cur.execute("""
+        INSERT INTO id_mapping (source_system, source_table, source_key, target_table, target_id)
+        SELECT DISTINCT ON (source_key) source_system, source_table, source_key, target_table, target_id
+        FROM _id_mapping
+        ORDER BY source_key, target_id DESC
+        ON CONFLICT (source_system, source_table, source_key) DO UPDATE SET
+            target_table = EXCLUDED.target_table, target_id = EXCLUDED.target_id, mapped_at = now();
+    """)
+    cur.execute("DROP TABLE IF EXISTS _id_mapping")
+    logging.info(f"Correspondances {source_system}.{source_table} -> {target_table}: {len(rows)} enregistrée(s)")
+    return len(rows)
+
+def forget_mappings(cur, source_system, source_table, keys):
+    """Supprime les correspondances des clés source données (lignes supprimées de la cible)"""
+    keys = [str(key) for key in keys]
+    if not keys or not mapping_available(cur):
+        return
+    cur.execute("""
+        DELETE FROM id_mapping
+        WHERE source_system = %s AND source_table = %s AND source_key = ANY(%s);
+    """, (source_system, source_table, keys))
+
+def load_mapping(cur, source_system, source_table):
+    """{clé source: id cible} de toute une table source"""
+    if not mapping_available(cur):
+        return {}
+    cur.execute("""
+        SELECT source_key, target_id FROM id_mapping
+        WHERE source_system = %s AND source_table = %s;
+    """, (source_system, source_table))
+    return dict(cur.fetchall())
+
+def lookup_ids(cur, source_system, source_table, keys, ignore_case=False):
+    """{clé: id cible} des clés source données, résolues par une seule jointure.
+
+    ignore_case : clés comparées en majuscules, sans espaces de début/fin (libellés saisis
+    à la main) ; les clés absentes de id_mapping sont absentes du résultat.
+    """
+    keys = sorted({str(key) for key in keys if key is not None})
+    if not keys or not mapping_available(cur):
+        return {}
+    match = "upper(trim(m.source_key)) = upper(trim(k.key))" if ignore_case else "m.source_key = k.key"
+    cur.execute(f"""
+        SELECT k.key, m.target_id
+        FROM unnest(%s::text[]) AS k(key)
+        JOIN id_mapping m
+          ON m.source_system = %s AND m.source_table = %s AND {match};
+    """, (keys, source_system, source_table))
+    return dict(cur.fetchall())
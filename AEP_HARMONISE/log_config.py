@@ -0,0 +1,112 @@
+# --- CONFIGURATION DU JOURNAL ---
+# Configuration commune du logging des scripts et du pipeline :
+#   - les gestionnaires (fichier, console) tournent dans un thread d'arrière-plan
+#     (QueueHandler -> QueueListener) : une ligne de journal ne bloque plus le chargement
+#     sur l'écriture disque et console ;
+#   - les messages par ligne (ligne insérée, migrée...) passent par RowLog, qui les
+#     échantillonne selon la verbosité, et un résumé par étape les remplace :
+#       'summary' : résumés seulement ;
+#       'sample'  : (défaut) les ROW_LOG_FIRST premières lignes puis une sur ROW_LOG_EVERY ;
+#       'rows'    : toutes les lignes (comportement historique).
+# La verbosité passe par la variable d'environnement AEP_LOG_VERBOSITY, héritée par les
+# processus enfants (étapes parallèles du pipeline, lecture parallèle des fichiers).
+# Les processus enfants journalisent directement : ils se terminent sans arrêter
+# proprement un thread d'écriture, qui perdrait ses derniers messages.
+
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+import multiprocessing
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+VERBOSITY_LEVELS = ('summary', 'sample', 'rows')
+DEFAULT_VERBOSITY = 'sample'
+VERBOSITY_ENV = 'AEP_LOG_VERBOSITY'
+
+# Échantillonnage des messages par ligne en verbosité 'sample'
+ROW_LOG_FIRST = 10
+ROW_LOG_EVERY = 1000
+
+_listener = None
+
+
+def setup_logging(log_file=None, level=logging.INFO):
+    """Configure le logging racine : log_file éventuel et console.
+
+    Comme basicConfig, sans effet si le logging est déjà configuré (le pipeline configure
+    le sien avant de charger les scripts).
+    """
+    global _listener
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = ([logging.FileHandler(log_file)] if log_file else []) + [logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    root.setLevel(level)
+
+    if multiprocessing.parent_process() is not None:
+        for handler in handlers:
+            root.addHandler(handler)
+        return
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Écrit les messages encore en file et arrête le thread d'écriture"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def set_verbosity(verbosity):
+    """Verbosité des messages par ligne de ce processus et de ses processus enfants"""
+    if verbosity not in VERBOSITY_LEVELS:
+        raise ValueError(f"Verbosité inconnue: {verbosity} (attendu: {', '.join(VERBOSITY_LEVELS)})")
+    os.environ[VERBOSITY_ENV] = verbosity
+
+def get_verbosity():
+    verbosity = os.environ.get(VERBOSITY_ENV, DEFAULT_VERBOSITY)
+    return verbosity if verbosity in VERBOSITY_LEVELS else DEFAULT_VERBOSITY
+
+
+class RowLog:
+    """Messages par ligne d'une étape, échantillonnés selon la verbosité.
+
+    log(message, *args) formate à la manière de logging : un message écarté ne coûte ni
+    formatage ni écriture. summary() journalise le total de l'étape.
+    """
+
+    def __init__(self, stage, action, level=logging.INFO, verbosity=None):
+        self.stage = stage
+        self.action = action  # ex: 'insérée(s)', libellé du résumé
+        self.level = level
+        self.verbosity = verbosity or get_verbosity()
+        self.count = 0
+        self.logged = 0
+
+    def _sampled(self):
+        if self.verbosity == 'rows':
+            return True
+        if self.verbosity == 'summary':
+            return False
+        return self.count <= ROW_LOG_FIRST or self.count % ROW_LOG_EVERY == 0
+
+    def log(self, message, *args):
+        self.count += 1
+        if self._sampled():
+            self.logged += 1
+            logging.log(self.level, message, *args)
+
+    def summary(self):
+        omitted = self.count - self.logged
+        detail = f" ({omitted} message(s) par ligne omis, verbosité '{self.verbosity}')" if omitted else ""
+        logging.info(f"{self.stage}: {self.count} ligne(s) {self.action}{detail}")
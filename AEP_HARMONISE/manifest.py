@@ -0,0 +1,119 @@
+# --- MANIFESTE D'INGESTION DES FICHIERS ---
+# Les chargeurs de fichiers (3 et 8 GeoJSON, 9 Excel, 10, 11 et 12 CSV) enregistrent dans la
+# table ingestion_manifest chaque fichier chargé avec succès : chemin, taille, date de
+# modification, empreinte SHA-256 du contenu, étape et statistiques du chargement.
+# Par défaut (mode incrémental), un fichier déjà enregistré et inchangé n'est pas relu :
+#   - même taille et même date de modification : inchangé, sans relire le contenu ;
+#   - sinon l'empreinte est recalculée : si elle est identique (fichier recopié ou
+#     simplement touché), le fichier est considéré inchangé et sa date est mise à jour.
+# L'option force (--force) retraite tous les fichiers.
+
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+from psycopg2.extras import Json
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_hash(file_path):
+    """Empreinte SHA-256 du contenu d'un fichier, lu par blocs"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _file_state(file_path):
+    st = os.stat(file_path)
+    return st.st_size, datetime.fromtimestamp(st.st_mtime)
+
+
+class IngestionManifest:
+    """Fichiers déjà chargés par une étape, lus depuis ingestion_manifest.
+
+    Sans la table (schéma pas encore migré), tous les fichiers sont traités et rien
+    n'est enregistré.
+    """
+
+    def __init__(self, conn, stage, force=False):
+        self.conn = conn
+        self.stage = stage
+        self.force = force
+        self.available = False
+        self.entries = {}  # chemin -> (taille, mtime, empreinte)
+        self.hashes = {}   # chemin -> empreinte calculée pendant l'exécution
+        self.stats = {'new': 0, 'changed': 0, 'unchanged': 0}
+        self.load()
+
+    def load(self):
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('ingestion_manifest') IS NOT NULL;")
+            self.available = cur.fetchone()[0]
+            if not self.available:
+                logging.warning("Table ingestion_manifest absente : tous les fichiers sont traités")
+                return
+            cur.execute("""
+                SELECT path, size, mtime, content_hash FROM ingestion_manifest WHERE stage = %s;
+            """, (self.stage,))
+            self.entries = {path: (size, mtime, content_hash) for path, size, mtime, content_hash in cur.fetchall()}
+
+    def content_hash(self, file_path):
+        """Empreinte du fichier, calculée une seule fois par exécution (partagée avec
+        les points de reprise, voir checkpoints.py)"""
+        path = os.path.abspath(file_path)
+        if path not in self.hashes:
+            self.hashes[path] = file_hash(path)
+        return self.hashes[path]
+
+    def is_current(self, file_path):
+        """Fichier déjà chargé par l'étape et inchangé depuis"""
+        path = os.path.abspath(file_path)
+        entry = self.entries.get(path)
+        if entry is None:
+            self.stats['new'] += 1
+            return False
+        size, mtime = _file_state(path)
+        if (size, mtime) == entry[:2]:
+            self.stats['unchanged'] += 1
+            return True
+        if size == entry[0] and self.content_hash(path) == entry[2]:
+            # Contenu identique, seule la date a changé
+            with self.conn.cursor() as cur:
+                cur.execute("UPDATE ingestion_manifest SET mtime = %s WHERE stage = %s AND path = %s;",
+                            (mtime, self.stage, path))
+            self.entries[path] = (size, mtime, entry[2])
+            self.stats['unchanged'] += 1
+            return True
+        self.stats['changed'] += 1
+        return False
+
+    def select(self, file_paths):
+        """Fichiers à traiter : nouveaux ou modifiés (tous si force ou sans manifeste)"""
+        if self.force or not self.available:
+            return list(file_paths)
+        selected = [file_path for file_path in file_paths if not self.is_current(file_path)]
+        self.conn.commit()
+        logging.info(f"Manifeste {self.stage}: {self.stats['new']} nouveau(x), {self.stats['changed']} modifié(s), "
+                     f"{self.stats['unchanged']} inchangé(s) ignoré(s)")
+        return selected
+
+    def record(self, file_path, stats=None):
+        """Enregistre un fichier chargé avec succès (dans la transaction de l'appelant)"""
+        if not self.available:
+            return
+        path = os.path.abspath(file_path)
+        size, mtime = _file_state(path)
+        content_hash = self.content_hash(path)
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO ingestion_manifest (stage, path, size, mtime, content_hash, stats)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (stage, path) DO UPDATE SET
+                    size = EXCLUDED.size, mtime = EXCLUDED.mtime, content_hash = EXCLUDED.content_hash,
+                    stats = EXCLUDED.stats, ingested_at = now();
+            """, (self.stage, path, size, mtime, content_hash,
+                  Json(stats or {}, dumps=lambda value: json.dumps(value, default=str))))
+        self.entries[path] = (size, mtime, content_hash)
@@ -0,0 +1,256 @@
+# --- MÉTRIQUES D'EXÉCUTION ---
+# Mesures par étape du pipeline et par fichier d'entrée : durée, lignes lues / écrites /
+# rejetées, débit (lignes/s), allers-retours avec la base, octets lus et mémoire résidente
+# maximale (RSS). Elles sont écrites en fin d'exécution :
+#   - dans un rapport JSON (une exécution par fichier) ;
+#   - dans un fichier texte Prometheus pour le collecteur textfile de node_exporter,
+#     afin de suivre le débit des chargements nocturnes et d'en repérer les régressions.
+# Les allers-retours sont comptés par le curseur des connexions de db.py (CountingCursor) :
+# chaque execute / executemany / COPY en est un, chaque lot d'une lecture en flux aussi.
+# Les scripts enregistrent leurs fichiers (record_file) ou leurs lignes (record_rows) dans
+# l'étape en cours ; lancés seuls, hors étape du pipeline, ces appels sont sans effet.
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import psycopg2.extensions
+
+try:
+    import resource  # Unix seulement
+except ImportError:
+    resource = None
+
+METRIC_PREFIX = 'aep_harmonise'
+
+_round_trips = 0
+_round_trips_lock = threading.Lock()
+_current_stage = None
+
+
+#  Allers-retours avec la base
+def count_round_trips(count=1):
+    global _round_trips
+    with _round_trips_lock:
+        _round_trips += count
+
+def round_trips():
+    """Allers-retours comptés dans ce processus depuis son démarrage"""
+    return _round_trips
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Curseur psycopg2 qui compte ses allers-retours avec le serveur"""
+
+    def execute(self, query, vars=None):
+        count_round_trips()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        count_round_trips()
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        count_round_trips()
+        return super().copy_expert(sql, file, size)
+
+    def copy_from(self, file, table, *args, **kwargs):
+        count_round_trips()
+        return super().copy_from(file, table, *args, **kwargs)
+
+
+#  Mémoire
+def peak_rss_bytes():
+    """RSS maximale de ce processus et de ses processus enfants terminés (None hors Unix)"""
+    if resource is None:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024  # ko sous Linux
+
+
+#  Étapes et fichiers
+def _rate(rows, seconds):
+    return round(rows / seconds, 1) if seconds else None
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+class StageMetrics:
+    """Mesures d'une étape : lignes enregistrées par record_rows et par fichier"""
+
+    def __init__(self, name):
+        self.name = name
+        self.status = 'running'
+        self.seconds = None
+        self.round_trips = 0
+        self.peak_rss_bytes = None
+        self.rows = {'read': 0, 'written': 0, 'rejected': 0}
+        self.files = {}
+        self._lock = threading.Lock()  # écrivains parallèles de parallel_ingest.py
+
+    def add_rows(self, read=0, written=0, rejected=0):
+        with self._lock:
+            self.rows['read'] += read
+            self.rows['written'] += written
+            self.rows['rejected'] += rejected
+
+    def add_file(self, path, read=0, written=0, rejected=0, seconds=None, input_dir=None):
+        entry = {
+            'file': _file_label(path, input_dir),
+            'seconds': round(seconds, 3) if seconds is not None else None,
+            'rows_read': read,
+            'rows_written': written,
+            'rows_rejected': rejected,
+            'rows_per_second': _rate(read, seconds),
+            'bytes_read': _file_size(path),
+        }
+        with self._lock:
+            self.files[os.path.abspath(path)] = entry
+        self.add_rows(read, written, rejected)
+
+    def report(self):
+        return {
+            'stage': self.name,
+            'status': self.status,
+            'seconds': round(self.seconds, 3) if self.seconds is not None else None,
+            'rows_read': self.rows['read'],
+            'rows_written': self.rows['written'],
+            'rows_rejected': self.rows['rejected'],
+            'rows_per_second': _rate(max(self.rows['read'], self.rows['written']), self.seconds),
+            'db_round_trips': self.round_trips,
+            'bytes_read': sum(entry['bytes_read'] for entry in self.files.values()),
+            'peak_rss_bytes': self.peak_rss_bytes,
+            'files': sorted(self.files.values(), key=lambda entry: entry['file']),
+        }
+
+@contextmanager
+def stage_metrics(name):
+    """Mesure une étape exécutée dans ce processus ; report() donne ses métriques"""
+    global _current_stage
+    stage = StageMetrics(name)
+    previous, _current_stage = _current_stage, stage
+    started = time.perf_counter()
+    trips = round_trips()
+    try:
+        yield stage
+        stage.status = 'success'
+    except BaseException:
+        stage.status = 'failed'
+        raise
+    finally:
+        stage.seconds = time.perf_counter() - started
+        stage.round_trips = round_trips() - trips
+        stage.peak_rss_bytes = peak_rss_bytes()
+        _current_stage = previous
+
+def record_rows(read=0, written=0, rejected=0):
+    """Lignes lues / écrites / rejetées par l'étape en cours (sources en base)"""
+    if _current_stage is not None:
+        _current_stage.add_rows(read, written, rejected)
+
+def _file_label(path, input_dir=None):
+    """Libellé d'un fichier : chemin relatif au dossier d'entrée (par défaut, son propre
+    dossier), pour que deux fichiers de même nom dans des sous-dossiers restent distincts"""
+    path = os.path.abspath(path)
+    return os.path.relpath(path, os.path.abspath(input_dir) if input_dir else os.path.dirname(path))
+
+def record_file(path, read=0, written=0, rejected=0, seconds=None, input_dir=None):
+    """Fichier d'entrée traité par l'étape en cours (seconds : durée de son traitement,
+    None si elle n'est pas mesurable, ex: lecture et écriture parallèles ; input_dir :
+    dossier d'entrée de l'étape, base du libellé du fichier)"""
+    if _current_stage is not None:
+        _current_stage.add_file(path, read, written, rejected, seconds, input_dir)
+
+
+#  Rapport d'exécution
+class RunReport:
+    """Métriques d'une exécution du pipeline, étape par étape"""
+
+    def __init__(self, run_name='pipeline'):
+        self.run_name = run_name
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+        self.stages = []
+
+    def add(self, stage_report):
+        self.stages.append(stage_report)
+
+    def report(self):
+        failed = any(stage['status'] != 'success' for stage in self.stages)
+        return {
+            'run': self.run_name,
+            'started_at': self.started_at.isoformat(),
+            'seconds': round(time.perf_counter() - self._started, 3),
+            'status': 'failed' if failed else 'success',
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': self.stages,
+        }
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.report(), ensure_ascii=False, indent=2))
+        logging.info(f"Rapport d'exécution écrit: {path}")
+
+    def write_prometheus(self, path):
+        _write_atomic(path, prometheus_text(self.report()))
+        logging.info(f"Métriques Prometheus écrites: {path}")
+
+def _write_atomic(path, text):
+    """Écrit puis renomme : node_exporter ne lit jamais un fichier à moitié écrit"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+def prometheus_text(report):
+    """Format d'exposition texte Prometheus d'un rapport d'exécution (jauges)"""
+    metrics = {}  # nom -> (aide, [(labels, valeur)])
+
+    def gauge(name, help_text, labels, value):
+        if value is not None:
+            metrics.setdefault(name, (help_text, []))[1].append((labels, value))
+
+    run = {'run': report['run']}
+    gauge('run_duration_seconds', "Durée de l'exécution", run, report['seconds'])
+    gauge('run_success', "1 si toutes les étapes ont réussi", run, int(report['status'] == 'success'))
+    gauge('run_timestamp_seconds', "Début de l'exécution (epoch)", run,
+          datetime.fromisoformat(report['started_at']).timestamp())
+    gauge('run_peak_rss_bytes', "RSS maximale du processus principal", run, report['peak_rss_bytes'])
+
+    for stage in report['stages']:
+        labels = dict(run, stage=stage['stage'])
+        gauge('stage_success', "1 si l'étape a réussi", labels, int(stage['status'] == 'success'))
+        gauge('stage_duration_seconds', "Durée de l'étape", labels, stage['seconds'])
+        for kind in ('read', 'written', 'rejected'):
+            gauge('stage_rows', "Lignes de l'étape par nature", dict(labels, kind=kind), stage[f'rows_{kind}'])
+        gauge('stage_rows_per_second', "Débit de l'étape", labels, stage['rows_per_second'])
+        gauge('stage_db_round_trips', "Allers-retours avec la base", labels, stage['db_round_trips'])
+        gauge('stage_bytes_read', "Octets des fichiers d'entrée", labels, stage['bytes_read'])
+        gauge('stage_peak_rss_bytes', "RSS maximale du processus de l'étape", labels, stage['peak_rss_bytes'])
+        for entry in stage['files']:
+            file_labels = dict(labels, file=entry['file'])
+            gauge('file_duration_seconds', "Durée de traitement du fichier", file_labels, entry['seconds'])
+            for kind in ('read', 'written', 'rejected'):
+                gauge('file_rows', "Lignes du fichier par nature", dict(file_labels, kind=kind),
+                      entry[f'rows_{kind}'])
+            gauge('file_rows_per_second', "Débit du fichier", file_labels, entry['rows_per_second'])
+            gauge('file_bytes_read', "Taille du fichier", file_labels, entry['bytes_read'])
+
+    lines = []
+    for name, (help_text, samples) in metrics.items():
+        full_name = f"{METRIC_PREFIX}_{name}"
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} gauge")
+        lines.extend(f"{full_name}{_labels(**labels)} {value}" for labels, value in samples)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,195 @@
+# --- MIGRATIONS VERSIONNÉES DU SCHÉMA AEP_HARMONISE ---
+# Chaque commande de SQL_COMMANDS (1_creation_base.py) est une étape numérotée par sa
+# position. La table schema_migrations garde la trace des étapes appliquées : seules les
+# étapes en attente sont exécutées, les données chargées restent en place.
+# SQL_COMMANDS doit donc rester en ajout seul : une évolution du schéma = une nouvelle
+# commande ajoutée en fin de liste (ALTER TABLE ..., CREATE TABLE ...).
+
+import re
+import hashlib
+import logging
+
+VERSION_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description VARCHAR(200),
+        checksum CHAR(64) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT now(),
+        baseline BOOLEAN NOT NULL DEFAULT FALSE
+    );
+"""
+
+# Objets créés par une étape, détectés dans son texte SQL
+_OBJECT_PATTERNS = [
+    ('extension', re.compile(r"CREATE EXTENSION (?:IF NOT EXISTS )?(\w+)", re.I)),
+    ('type', re.compile(r"CREATE TYPE (\w+)", re.I)),
+    ('table', re.compile(r"CREATE TABLE (?:IF NOT EXISTS )?(\w+)", re.I)),
+    ('index', re.compile(r"CREATE (?:UNIQUE )?INDEX (?:CONCURRENTLY )?(?:IF NOT EXISTS )?(\w+)", re.I)),
+    ('constraint', re.compile(r"ADD CONSTRAINT (\w+)", re.I)),
+]
+
+# Éléments d'un CREATE TABLE qui ne sont pas des colonnes
+_TABLE_CONSTRAINT_KEYWORDS = ('primary', 'unique', 'check', 'constraint', 'foreign', 'exclude')
+
+
+#  Description des étapes
+def _strip_comments(command):
+    return re.sub(r"--[^\n]*", "", command)
+
+def step_checksum(command):
+    """Empreinte d'une étape, insensible aux espaces et commentaires"""
+    normalized = ' '.join(_strip_comments(command).split())
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def describe_step(command):
+    """Première ligne significative d'une étape (ex: 'CREATE TABLE commune (')"""
+    for line in _strip_comments(command).splitlines():
+        if line.strip():
+            return line.strip()[:200]
+    return ''
+
+def step_objects(command):
+    """Liste des objets (type, nom) créés par une étape"""
+    objects = []
+    text = _strip_comments(command)
+    for kind, pattern in _OBJECT_PATTERNS:
+        objects.extend((kind, name.lower()) for name in pattern.findall(text))
+    return objects
+
+def declared_columns(command):
+    """{table: [colonnes]} déclarées par les CREATE TABLE (hors PARTITION OF) d'une étape"""
+    text = _strip_comments(command)
+    tables = {}
+    for match in re.finditer(r"CREATE TABLE (?:IF NOT EXISTS )?(\w+) \(", text, re.I):
+        depth, start = 1, match.end()
+        pos = start
+        while depth and pos < len(text):
+            depth += {'(': 1, ')': -1}.get(text[pos], 0)
+            pos += 1
+        body = text[start:pos - 1]
+
+        items, depth, current = [], 0, ''
+        for char in body:
+            if char == ',' and depth == 0:
+                items.append(current)
+                current = ''
+                continue
+            depth += {'(': 1, ')': -1}.get(char, 0)
+            current += char
+        items.append(current)
+
+        columns = []
+        for item in items:
+            words = item.split()
+            if words and words[0].lower() not in _TABLE_CONSTRAINT_KEYWORDS:
+                columns.append(words[0].lower())
+        tables[match.group(1).lower()] = columns
+    return tables
+
+
+#  Catalogue
+def object_exists(cur, kind, name):
+    """Vérifie la présence d'un objet dans le catalogue de la base"""
+    queries = {
+        'extension': "SELECT 1 FROM pg_extension WHERE extname = %s",
+        'type': "SELECT 1 FROM pg_type WHERE typname = %s",
+        'table': "SELECT 1 FROM pg_class WHERE relname = %s AND relkind IN ('r', 'p')",
+        'index': "SELECT 1 FROM pg_class WHERE relname = %s AND relkind IN ('i', 'I')",
+        'constraint': "SELECT 1 FROM pg_constraint WHERE conname = %s",
+    }
+    cur.execute(queries[kind], (name,))
+    return cur.fetchone() is not None
+
+def live_columns(cur, table):
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s;
+    """, (table,))
+    return {r[0] for r in cur.fetchall()}
+
+def applied_steps(cur):
+    """{version: checksum} des étapes déjà appliquées"""
+    cur.execute("SELECT version, checksum FROM schema_migrations;")
+    return dict(cur.fetchall())
+
+
+#  Dérive
+def detect_drift(cur, commands):
+    """Compare les étapes appliquées au catalogue réel.
+
+    Retourne la liste des anomalies : étape modifiée depuis son application, objet
+    manquant, colonne manquante ou inattendue.
+    """
+    drift = []
+    applied = applied_steps(cur)
+    for version, command in enumerate(commands, 1):
+        if version not in applied:
+            continue
+        if applied[version] != step_checksum(command):
+            drift.append(f"Étape #{version} modifiée depuis son application: {describe_step(command)}")
+        for kind, name in step_objects(command):
+            if not object_exists(cur, kind, name):
+                drift.append(f"Étape #{version}: {kind} '{name}' absent de la base")
+        for table, columns in declared_columns(command).items():
+            live = live_columns(cur, table)
+            if not live:
+                continue
+            missing = [c for c in columns if c not in live]
+            if missing:
+                drift.append(f"Table {table}: colonne(s) manquante(s) {missing}")
+
+    # Colonnes présentes en base mais déclarées par aucune étape
+    expected = {}
+    for command in commands:
+        for table, columns in declared_columns(command).items():
+            expected.setdefault(table, set()).update(columns)
+    for table, columns in expected.items():
+        extra = live_columns(cur, table) - columns
+        if extra:
+            drift.append(f"Table {table}: colonne(s) non déclarée(s) {sorted(extra)}")
+    return drift
+
+
+#  Application
+def migrate(conn, commands, dry_run=False):
+    """Applique les étapes en attente dans une seule transaction.
+
+    Une base créée avant l'existence de schema_migrations est adoptée : les étapes dont
+    tous les objets existent déjà sont enregistrées comme 'baseline' sans être rejouées.
+    Retourne la liste des versions appliquées (ou à appliquer si dry_run).
+    """
+    pending = []
+    with conn.cursor() as cur:
+        cur.execute(VERSION_TABLE_SQL)
+        applied = applied_steps(cur)
+
+        for version, command in enumerate(commands, 1):
+            if version in applied:
+                continue
+            objects = step_objects(command)
+            already_present = bool(objects) and all(object_exists(cur, k, n) for k, n in objects)
+            pending.append(version)
+
+            if dry_run:
+                state = "déjà présente (baseline)" if already_present else "à appliquer"
+                logging.info(f"Étape #{version} {state}: {describe_step(command)}")
+                continue
+
+            if already_present:
+                logging.info(f"Étape #{version} déjà présente, enregistrée comme baseline: {describe_step(command)}")
+            else:
+                logging.info(f"Application de l'étape #{version}: {describe_step(command)}")
+                cur.execute(command)
+            cur.execute("""
+                INSERT INTO schema_migrations (version, description, checksum, baseline)
+                VALUES (%s, %s, %s, %s);
+            """, (version, describe_step(command), step_checksum(command), already_present))
+
+        for message in detect_drift(cur, commands):
+            logging.warning(f"Dérive du schéma: {message}")
+
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    return pending
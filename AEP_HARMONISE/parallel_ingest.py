@@ -0,0 +1,103 @@
+# --- INGESTION PARALLÈLE DES FICHIERS CSV ---
+# Mode parallèle des chargeurs de volumes (10_eau_brute_jirama.py, 11_eau_traite_jirama.py,
+# 12_eau_distribue.py) :
+#   1. chaque fichier est lu et validé dans un processus du pool (aucun accès à la base) ;
+#   2. le processus principal résout les références en mémoire (voir resolvers.py) ;
+#   3. les lignes nettoyées de chaque fichier sont écrites par un nombre borné d'écrivains,
+#      chacun sur sa propre connexion du pool, une transaction par fichier ;
+#   4. les statistiques par fichier sont fusionnées dans l'ordre des noms de fichiers.
+
+import os
+import logging
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from db import DB_CONFIG_TARGET, pooled_connection
+
+# Nombre de connexions d'écriture simultanées (borné par POOL_MAX_CONNECTIONS de db.py)
+DEFAULT_WRITERS = 4
+
+_scripts = {}
+
+
+#  Côté processus de lecture
+def _load_script(script_path):
+    """Importe un script par son chemin (noms numérotés non importables directement)"""
+    if script_path not in _scripts:
+        module_name = "ingestion_" + os.path.splitext(os.path.basename(script_path))[0]
+        spec = importlib.util.spec_from_file_location(module_name, script_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _scripts[script_path] = module
+    return _scripts[script_path]
+
+def _parse_in_worker(script_path, parse_name, file_path):
+    return getattr(_load_script(script_path), parse_name)(file_path)
+
+
+#  Côté écrivains
+def _write_file(write, rows, config):
+    """Écrit les lignes d'un fichier sur une connexion du pool, dans sa propre transaction"""
+    with pooled_connection(config) as conn:
+        counts = write(conn, rows)
+        conn.commit()
+        return counts
+
+
+#  Orchestration
+def ingest_files(script_path, parse_name, file_paths, prepare, write, workers,
+                 writers=DEFAULT_WRITERS, on_written=None, config=DB_CONFIG_TARGET):
+    """Lit les fichiers en parallèle puis les écrit par un nombre borné de connexions.
+
+    parse_name : fonction du script, parse(file_path) -> résultat picklable, sans accès base.
+    prepare(file_path, parsed) -> (lignes, stats du fichier) : processus principal.
+    write(conn, lignes) -> {compteur: valeur} ajouté aux stats du fichier ; validé par fichier.
+    on_written(file_path, succès) : appelé dans le processus principal après l'écriture.
+
+    Retourne ({fichier: stats} trié par nom de fichier, {fichier: exception}).
+    """
+    results = {}
+    failures = {}
+    context = multiprocessing.get_context('spawn')
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as parsers, \
+         ThreadPoolExecutor(max_workers=writers) as writer_pool:
+        parse_futures = {
+            parsers.submit(_parse_in_worker, script_path, parse_name, file_path): file_path
+            for file_path in file_paths
+        }
+        write_futures = {}
+        for future in as_completed(parse_futures):
+            file_path = parse_futures[future]
+            try:
+                rows, file_stats = prepare(file_path, future.result())
+            except Exception as e:
+                logging.error(f"Échec lecture fichier {os.path.basename(file_path)}: {e}")
+                failures[file_path] = e
+                continue
+            write_futures[writer_pool.submit(_write_file, write, rows, config)] = (file_path, file_stats)
+
+        for future in as_completed(write_futures):
+            file_path, file_stats = write_futures[future]
+            try:
+                for key, value in future.result().items():
+                    file_stats[key] = file_stats.get(key, 0) + value
+                results[file_path] = file_stats
+                if on_written:
+                    on_written(file_path, True)
+            except Exception as e:
+                logging.error(f"Échec écriture fichier {os.path.basename(file_path)}: {e}")
+                failures[file_path] = e
+                if on_written:
+                    on_written(file_path, False)
+
+    return {path: results[path] for path in sorted(results)}, \
+           {path: failures[path] for path in sorted(failures)}
+
+def merge_stats(global_stats, file_stats_by_path):
+    """Ajoute les statistiques par fichier aux statistiques globales (clés connues seulement)"""
+    for file_stats in file_stats_by_path.values():
+        for key, value in file_stats.items():
+            if key in global_stats and isinstance(value, (int, float)):
+                global_stats[key] += value
+    return global_stats
@@ -0,0 +1,125 @@
+# --- PARTITIONNEMENT MENSUEL DES TABLES DE VOLUMES ---
+# eau_brute, eau_traite et eau_distribue peuvent être créées partitionnées par mois
+# sur la colonne date (voir 1_creation_base.py --partitioned). Ce module crée les
+# partitions manquantes avant écriture et permet de remplacer un mois complet.
+
+import logging
+from datetime import date, datetime
+from psycopg2 import sql
+from bulk_copy import copy_rows
+
+PARTITIONED_TABLES = ('eau_brute', 'eau_traite', 'eau_distribue')
+
+
+#  Utilitaires
+def month_start(value):
+    """Premier jour du mois d'une date (objet date/datetime ou chaîne 'AAAA-MM-JJ')"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = date.fromisoformat(value.strip()[:10])
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.replace(day=1)
+
+def next_month(month):
+    return date(month.year + 1, 1, 1) if month.month == 12 else date(month.year, month.month + 1, 1)
+
+def partition_name(table, month):
+    return f"{table}_{month.year:04d}_{month.month:02d}"
+
+def default_partition_name(table):
+    return f"{table}_default"
+
+def is_partitioned(cur, table):
+    """Indique si la table est une table partitionnée (relkind 'p')"""
+    cur.execute("""
+        SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);
+    """, (table,))
+    result = cur.fetchone()
+    return bool(result and result[0])
+
+def _relation_exists(cur, name):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+    return cur.fetchone()[0]
+
+
+#  Création des partitions
+def _create_month_partition(cur, table, month):
+    """Crée la partition mensuelle, en y déplaçant les lignes déjà tombées dans la partition DEFAULT"""
+    name = partition_name(table, month)
+    bounds = (month, next_month(month))
+    default_name = default_partition_name(table)
+
+    cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE date >= %s AND date < %s)").format(
+        sql.Identifier(default_name)), bounds)
+    if not cur.fetchone()[0]:
+        cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+            sql.Identifier(name), sql.Identifier(table)), bounds)
+        return
+
+    # Des lignes de ce mois sont dans la partition DEFAULT : on les déplace avant l'attachement
+    cur.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(
+        sql.Identifier(name), sql.Identifier(table)))
+    cur.execute(sql.SQL("""
+        WITH moved AS (
+            DELETE FROM {} WHERE date >= %s AND date < %s RETURNING *
+        )
+        INSERT INTO {} SELECT * FROM moved
+    """).format(sql.Identifier(default_name), sql.Identifier(name)), bounds)
+    moved = cur.rowcount
+    cur.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(
+        sql.Identifier(table), sql.Identifier(name)), bounds)
+    logging.info(f"Partition {name} créée avec {moved} ligne(s) reprises de {default_name}")
+
+def ensure_month_partitions(cur, table, dates):
+    """Crée les partitions mensuelles manquantes pour les dates à écrire.
+
+    Les dates NULL sont ignorées : elles vont dans la partition DEFAULT.
+    Retourne la liste des partitions créées.
+    """
+    created = []
+    for month in sorted({month_start(d) for d in dates if d is not None}):
+        name = partition_name(table, month)
+        if _relation_exists(cur, name):
+            continue
+        _create_month_partition(cur, table, month)
+        created.append(name)
+        logging.info(f"Partition {name} créée")
+    return created
+
+
+#  Remplacement d'un mois
+def replace_month_partition(cur, table, month, columns, rows):
+    """Recharge exactement un mois : les lignes sont chargées dans une table neuve qui
+    remplace la partition existante (DETACH/DROP puis ATTACH), sans recherche de doublons.
+
+    Toutes les lignes doivent appartenir au mois. Retourne le nombre de lignes écrites.
+    """
+    month = month_start(month)
+    name = partition_name(table, month)
+    staging = f"{name}_reload"
+    bounds = (month, next_month(month))
+
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+    cur.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(
+        sql.Identifier(staging), sql.Identifier(table)))
+    # La contrainte CHECK évite le parcours de validation lors de l'ATTACH
+    cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK (date IS NOT NULL AND date >= %s AND date < %s)").format(
+        sql.Identifier(staging), sql.Identifier(f"{staging}_bornes")), bounds)
+
+    written = copy_rows(cur, staging, columns, rows)
+
+    if _relation_exists(cur, name):
+        cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+            sql.Identifier(table), sql.Identifier(name)))
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+    cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+        sql.Identifier(staging), sql.Identifier(name)))
+    cur.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(
+        sql.Identifier(table), sql.Identifier(name)), bounds)
+    cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+        sql.Identifier(name), sql.Identifier(f"{staging}_bornes")))
+
+    logging.info(f"Partition {name} remplacée: {written} lignes")
+    return written
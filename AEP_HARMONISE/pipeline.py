@@ -0,0 +1,355 @@
+# --- PIPELINE COMPLET AEP_HARMONISE ---
+# Point d'entrée unique : enchaîne les douze scripts dans l'ordre des dépendances
+# (schéma → commune → quartier → index spatial des quartiers → captage/station/réservoir →
+# relations → noeuds → points → volumes → index de recherche) en réutilisant les connexions des pools de db.py, et garde en
+# mémoire l'état produit par chaque étape (mappings d'identifiants) pour les suivantes.
+# Avec --workers N, les étapes indépendantes s'exécutent en parallèle (une étape par
+# processus, chacune avec sa propre connexion cible et sa propre transaction).
+# Les métriques de chaque étape (durée, lignes, débit, allers-retours, mémoire) sont
+# écrites en fin d'exécution dans un rapport JSON et, au besoin, un fichier Prometheus.
+
+import os
+import argparse
+import logging
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Le logging du pipeline est configuré avant le chargement des scripts (leur setup_logging est alors sans effet)
+from log_config import setup_logging, set_verbosity, VERBOSITY_LEVELS, DEFAULT_VERBOSITY
+setup_logging('pipeline.log')
+
+from db import (DB_CONFIG_TARGET, DB_CONFIG_SOURCE_EAURIZON, DB_CONFIG_SOURCE_JIRAMA,
+                pooled_connection, close_pools)
+from spatial import SPATIAL_MODES, DEFAULT_SPATIAL_MODE, clear_quartier_index
+from resolvers import invalidate_resolvers, set_fuzzy_matching
+from sync import SYNC_MODES, DEFAULT_SYNC_MODE
+from metrics import RunReport, stage_metrics
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Rapport d'exécution écrit en fin de pipeline (voir metrics.py)
+DEFAULT_METRICS_JSON = 'pipeline_metrics.json'
+
+_modules = {}
+
+
+#  Chargement des scripts numérotés (noms non importables directement)
+def load_script(filename):
+    """Importe un script du dossier par son nom de fichier (ex: '4_captage.py')"""
+    if filename not in _modules:
+        module_name = "etape_" + os.path.splitext(filename)[0]
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPT_DIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[filename] = module
+    return _modules[filename]
+
+
+#  Étapes
+# Chaque fonction reçoit le module du script et l'état partagé du pipeline (dict).
+def run_schema(module, state):
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        module.create_database_schema(partitioned=state['partitioned'], conn=conn)
+
+def run_commune(module, state):
+    with pooled_connection(DB_CONFIG_SOURCE_EAURIZON) as source_conn, \
+         pooled_connection(DB_CONFIG_TARGET) as target_conn:
+        module.migrate_commune(source_conn, target_conn, sync_mode=state['sync_mode'],
+                               delete_missing=state['delete_missing'])
+
+def run_quartier(module, state):
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        module.migrate_quartier(conn, force=state['force'], replay_rejects=state['replay_rejects'])
+    # Les quartiers viennent d'être rechargés : l'index STRtree sera reconstruit au prochain usage
+    clear_quartier_index()
+
+def run_index_quartier(module, state):
+    # Index GIST des quartiers, utilisé par l'affectation spatiale des captages, stations et réservoirs
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        module.create_indexes(tables=['quartier'], conn=conn)
+
+def run_captage(module, state):
+    with pooled_connection(DB_CONFIG_SOURCE_JIRAMA) as source_conn, \
+         pooled_connection(DB_CONFIG_TARGET) as target_conn:
+        state['captage_mapping'] = module.migrate_captage(
+            source_conn, target_conn, spatial_mode=state['spatial_mode'], sync_mode=state['sync_mode'],
+            delete_missing=state['delete_missing'])
+
+def _text_key_sync_mode(state):
+    """Stations et réservoirs ont une clé source textuelle : 'watermark' y devient 'hash'"""
+    return 'hash' if state['sync_mode'] == 'watermark' else state['sync_mode']
+
+def run_station(module, state):
+    with pooled_connection(DB_CONFIG_SOURCE_JIRAMA) as source_conn, \
+         pooled_connection(DB_CONFIG_TARGET) as target_conn:
+        state['station_mapping'] = module.migrate_station_traitement(
+            source_conn, target_conn, spatial_mode=state['spatial_mode'], sync_mode=_text_key_sync_mode(state),
+            delete_missing=state['delete_missing'])
+
+def run_reservoir(module, state):
+    with pooled_connection(DB_CONFIG_SOURCE_JIRAMA) as source_conn, \
+         pooled_connection(DB_CONFIG_TARGET) as target_conn:
+        state['reservoir_mapping'] = module.migrate_reservoir(
+            source_conn, target_conn, spatial_mode=state['spatial_mode'], sync_mode=_text_key_sync_mode(state),
+            delete_missing=state['delete_missing'])
+
+def run_relations(module, state):
+    # Les réservoirs viennent d'être insérés : leurs ids sont résolus en mémoire
+    reservoir_ids = None
+    if state.get('reservoir_mapping'):
+        reservoir_ids = {str(source_id).upper()[:50].strip(): new_id
+                         for source_id, new_id in state['reservoir_mapping'].items()}
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        state['relations_stats'] = module.fill_reservoir_reservoir_relations(conn, reservoir_ids=reservoir_ids)
+
+def run_noeud(module, state):
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        state['noeud_stats'] = module.migrate_noeud_consommation(conn, force=state['force'])
+
+def run_points(module, state):
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        state['points_stats'] = module.import_excel_files(conn, force=state['force'],
+                                                          resume=state['resume'],
+                                                          replay_rejects=state['replay_rejects'])
+
+def run_eau_brute(module, state):
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        state['eau_brute_stats'] = module.migrate_eau_brute(conn=conn, workers=state['ingest_workers'],
+                                                            force=state['force'], resume=state['resume'],
+                                                            replay_rejects=state['replay_rejects'])
+
+def run_eau_traite(module, state):
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        state['eau_traite_stats'] = module.migrate_eau_traite(conn=conn, workers=state['ingest_workers'],
+                                                              force=state['force'], resume=state['resume'],
+                                                              replay_rejects=state['replay_rejects'])
+
+def run_eau_distribue(module, state):
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        state['eau_distribue_stats'] = module.import_csv_to_db(conn=conn, workers=state['ingest_workers'],
+                                                               force=state['force'], resume=state['resume'],
+                                                               replay_rejects=state['replay_rejects'])
+
+def run_indexes(module, state):
+    # Phase post-chargement : index de recherche de toutes les tables (voir 1_creation_base.py)
+    with pooled_connection(DB_CONFIG_TARGET) as conn:
+        module.create_indexes(conn=conn)
+
+# Étapes dans l'ordre des dépendances
+STAGES = [
+    {'name': 'schema', 'script': '1_creation_base.py', 'depends_on': [], 'run': run_schema},
+    {'name': 'commune', 'script': '2_commune.py', 'depends_on': ['schema'], 'run': run_commune},
+    {'name': 'quartier', 'script': '3_quartier.py', 'depends_on': ['commune'], 'run': run_quartier},
+    {'name': 'index_quartier', 'script': '1_creation_base.py', 'depends_on': ['quartier'], 'run': run_index_quartier},
+    {'name': 'captage', 'script': '4_captage.py', 'depends_on': ['quartier', 'index_quartier'], 'run': run_captage},
+    {'name': 'station', 'script': '5_station_traitement.py', 'depends_on': ['quartier', 'index_quartier'], 'run': run_station},
+    {'name': 'reservoir', 'script': '6_reservoir.py', 'depends_on': ['quartier', 'index_quartier'], 'run': run_reservoir},
+    {'name': 'relations', 'script': '7_reservoir_reservoir_jirama.py', 'depends_on': ['reservoir'], 'run': run_relations},
+    {'name': 'noeud', 'script': '8_noeud_consommation.py', 'depends_on': ['schema'], 'run': run_noeud},
+    {'name': 'points', 'script': '9_point_de_distribution_particulier.py', 'depends_on': ['quartier', 'noeud'], 'run': run_points},
+    {'name': 'eau_brute', 'script': '10_eau_brute_jirama.py', 'depends_on': ['captage'], 'run': run_eau_brute},
+    {'name': 'eau_traite', 'script': '11_eau_traite_jirama.py', 'depends_on': ['station'], 'run': run_eau_traite},
+    {'name': 'eau_distribue', 'script': '12_eau_distribue.py', 'depends_on': ['points'], 'run': run_eau_distribue},
+    {'name': 'indexes', 'script': '1_creation_base.py',
+     'depends_on': ['relations', 'points', 'eau_brute', 'eau_traite', 'eau_distribue'], 'run': run_indexes},
+]
+
+
+#  Exécution
+def _stage(name):
+    return next(s for s in STAGES if s['name'] == name)
+
+def _check_dependencies(selected):
+    """Vérifie que chaque étape sélectionnée ne dépend que d'étapes placées avant elle"""
+    seen = set()
+    names = {s['name'] for s in selected}
+    for stage in selected:
+        for dep in stage['depends_on']:
+            if dep in names and dep not in seen:
+                raise ValueError(f"Étape '{stage['name']}' placée avant sa dépendance '{dep}'")
+        seen.add(stage['name'])
+
+def _run_stage(stage, state):
+    """Exécute une étape dans ce processus ; retourne ses métriques (voir metrics.py).
+    En cas d'échec, l'exception porte les métriques de l'étape (attribut stage_metrics),
+    y compris depuis un processus du pool."""
+    metrics = None  # non lié si stage_metrics échoue avant son yield
+    try:
+        with stage_metrics(stage['name']) as metrics:
+            stage['run'](load_script(stage['script']), state)
+    except Exception as e:
+        if metrics is not None:
+            e.stage_metrics = metrics.report()
+        raise
+    return metrics.report()
+
+def _run_stage_in_worker(stage_name, state):
+    """Exécute une étape dans un processus du pool ; retourne les entrées d'état produites
+    et les métriques de l'étape"""
+    stage = _stage(stage_name)
+    before = set(state)
+    try:
+        logging.info(f"=== Étape {stage_name} ({stage['script']}) [pid {os.getpid()}] ===")
+        report = _run_stage(stage, state)
+        return {key: value for key, value in state.items() if key not in before}, report
+    finally:
+        close_pools()
+
+def _run_parallel(selected, state, workers, run_report):
+    """Ordonnanceur DAG : soumet chaque étape dès que ses dépendances sont terminées"""
+    names = {s['name'] for s in selected}
+    pending = list(selected)
+    running = {}
+    done = set()
+    failure = None
+
+    # 'spawn' : aucun processus n'hérite des connexions ouvertes du processus parent
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        while pending or running:
+            if failure is None:
+                ready = [s for s in pending
+                         if all(dep in done or dep not in names for dep in s['depends_on'])]
+                for stage in ready:
+                    pending.remove(stage)
+                    future = executor.submit(_run_stage_in_worker, stage['name'], dict(state))
+                    running[future] = stage
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    produced, report = future.result()
+                    state.update(produced)
+                    run_report.add(report)
+                    done.add(stage['name'])
+                    logging.info(f"Étape {stage['name']} terminée")
+                except Exception as e:
+                    if hasattr(e, 'stage_metrics'):
+                        run_report.add(e.stage_metrics)
+                    # Les étapes déjà lancées se terminent ; aucune nouvelle étape n'est soumise
+                    logging.error(f"Échec de l'étape {stage['name']}: {e}")
+                    failure = failure or e
+
+    if failure is not None:
+        raise failure
+    if pending:
+        raise RuntimeError(f"Étapes non exécutées (dépendances non satisfaites): {[s['name'] for s in pending]}")
+
+def run_pipeline(stage_names=None, workers=1, spatial_mode=DEFAULT_SPATIAL_MODE, ingest_workers=1, force=False,
+                 resume=False, sync_mode=DEFAULT_SYNC_MODE, replay_rejects=False, verbosity=DEFAULT_VERBOSITY,
+                 metrics_json=DEFAULT_METRICS_JSON, metrics_textfile=None, partitioned=None, fuzzy=False,
+                 delete_missing=False):
+    """Exécute les étapes demandées (toutes par défaut).
+
+    workers=1 : exécution séquentielle dans l'ordre de STAGES, dans ce processus.
+    workers>1 : les étapes indépendantes tournent en parallèle dans un pool de processus.
+    Une étape en échec interrompt le pipeline : les étapes suivantes en dépendent.
+    spatial_mode : affectation des quartiers des captages/stations/réservoirs (voir spatial.py) ;
+    en mode 'strtree', l'index des quartiers est construit une fois par processus et partagé
+    par ces étapes.
+    partitioned : disposition des tables de volumes à la création du schéma (True :
+    partitionnées par mois) ; None reprend celle de la base (voir 1_creation_base.py).
+    ingest_workers : processus de lecture des fichiers CSV de volumes (voir parallel_ingest.py).
+    force : les chargeurs de fichiers retraitent aussi les fichiers déjà chargés et inchangés
+    (par défaut, seuls les fichiers nouveaux ou modifiés sont lus ; voir manifest.py).
+    resume : les fichiers interrompus repartent de leur dernier lot validé (voir checkpoints.py).
+    sync_mode : synchronisation des communes, captages, stations et réservoirs depuis les
+    bases source ('full', 'watermark' ou 'hash', voir sync.py).
+    delete_missing : les lignes disparues de ces sources sont supprimées de la cible (sauf
+    lignes encore référencées) ; par défaut, elles sont conservées et signalées.
+    replay_rejects : les chargeurs de fichiers (quartiers, points de distribution, volumes)
+    ne retraitent que leurs lignes en quarantaine (voir quarantine.py).
+    fuzzy : rapprochement approché des noms de captages, stations et quartiers inconnus
+    (voir resolvers.py), transmis aux processus des étapes parallèles par l'environnement.
+    verbosity : messages par ligne insérée ('summary', 'sample' ou 'rows', voir log_config.py),
+    transmise aux processus des étapes parallèles par l'environnement.
+    metrics_json, metrics_textfile : rapport d'exécution JSON et fichier texte Prometheus
+    (collecteur textfile de node_exporter) des métriques par étape et par fichier
+    (voir metrics.py), écrits en fin d'exécution, même en cas d'échec ; None : non écrit.
+    Retourne l'état partagé (mappings et statistiques produits par les étapes).
+    """
+    state = {'spatial_mode': spatial_mode, 'ingest_workers': ingest_workers, 'force': force,
+             'resume': resume, 'sync_mode': sync_mode, 'replay_rejects': replay_rejects,
+             'partitioned': partitioned, 'delete_missing': delete_missing}
+    set_verbosity(verbosity)
+    set_fuzzy_matching(fuzzy)
+    clear_quartier_index()
+    invalidate_resolvers()
+    selected = [s for s in STAGES if stage_names is None or s['name'] in stage_names]
+    _check_dependencies(selected)
+    run_report = RunReport('pipeline')
+    try:
+        if workers > 1:
+            _run_parallel(selected, state, workers, run_report)
+        else:
+            for stage in selected:
+                logging.info(f"=== Étape {stage['name']} ({stage['script']}) ===")
+                try:
+                    run_report.add(_run_stage(stage, state))
+                except Exception as e:
+                    if hasattr(e, 'stage_metrics'):
+                        run_report.add(e.stage_metrics)
+                    raise
+        logging.info("Pipeline terminé.")
+        return state
+    finally:
+        close_pools()
+        _write_run_report(run_report, metrics_json, metrics_textfile)
+
+def _write_run_report(run_report, metrics_json, metrics_textfile):
+    """Écrit les métriques de l'exécution ; une erreur d'écriture ne masque pas celle du pipeline"""
+    try:
+        if metrics_json:
+            run_report.write_json(metrics_json)
+        if metrics_textfile:
+            run_report.write_prometheus(metrics_textfile)
+    except OSError as e:
+        logging.error(f"Écriture des métriques impossible: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline complet d'intégration AEP_HARMONISE")
+    parser.add_argument("--stages", nargs="+", choices=[s['name'] for s in STAGES],
+                        help="étapes à exécuter (toutes par défaut, dans l'ordre des dépendances)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="nombre de processus pour exécuter en parallèle les étapes indépendantes")
+    parser.add_argument("--spatial", choices=SPATIAL_MODES, default=DEFAULT_SPATIAL_MODE,
+                        help="affectation des quartiers: requête par ligne, jointure spatiale unique ou index STRtree en mémoire")
+    parser.add_argument("--partitioned", action="store_const", const=True, default=None,
+                        help="crée eau_brute, eau_traite et eau_distribue partitionnées par mois "
+                             "(nouvelle base ; sinon la disposition enregistrée dans la base est reprise)")
+    parser.add_argument("--ingest-workers", type=int, default=1,
+                        help="processus de lecture des fichiers CSV de volumes (parallèle si > 1)")
+    parser.add_argument("--force", action="store_true",
+                        help="retraite tous les fichiers d'entrée, y compris ceux déjà chargés et inchangés")
+    parser.add_argument("--resume", action="store_true",
+                        help="reprend les fichiers interrompus après leur dernier lot validé")
+    parser.add_argument("--sync", choices=SYNC_MODES, default=DEFAULT_SYNC_MODE,
+                        help="synchronisation des tables source: complète, par filigrane ou par comparaison d'empreintes")
+    parser.add_argument("--delete-missing", action="store_true",
+                        help="supprime de la cible les communes, captages, stations et réservoirs disparus "
+                             "de la source (sauf lignes encore référencées)")
+    parser.add_argument("--replay-rejects", action="store_true",
+                        help="les chargeurs de fichiers ne retraitent que leurs lignes en quarantaine")
+    parser.add_argument("--fuzzy", action="store_true",
+                        help="rapproche les noms inconnus par similarité de trigrammes (chaque rapprochement est journalisé)")
+    parser.add_argument("--verbosity", choices=VERBOSITY_LEVELS, default=DEFAULT_VERBOSITY,
+                        help="messages par ligne insérée: résumé par étape seul, échantillon ou tous")
+    parser.add_argument("--metrics-json", default=DEFAULT_METRICS_JSON,
+                        help="rapport d'exécution JSON (métriques par étape et par fichier)")
+    parser.add_argument("--metrics-textfile", metavar="FICHIER.prom",
+                        help="fichier texte Prometheus pour le collecteur textfile de node_exporter")
+    args = parser.parse_args()
+
+    try:
+        run_pipeline(args.stages, workers=args.workers, spatial_mode=args.spatial,
+                     ingest_workers=args.ingest_workers, force=args.force, resume=args.resume,
+                     sync_mode=args.sync, replay_rejects=args.replay_rejects,
+                     verbosity=args.verbosity, metrics_json=args.metrics_json,
+                     metrics_textfile=args.metrics_textfile, partitioned=args.partitioned,
+                     fuzzy=args.fuzzy, delete_missing=args.delete_missing)
+    except Exception as e:
+        logging.critical(f"Échec du pipeline: {str(e)}", exc_info=True)
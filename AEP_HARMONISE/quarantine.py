@@ -0,0 +1,131 @@
+# --- QUARANTAINE DES LIGNES REJETÉES ---
+# Les chargeurs de fichiers (3 GeoJSON, 9 Excel, 10, 11 et 12 CSV) n'écrivent plus seulement
+# leurs rejets dans le journal : chaque ligne rejetée est enregistrée en masse dans la table
+# ingestion_quarantine avec son contenu brut (payload JSON), son fichier, sa ligne et un
+# code motif. Une ligne est identifiée par (étape, fichier, ligne) : un fichier relu met à
+# jour ses rejets au lieu de les dupliquer, et un fichier retraité depuis le début efface
+# d'abord ses anciens rejets.
+# Mode rejeu (--replay-rejects) : après correction des références (alias, captages, points
+# de distribution...), seules les lignes en quarantaine de l'étape sont retraitées, dans
+# une transaction ; celles qui échouent encore y retournent avec leur nouveau motif.
+
+import os
+import json
+import logging
+from collections import Counter, namedtuple
+from bulk_copy import upsert_rows
+
+# Codes motif
+FORMAT_INVALIDE = 'format_invalide'          # ligne illisible (colonnes manquantes...)
+QUANTITE_INVALIDE = 'quantite_invalide'
+DATE_INVALIDE = 'date_invalide'
+REFERENCE_MANQUANTE = 'reference_manquante'  # nom de captage/station ou ref_borne absent
+REFERENCE_INCONNUE = 'reference_inconnue'    # captage, station ou point de distribution introuvable
+DONNEE_MANQUANTE = 'donnee_manquante'        # champ obligatoire absent (id_com, code_quartier)
+GEOMETRIE_MANQUANTE = 'geometrie_manquante'
+REFUS_BASE = 'refus_base'                    # ligne refusée par la base (voir batch_writer.py)
+
+QUARANTINE_COLUMNS = ('stage', 'source_file', 'source_line', 'reason', 'detail', 'payload')
+
+QuarantineEntry = namedtuple('QuarantineEntry', 'source_file source_line reason detail payload')
+
+
+def _to_json(payload):
+    return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class Quarantine:
+    """Rejets d'une étape, mis en attente puis écrits en masse par flush().
+
+    Sans la table ingestion_quarantine (schéma pas encore migré), les rejets sont
+    seulement comptés et journalisés.
+    """
+
+    def __init__(self, conn, stage):
+        self.stage = stage
+        self.pending = {}  # (fichier, ligne) -> ligne à écrire (la dernière l'emporte)
+        self.stats = Counter()
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('ingestion_quarantine') IS NOT NULL;")
+            self.available = cur.fetchone()[0]
+        if not self.available:
+            logging.warning("Table ingestion_quarantine absente : les rejets ne sont que journalisés")
+
+    def add(self, reason, payload, source_file, source_line, detail=None):
+        """Met en attente une ligne rejetée (payload : contenu brut, sérialisable en JSON)"""
+        path = os.path.abspath(source_file)
+        self.pending[(path, source_line)] = (self.stage, path, source_line, reason, detail, _to_json(payload))
+        self.stats[reason] += 1
+
+    def flush(self, cur):
+        """Écrit les rejets en attente (dans la transaction de l'appelant) ; retourne leur nombre"""
+        rows = list(self.pending.values())
+        self.pending = {}
+        if not rows or not self.available:
+            return 0
+        upsert_rows(cur, 'ingestion_quarantine', QUARANTINE_COLUMNS, rows,
+                    ('stage', 'source_file', 'source_line'), on_conflict='update')
+        return len(rows)
+
+    def discard(self):
+        """Oublie les rejets en attente (transaction de l'appelant annulée)"""
+        self.pending = {}
+
+    def forget_file(self, cur, source_file):
+        """Efface les rejets précédents d'un fichier retraité depuis le début"""
+        if self.available:
+            cur.execute("DELETE FROM ingestion_quarantine WHERE stage = %s AND source_file = %s;",
+                        (self.stage, os.path.abspath(source_file)))
+
+    def take(self, cur):
+        """Retire de la quarantaine les lignes de l'étape (rejeu) : {fichier: [QuarantineEntry]}
+        par fichier et par ligne. Annuler la transaction les y remet."""
+        if not self.available:
+            return {}
+        cur.execute("""
+            DELETE FROM ingestion_quarantine WHERE stage = %s
+            RETURNING source_file, source_line, reason, detail, payload;
+        """, (self.stage,))
+        entries = {}
+        for entry in sorted((QuarantineEntry(*row) for row in cur.fetchall()),
+                            key=lambda e: (e.source_file, e.source_line)):
+            entries.setdefault(entry.source_file, []).append(entry)
+        return entries
+
+    def log_summary(self):
+        if self.stats:
+            detail = ', '.join(f"{reason}: {count}" for reason, count in sorted(self.stats.items()))
+            logging.warning(f"Quarantaine {self.stage}: {sum(self.stats.values())} ligne(s) rejetée(s) ({detail})")
+
+
+def replay(conn, stage, process, written_keys=('inserted',)):
+    """Rejoue les lignes en quarantaine d'une étape, fichier par fichier, en une transaction.
+
+    process(cur, source_file, entries, quarantine) retraite les lignes d'un fichier et
+    remet en quarantaine (quarantine.add) celles qui échouent encore ; retourne ses stats.
+    written_keys : compteurs de ces stats qui comptent les lignes écrites en base.
+    Retourne {'taken', 'recovered', 'still_rejected', 'ignored', 'files': {fichier: stats}} ;
+    recovered compte les lignes réellement écrites, ignored celles ni écrites ni rejetées
+    (doublons déjà en base...).
+    """
+    quarantine = Quarantine(conn, stage)
+    stats = {'taken': 0, 'recovered': 0, 'still_rejected': 0, 'ignored': 0, 'files': {}}
+    try:
+        with conn.cursor() as cur:
+            by_file = quarantine.take(cur)
+            for source_file, entries in by_file.items():
+                stats['taken'] += len(entries)
+                file_stats = process(cur, source_file, entries, quarantine)
+                stats['files'][os.path.basename(source_file)] = file_stats
+                stats['recovered'] += sum(file_stats.get(key, 0) for key in written_keys)
+            stats['still_rejected'] = quarantine.flush(cur)
+            stats['ignored'] = stats['taken'] - stats['recovered'] - stats['still_rejected']
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logging.info(f"Rejeu de la quarantaine {stage}: {stats['taken']} ligne(s) rejouée(s), "
+                 f"{stats['recovered']} récupérée(s), {stats['still_rejected']} toujours rejetée(s), "
+                 f"{stats['ignored']} ignorée(s)")
+    quarantine.log_summary()
+    return stats
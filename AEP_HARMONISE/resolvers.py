@@ -0,0 +1,334 @@
+# --- RÉSOLUTION DES RÉFÉRENCES EN MÉMOIRE ---
+# Les scripts de volumes et de points de distribution retrouvent captages, stations,
+# réservoirs, quartiers, noeuds et points par leur nom ou leur référence. Chaque table de
+# référence (quelques milliers de lignes au plus) est chargée une fois dans un dictionnaire
+# à clés normalisées ; les recherches se font ensuite en mémoire, sans requête par ligne.
+# Un script qui insère dans une table de référence appelle invalidate_resolvers(table).
+# La normalisation reprend les comparaisons SQL d'origine : libellés comparés par
+# UPPER(TRIM(...)) (espaces intérieurs conservés), quartier cherché sous la forme 'FKT <nom>',
+# ref_borne exacte (espaces de bord exceptés). Deux libellés distincts confondus par la
+# normalisation sont journalisés et leur clé reste non résolue (ni l'un ni l'autre n'est choisi).
+# Ordre de résolution : alias enregistré (table reference_alias), libellé exact normalisé,
+# puis, sur demande seulement (set_fuzzy_matching, option --fuzzy), pour les noms de
+# captages, stations et quartiers, meilleur candidat d'un index de trigrammes au-dessus d'un
+# seuil de confiance : chaque rapprochement est journalisé avec son score, les cas ambigus
+# sont rapportés, non résolus. Le choix passe par la variable d'environnement
+# AEP_FUZZY_MATCHING, héritée par les processus enfants (comme la verbosité de log_config.py).
+
+import os
+import logging
+from collections import Counter
+
+# Préfixe des libellés de quartier ("FKT ANDOHALO" pour "ANDOHALO")
+QUARTIER_PREFIX = "FKT "
+
+# Rapprochement approché : tables concernées, score minimal (similarité de trigrammes,
+# 0 à 1) et écart minimal entre les deux meilleurs candidats pour trancher
+FUZZY_REFERENCES = ('captage', 'station_traitement', 'quartier')
+FUZZY_THRESHOLD = 0.7
+FUZZY_MARGIN = 0.1
+FUZZY_ENV = 'AEP_FUZZY_MATCHING'
+
+
+def set_fuzzy_matching(enabled):
+    """Active le rapprochement approché dans ce processus et ses processus enfants"""
+    os.environ[FUZZY_ENV] = '1' if enabled else '0'
+
+def fuzzy_matching_enabled():
+    return os.environ.get(FUZZY_ENV) == '1'
+
+
+#  Normalisation des clés
+def normalize_name(value):
+    """Majuscules, espaces de début/fin supprimés (équivalent de UPPER(TRIM(...)))"""
+    if value is None:
+        return None
+    normalized = str(value).strip().upper()
+    return normalized or None
+
+def normalize_ref(value):
+    """Référence exacte (sensible à la casse), espaces de début/fin supprimés"""
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+def quartier_keys(value):
+    """Clé d'un nom de quartier source : libellé cherché sous la forme 'FKT <nom>'"""
+    name = normalize_name(value)
+    return [normalize_name(f"{QUARTIER_PREFIX}{name}")] if name else []
+
+def normalize_troncon(value):
+    """Tronçon au format 'A->B' (les variantes 'A - B' et 'A -> B' sont ramenées à 'A->B')"""
+    normalized = normalize_name(value)
+    if not normalized:
+        return None
+    parts = [p.strip() for p in normalized.replace(" - ", "->").split("->")]
+    return "->".join(parts)
+
+def troncon_keys(value):
+    """Clés candidates d'un tronçon : sens donné puis sens inverse"""
+    key = normalize_troncon(value)
+    if not key:
+        return []
+    parts = key.split("->")
+    if len(parts) == 2:
+        return [key, f"{parts[1]}->{parts[0]}"]
+    return [key]
+
+def trigrams(key):
+    """Trigrammes d'une clé normalisée, mot par mot (même découpage que pg_trgm)"""
+    grams = set()
+    for word in key.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+# Tables de référence : requête de chargement (libellé, id) et normalisation des clés
+REFERENCES = {
+    'captage': ("SELECT libelle_capt, id_capt FROM captage ORDER BY id_capt", normalize_name),
+    'station_traitement': ("SELECT libelle, id_station FROM station_traitement ORDER BY id_station", normalize_name),
+    'reservoir': ("SELECT libelle, id_reservoir FROM reservoir ORDER BY id_reservoir", normalize_name),
+    'quartier': ("SELECT lib_quartier, id_quartier FROM quartier ORDER BY id_quartier", normalize_name),
+    'noeud_consommation': ("SELECT troncon, id_noeud_cons FROM noeud_consommation ORDER BY id_noeud_cons", normalize_troncon),
+    'point_de_distribution': ("SELECT ref_borne, id_point_dist FROM point_de_distribution ORDER BY id_point_dist", normalize_ref),
+}
+
+# Clés candidates d'une valeur recherchée (par défaut : la clé normalisée seule)
+_LOOKUP_KEYS = {
+    'quartier': quartier_keys,
+    'noeud_consommation': troncon_keys,
+}
+
+
+#  Résolveur
+class ReferenceResolver:
+    """Dictionnaire {clé normalisée: id} d'une table de référence, chargé une fois.
+
+    En cas de doublon de libellé, l'id le plus petit est retenu (équivalent du LIMIT 1) ;
+    deux libellés différents ramenés à la même clé sont journalisés et la clé est retirée
+    (recherche non résolue, voir collisions).
+    stats : chargements, recherches trouvées (hits) et non trouvées (misses), dont
+    résolues par alias ou par rapprochement approché, et cas ambigus.
+    """
+
+    def __init__(self, reference):
+        if reference not in REFERENCES:
+            raise ValueError(f"Table de référence inconnue: {reference}")
+        self.reference = reference
+        self.query, self.normalize = REFERENCES[reference]
+        self.lookup_keys = _LOOKUP_KEYS.get(reference, lambda value: [self.normalize(value)])
+        self.fuzzy = False  # fixé au chargement (voir set_fuzzy_matching)
+        self.ids = None
+        self.labels = {}     # clé -> libellé d'origine (contrôle des collisions)
+        self.collisions = {}  # clé -> libellés distincts confondus (clé non résolue)
+        self.aliases = {}
+        self.grams = {}      # trigramme -> clés qui le contiennent
+        self.key_grams = {}  # clé -> trigrammes
+        self.fuzzy_cache = {}  # clé recherchée -> id (ou None), évalué une seule fois
+        self.fuzzy_matches = {}  # clé recherchée -> (libellé retenu, score)
+        self.ambiguous = {}  # clé recherchée -> [(libellé, score), ...]
+        self.stats = {'loads': 0, 'hits': 0, 'misses': 0, 'aliases': 0, 'fuzzy': 0, 'ambiguous': 0,
+                      'collisions': 0}
+
+    @property
+    def loaded(self):
+        return self.ids is not None
+
+    def load(self, conn):
+        """(Re)charge la table de référence en une requête"""
+        with conn.cursor() as cur:
+            cur.execute(self.query)
+            rows = cur.fetchall()
+        self.ids, self.labels, self.collisions = {}, {}, {}
+        for label, ref_id in rows:
+            key = self.normalize(label)
+            if key is None:
+                continue
+            if key in self.ids and self.labels[key] != label and self.ids[key] != ref_id:
+                self.collisions.setdefault(key, [self.labels[key]]).append(label)
+                continue
+            self.ids.setdefault(key, ref_id)
+            self.labels.setdefault(key, label)
+        for key in self.collisions:
+            self._drop_collision(key)
+        self.aliases = load_aliases(conn, self.reference, self.normalize, self.lookup_keys)
+        self.grams, self.key_grams = {}, {}
+        self.fuzzy_cache = {}
+        self.fuzzy = self.reference in FUZZY_REFERENCES and fuzzy_matching_enabled()
+        if self.fuzzy:
+            for key in self.ids:
+                self._index(key)
+        self.stats['loads'] += 1
+        logging.info(f"Référence {self.reference} chargée: {len(self.ids)} clés, {len(self.aliases)} alias")
+        return self
+
+    def _index(self, key):
+        grams = trigrams(key)
+        self.key_grams[key] = grams
+        for gram in grams:
+            self.grams.setdefault(gram, set()).add(key)
+
+    def _drop_collision(self, key):
+        """Retire une clé confondue par la normalisation : ses recherches restent non résolues"""
+        self.ids.pop(key, None)
+        self.labels.pop(key, None)
+        for gram in self.key_grams.pop(key, ()):
+            self.grams[gram].discard(key)
+        self.stats['collisions'] += 1
+        listed = ' / '.join(f"'{label}'" for label in self.collisions[key])
+        logging.warning(f"Référence {self.reference}: libellés {listed} confondus par la normalisation "
+                        f"('{key}') ; clé non résolue, corriger les libellés en base")
+
+    def invalidate(self):
+        """Oublie le contenu chargé : la prochaine recherche rechargera la table"""
+        self.ids = None
+
+    def add(self, label, ref_id):
+        """Enregistre une référence qui vient d'être insérée (sans rechargement)"""
+        key = self.normalize(label)
+        if not self.loaded or key is None:
+            return
+        if key in self.collisions:
+            self.collisions[key].append(label)
+        elif key in self.ids:
+            if self.labels[key] != label and self.ids[key] != ref_id:
+                self.collisions[key] = [self.labels[key], label]
+                self._drop_collision(key)
+                self.fuzzy_cache = {}
+        else:
+            self.ids[key] = ref_id
+            self.labels[key] = label
+            if self.fuzzy:
+                self._index(key)
+            self.fuzzy_cache = {}
+
+    def resolve(self, value):
+        """Id correspondant à value, ou None"""
+        if self.ids is None:
+            raise RuntimeError(f"Référence {self.reference} non chargée")
+        keys = [key for key in self.lookup_keys(value) if key is not None]
+        for key in keys:
+            target = self.aliases.get(key)
+            if target in self.ids:
+                self.stats['hits'] += 1
+                self.stats['aliases'] += 1
+                return self.ids[target]
+        for key in keys:
+            if key in self.ids:
+                self.stats['hits'] += 1
+                return self.ids[key]
+        if self.fuzzy and keys:
+            ref_id = self._fuzzy_resolve(keys[0])
+            if ref_id is not None:
+                self.stats['hits'] += 1
+                self.stats['fuzzy'] += 1
+                return ref_id
+        self.stats['misses'] += 1
+        return None
+
+    def resolve_many(self, values):
+        """{valeur: id ou None} pour un ensemble de valeurs (chaque valeur distincte une fois)"""
+        return {value: self.resolve(value) for value in set(values)}
+
+    def candidates(self, key, limit=3):
+        """Meilleurs libellés candidats [(clé, score)] par similarité de trigrammes"""
+        grams = trigrams(key)
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            for candidate in self.grams.get(gram, ()):
+                shared[candidate] += 1
+        scored = [(candidate, count / len(grams | self.key_grams[candidate]))
+                  for candidate, count in shared.items()]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
+
+    def _fuzzy_resolve(self, key):
+        """Meilleur candidat si son score atteint le seuil et le départage du second"""
+        if key in self.fuzzy_cache:
+            return self.fuzzy_cache[key]
+        ref_id = None
+        scored = [(c, score) for c, score in self.candidates(key) if score >= FUZZY_THRESHOLD]
+        if scored:
+            best, best_score = scored[0]
+            rivals = [(c, score) for c, score in scored[1:]
+                      if best_score - score < FUZZY_MARGIN and self.ids[c] != self.ids[best]]
+            if rivals:
+                self.ambiguous[key] = [(best, round(best_score, 3))] + [(c, round(sc, 3)) for c, sc in rivals]
+                self.stats['ambiguous'] += 1
+            else:
+                ref_id = self.ids[best]
+                self.fuzzy_matches[key] = (best, round(best_score, 3))
+                logging.warning(f"Rapprochement approché {self.reference}: '{key}' -> '{best}' "
+                                f"(score {best_score:.3f}) ; ajouter un alias pour le confirmer")
+        self.fuzzy_cache[key] = ref_id
+        return ref_id
+
+    def log_stats(self):
+        logging.info(f"Résolution {self.reference}: {self.stats['hits']} trouvée(s) "
+                     f"(dont {self.stats['aliases']} par alias, {self.stats['fuzzy']} approchée(s)), "
+                     f"{self.stats['misses']} non trouvée(s), {self.stats['loads']} chargement(s), "
+                     f"{self.stats['collisions']} collision(s) de libellés")
+        for key, candidates in sorted(self.ambiguous.items()):
+            listed = ', '.join(f"'{label}' ({score})" for label, score in candidates)
+            logging.warning(f"  Ambigu {self.reference}: '{key}' -> {listed} ; ajouter un alias pour trancher")
+
+
+#  Alias persistés
+def load_aliases(conn, reference, normalize=normalize_name, lookup_keys=None):
+    """{alias normalisé: libellé normalisé} de la table reference_alias (vide si absente).
+    L'alias (valeur source) prend la première clé de recherche lookup_keys, le libellé
+    (valeur en base) la normalisation normalize."""
+    if lookup_keys is None:
+        lookup_keys = lambda value: [normalize(value)]
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('reference_alias') IS NOT NULL;")
+        if not cur.fetchone()[0]:
+            return {}
+        cur.execute("SELECT alias, libelle FROM reference_alias WHERE reference = %s;", (reference,))
+        aliases = {}
+        for alias, libelle in cur.fetchall():
+            keys = [key for key in lookup_keys(alias) if key]
+            if keys and normalize(libelle):
+                aliases[keys[0]] = normalize(libelle)
+        return aliases
+
+def add_alias(conn, reference, alias, libelle):
+    """Enregistre (ou remplace) un alias ; le résolveur de la table est invalidé"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO reference_alias (reference, alias, libelle) VALUES (%s, %s, %s)
+            ON CONFLICT (reference, alias) DO UPDATE SET libelle = EXCLUDED.libelle;
+        """, (reference, alias, libelle))
+    invalidate_resolvers(reference)
+
+
+#  Registre partagé (une instance par table de référence et par processus)
+_resolvers = {}
+
+def get_resolver(conn, reference):
+    """Résolveur de la table de référence, chargé via conn au premier usage"""
+    resolver = _resolvers.get(reference)
+    if resolver is None:
+        resolver = _resolvers[reference] = ReferenceResolver(reference)
+    if not resolver.loaded:
+        resolver.load(conn)
+    return resolver
+
+def invalidate_resolvers(*references):
+    """Invalide les résolveurs des tables données (toutes si aucune n'est donnée)"""
+    for reference in references or list(_resolvers):
+        if reference in _resolvers:
+            _resolvers[reference].invalidate()
+
+def log_resolver_stats(*references):
+    """Journalise les statistiques des résolveurs donnés (tous si aucun n'est donné)"""
+    for reference in references or list(_resolvers):
+        if reference in _resolvers:
+            _resolvers[reference].log_stats()
+
+def resolver_stats():
+    """{table: stats} des résolveurs utilisés"""
+    return {reference: dict(resolver.stats) for reference, resolver in _resolvers.items()}
@@ -0,0 +1,192 @@
+# --- AFFECTATION SPATIALE DES QUARTIERS ---
+# captage, station_traitement et reservoir sont rattachés au quartier qui contient leur
+# géométrie. Modes (défaut commun aux scripts 4/5/6 et au pipeline : 'join') :
+#   'row'  : une requête ST_Contains par ligne source (find_quartier_id des scripts 4/5/6)
+#   'join' : les lignes source sont déposées en masse (COPY) dans une table temporaire,
+#            puis affectées et insérées par un seul INSERT ... SELECT joint sur quartier.geom
+#            (index GIST) ; les lignes hors de tout quartier ressortent de la même requête.
+#   'strtree' : les polygones des quartiers sont chargés une fois dans un index STRtree
+#            (shapely 2, géométries préparées) gardé en cache pendant l'exécution ; les
+#            géométries source sont affectées par tableaux entiers, sans requête PostgreSQL.
+
+import logging
+from psycopg2 import sql
+from bulk_copy import copy_rows, copy_rows_returning, DEFAULT_CHUNK_SIZE
+
+SPATIAL_MODES = ('row', 'join', 'strtree')
+DEFAULT_SPATIAL_MODE = 'join'
+
+# Nombre d'identifiants d'orphelins repris dans le rapport
+ORPHAN_SAMPLE_SIZE = 20
+
+# Index des quartiers (mode 'strtree'), construit au premier usage
+_quartier_index = None
+
+
+def insert_with_quartier(cur, table, id_column, columns, rows, geom_column='geom',
+                         chunk_size=DEFAULT_CHUNK_SIZE):
+    """Insère rows dans table en affectant id_quartier par une jointure spatiale unique.
+
+    columns ne contient pas id_quartier et doit contenir geom_column.
+    Retourne une liste alignée sur rows : (nouvel id, id_quartier) pour les lignes
+    insérées, None pour les lignes situées hors de tout quartier (non insérées).
+    """
+    columns = list(columns)
+    if geom_column not in columns:
+        raise ValueError(f"Colonne géométrique '{geom_column}' absente de {columns}")
+    if not rows:
+        return []
+
+    stage = f"_spatial_{table}"
+    column_list = sql.SQL(', ').join(sql.Identifier(c) for c in columns)
+    staged_list = sql.SQL(', ').join(sql.SQL("s.{}").format(sql.Identifier(c)) for c in columns)
+
+    # Table de transit aux types de la table cible, sans ses contraintes (id_quartier NOT NULL)
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(stage)))
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} AS SELECT {} FROM {} WITH NO DATA").format(
+        sql.Identifier(stage), column_list, sql.Identifier(table)))
+    cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN pos INTEGER").format(sql.Identifier(stage)))
+    copy_rows(cur, stage, ['pos'] + columns,
+              ((pos,) + tuple(row) for pos, row in enumerate(rows)), chunk_size=chunk_size)
+    cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(stage)))
+
+    # Une seule requête : affectation, réservation des ids, insertion et restitution des orphelins
+    cur.execute(sql.SQL("""
+        WITH assigned AS (
+            SELECT s.pos, q.id_quartier,
+                   CASE WHEN q.id_quartier IS NOT NULL
+                        THEN nextval(pg_get_serial_sequence(%s, %s)) END AS new_id,
+                   {staged}
+            FROM {stage} s
+            LEFT JOIN LATERAL (
+                SELECT id_quartier FROM quartier
+                WHERE ST_Contains(quartier.geom, s.{geom})
+                LIMIT 1
+            ) q ON TRUE
+        ), inserted AS (
+            INSERT INTO {table} ({id_column}, {columns}, id_quartier)
+            SELECT new_id, {columns}, id_quartier FROM assigned WHERE new_id IS NOT NULL
+        )
+        SELECT pos, new_id, id_quartier FROM assigned ORDER BY pos;
+    """).format(
+        staged=staged_list,
+        stage=sql.Identifier(stage),
+        geom=sql.Identifier(geom_column),
+        table=sql.Identifier(table),
+        id_column=sql.Identifier(id_column),
+        columns=column_list,
+    ), (table, id_column))
+
+    assigned = [None] * len(rows)
+    for pos, new_id, quartier_id in cur.fetchall():
+        if new_id is not None:
+            assigned[pos] = (new_id, quartier_id)
+
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(stage)))
+    return assigned
+
+#  Index STRtree des quartiers
+def _import_shapely():
+    try:
+        import shapely
+    except ImportError as e:
+        raise ImportError("Le mode d'affectation 'strtree' nécessite shapely >= 2 (pip install shapely)") from e
+    return shapely
+
+def get_quartier_index(cur, refresh=False):
+    """Charge les polygones des quartiers dans un STRtree (une fois par exécution).
+
+    Retourne un dict {'ids', 'geoms', 'tree'} : ids[i] est l'id_quartier de geoms[i].
+    Les polygones sont préparés : les tests de contenance sont faits sans recalcul.
+    """
+    global _quartier_index
+    if _quartier_index is None or refresh:
+        shapely = _import_shapely()
+        cur.execute("""
+            SELECT id_quartier, ST_AsBinary(geom)
+            FROM quartier
+            WHERE geom IS NOT NULL
+            ORDER BY id_quartier;
+        """)
+        rows = cur.fetchall()
+        ids = [r[0] for r in rows]
+        geoms = shapely.from_wkb([bytes(r[1]) for r in rows])
+        shapely.prepare(geoms)
+        _quartier_index = {'ids': ids, 'geoms': geoms, 'tree': shapely.STRtree(geoms)}
+        logging.info(f"Index STRtree des quartiers construit ({len(ids)} polygones)")
+    return _quartier_index
+
+def clear_quartier_index():
+    """Invalide l'index (à appeler après un rechargement de la table quartier)"""
+    global _quartier_index
+    _quartier_index = None
+
+def assign_quartiers(cur, geoms):
+    """Affecte un id_quartier à chaque géométrie (EWKB hexadécimal tel que renvoyé par
+    psycopg2, ou bytes). Retourne une liste alignée sur geoms (None hors de tout quartier).
+
+    Même règle que ST_Contains(quartier.geom, geom) ; en cas de chevauchement, le
+    quartier de plus petit id l'emporte.
+    """
+    if not geoms:
+        return []
+    shapely = _import_shapely()
+    index = get_quartier_index(cur)
+    points = shapely.from_wkb(list(geoms), on_invalid='warn')
+
+    # Candidats par boîte englobante, puis test exact vectorisé sur les polygones préparés
+    source_idx, tree_idx = index['tree'].query(points)
+    hits = shapely.contains(index['geoms'][tree_idx], points[source_idx])
+    source_idx, tree_idx = source_idx[hits], tree_idx[hits]
+
+    assigned = [None] * len(geoms)
+    for i, t in sorted(zip(source_idx.tolist(), tree_idx.tolist())):
+        if assigned[i] is None:
+            assigned[i] = index['ids'][t]
+    return assigned
+
+
+#  Insertion
+def insert_located(cur, table, id_column, columns, keys, rows, spatial_mode=DEFAULT_SPATIAL_MODE):
+    """Insère des lignes dont la dernière colonne est id_quartier, selon le mode d'affectation.
+
+    Mode 'row' : id_quartier est déjà renseigné, insertion directe par COPY.
+    Mode 'join' : id_quartier (None dans rows) est affecté par insert_with_quartier.
+    Mode 'strtree' : id_quartier (None dans rows) est affecté en mémoire par assign_quartiers.
+    Retourne (liste de (clé source, valeurs avec id_quartier, nouvel id), clés orphelines).
+    """
+    if spatial_mode not in SPATIAL_MODES:
+        raise ValueError(f"Mode d'affectation spatiale inconnu: {spatial_mode}")
+    if columns[-1] != 'id_quartier':
+        raise ValueError(f"id_quartier doit être la dernière colonne: {columns}")
+
+    if spatial_mode == 'row':
+        new_ids = copy_rows_returning(cur, table, id_column, columns, rows)
+        return list(zip(keys, rows, new_ids)), []
+
+    if spatial_mode == 'strtree':
+        geom_pos = columns.index('geom')
+        assigned = assign_quartiers(cur, [values[geom_pos] for values in rows])
+        located = [(key, tuple(values[:-1]) + (quartier_id,))
+                   for key, values, quartier_id in zip(keys, rows, assigned) if quartier_id is not None]
+        orphans = [key for key, quartier_id in zip(keys, assigned) if quartier_id is None]
+        new_ids = copy_rows_returning(cur, table, id_column, columns, [values for _, values in located])
+        return [(key, values, new_id) for (key, values), new_id in zip(located, new_ids)], orphans
+
+    assigned = insert_with_quartier(cur, table, id_column, columns[:-1], [values[:-1] for values in rows])
+    inserted, orphans = [], []
+    for key, values, result in zip(keys, rows, assigned):
+        if result is None:
+            orphans.append(key)
+        else:
+            new_id, quartier_id = result
+            inserted.append((key, tuple(values[:-1]) + (quartier_id,), new_id))
+    return inserted, orphans
+
+def report_orphans(label, keys):
+    """Journalise en une fois les objets situés hors de tout quartier"""
+    if not keys:
+        return
+    sample = ', '.join(str(k) for k in keys[:ORPHAN_SAMPLE_SIZE])
+    more = f" (+{len(keys) - ORPHAN_SAMPLE_SIZE} autres)" if len(keys) > ORPHAN_SAMPLE_SIZE else ""
+    logging.warning(f"{len(keys)} {label} hors de tout quartier, non migré(s): {sample}{more}")
@@ -0,0 +1,326 @@
+# --- SYNCHRONISATION INCRÉMENTALE DES TABLES SOURCE ---
+# commune (AEP_EAURIZON), captage, station_traitement et reservoir (AEP_JIRAMA) peuvent être
+# rafraîchis sans recopier toute la table source. Pour chaque ligne chargée, la table
+# sync_etat_source garde la clé source, l'empreinte md5 de la ligne (calculée par le serveur
+# source) et l'id cible ; sync_watermark garde la plus grande clé numérique vue. Modes :
+#   'full'      : toute la table est extraite ; les clés déjà chargées (état de
+#                 synchronisation, à défaut id_mapping pour les chargements antérieurs) sont
+#                 mises à jour sur place et les autres insérées : relancer 'full' ne
+#                 duplique pas la cible. L'état est réécrit et sert de base aux
+#                 synchronisations suivantes ;
+#   'watermark' : seules les lignes de clé supérieure au filigrane sont extraites (sources
+#                 en ajout seul, clé numérique) ;
+#   'hash'      : les empreintes source (clé + md5, sans les colonnes) sont comparées à l'état
+#                 par jointure : seules les lignes nouvelles ou modifiées sont extraites ;
+#                 les lignes modifiées sont mises à jour sur place (ids cibles conservés).
+# Les clés disparues de la source ('full' et 'hash', anti-jointure) sont seulement signalées.
+# Avec delete_missing (option --delete-missing), elles sont supprimées de la cible, sauf les
+# lignes encore référencées (volumes, conduites, relations entre réservoirs...) : les clés
+# étrangères en ON DELETE CASCADE / SET NULL effaceraient sinon leur historique.
+
+import logging
+import psycopg2
+from psycopg2 import sql
+from bulk_copy import copy_rows
+from db import stream_query
+from id_mapping import forget_mappings, load_mapping
+
+SYNC_MODES = ('full', 'watermark', 'hash')
+DEFAULT_SYNC_MODE = 'full'
+
+
+class SourceSync:
+    """Synchronisation d'une table source vers une table cible.
+
+    Utilisation : plan() avant l'extraction (filtre SQL de la requête source), puis
+    is_update() / target_id() pour séparer insertions et mises à jour, update_rows(),
+    delete_rows() et enfin record() dans la transaction des écritures.
+    """
+
+    def __init__(self, target_conn, source_system, source_table, key_column,
+                 mode=DEFAULT_SYNC_MODE, watermark_column=None, delete_missing=False):
+        if mode not in SYNC_MODES:
+            raise ValueError(f"Mode de synchronisation inconnu: {mode}")
+        if mode == 'watermark' and not watermark_column:
+            raise ValueError(f"Mode 'watermark' indisponible pour {source_table}: pas de clé numérique")
+        self.conn = target_conn
+        self.system = source_system
+        self.table = source_table
+        self.key_column = key_column
+        self.mode = mode
+        self.watermark_column = watermark_column
+        self.delete_missing = delete_missing
+        self.watermark = None
+        self.hashes = {}    # clé source -> empreinte des lignes extraites
+        self.changed = {}   # clé source -> id cible (lignes modifiées)
+        self.deleted = {}   # clé source -> id cible (clés disparues de la source)
+        self.max_key = None
+        self.stats = {'new': 0, 'changed': 0, 'deleted': 0, 'unchanged': 0}
+        with target_conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('sync_etat_source') IS NOT NULL;")
+            self.available = cur.fetchone()[0]
+        if not self.available:
+            if mode != 'full':
+                raise ValueError("Tables de synchronisation absentes : lancer 1_creation_base.py ou utiliser le mode 'full'")
+            logging.warning("Table sync_etat_source absente : état de synchronisation non enregistré")
+
+    #  Planification
+    def plan(self, source_conn, source_filter="TRUE"):
+        """Calcule les clés à extraire et retourne (condition SQL, paramètres) à ajouter au
+        WHERE de la requête source (colonnes de la table source non préfixées)"""
+        if not self.available:
+            return "TRUE", ()
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT watermark FROM sync_watermark WHERE source_system = %s AND source_table = %s;
+            """, (self.system, self.table))
+            saved = cur.fetchone()
+            self.watermark = saved[0] if saved else None
+
+        condition, params = "TRUE", ()
+        if self.mode == 'watermark' and self.watermark is not None:
+            condition, params = f"{self.watermark_column} > %s", (self.watermark,)
+
+        # Empreintes calculées par le serveur source : seules les clés et les md5 transitent
+        key = f'"{self.key_column}"'
+        wm = f'"{self.watermark_column}"' if self.watermark_column else "NULL"
+        rows = stream_query(source_conn, f"""
+            SELECT {key}::text AS source_key, md5(t::text) AS row_hash, {wm} AS wm
+            FROM "{self.table}" t
+            WHERE ({source_filter}) AND ({condition});
+        """, params, name=f"sync_{self.table}")
+        source = [(r.source_key, r.row_hash, r.wm) for r in rows]
+        self.hashes = {k: h for k, h, _ in source}
+        keys_wm = [w for _, _, w in source if w is not None]
+        self.max_key = max(keys_wm) if keys_wm else None
+
+        if self.mode == 'full':
+            self._match_loaded(source)
+            return condition, params
+        if self.mode != 'hash':
+            self.stats['new'] = len(source)
+            return condition, params
+
+        new_keys = self._diff(source)
+        extract = new_keys + list(self.changed)
+        self.hashes = {k: self.hashes[k] for k in extract}
+        logging.info(f"Synchronisation {self.system}.{self.table}: {self.stats['new']} nouvelle(s), "
+                     f"{self.stats['changed']} modifiée(s), {self.stats['deleted']} disparue(s) de la source, "
+                     f"{self.stats['unchanged']} inchangée(s)")
+        return f"{key}::text = ANY(%s)", (extract,)
+
+    def _match_loaded(self, source):
+        """Mode 'full' : sépare les clés source déjà chargées (à mettre à jour) des nouvelles,
+        et relève les clés chargées absentes de la source (à supprimer)"""
+        with self.conn.cursor() as cur:
+            loaded = load_mapping(cur, self.system, self.table)
+            loaded.update(self.mapping(cur))
+        source_keys = {k for k, _, _ in source}
+        self.changed = {k: loaded[k] for k in source_keys if k in loaded}
+        self.deleted = {k: target_id for k, target_id in loaded.items() if k not in source_keys}
+        self.stats['new'] = len(source_keys) - len(self.changed)
+        self.stats['changed'] = len(self.changed)
+        self.stats['deleted'] = len(self.deleted)
+        logging.info(f"Synchronisation complète {self.system}.{self.table}: {self.stats['new']} nouvelle(s), "
+                     f"{self.stats['changed']} déjà chargée(s) mise(s) à jour, "
+                     f"{self.stats['deleted']} disparue(s) de la source")
+
+    def _diff(self, source):
+        """Compare les empreintes source à l'état enregistré (jointures côté cible)"""
+        with self.conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS _sync_source")
+            cur.execute("CREATE TEMP TABLE _sync_source (source_key TEXT PRIMARY KEY, row_hash TEXT)")
+            copy_rows(cur, '_sync_source', ('source_key', 'row_hash'), ((k, h) for k, h, _ in source))
+
+            state = (self.system, self.table)
+            cur.execute("""
+                SELECT s.source_key, e.target_id, e.row_hash IS NOT DISTINCT FROM s.row_hash
+                FROM _sync_source s
+                LEFT JOIN sync_etat_source e
+                       ON e.source_system = %s AND e.source_table = %s AND e.source_key = s.source_key;
+            """, state)
+            new_keys = []
+            for source_key, target_id, same in cur.fetchall():
+                if target_id is None:
+                    new_keys.append(source_key)
+                elif not same:
+                    self.changed[source_key] = target_id
+                else:
+                    self.stats['unchanged'] += 1
+
+            # Anti-jointure : clés enregistrées absentes de la source
+            cur.execute("""
+                SELECT e.source_key, e.target_id FROM sync_etat_source e
+                WHERE e.source_system = %s AND e.source_table = %s
+                  AND NOT EXISTS (SELECT 1 FROM _sync_source s WHERE s.source_key = e.source_key);
+            """, state)
+            self.deleted = dict(cur.fetchall())
+            cur.execute("DROP TABLE IF EXISTS _sync_source")
+        self.stats['new'] = len(new_keys)
+        self.stats['changed'] = len(self.changed)
+        self.stats['deleted'] = len(self.deleted)
+        return new_keys
+
+    #  Application
+    def is_update(self, source_key):
+        return str(source_key) in self.changed
+
+    def target_id(self, source_key):
+        return self.changed.get(str(source_key))
+
+    def update_rows(self, cur, table, id_column, columns, rows, locate=False):
+        """Met à jour sur place les lignes modifiées : rows = [(id cible, valeurs alignées sur columns)].
+
+        locate : id_quartier (dernière colonne, None hors mode 'row') est recalculé par
+        ST_Contains ; hors de tout quartier, l'ancien quartier est conservé.
+        """
+        if not rows:
+            return 0
+        stage = f"_sync_{table}"
+        columns = list(columns)
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(stage)))
+        cur.execute(sql.SQL("CREATE TEMP TABLE {} AS SELECT {} FROM {} WITH NO DATA").format(
+            sql.Identifier(stage),
+            sql.SQL(', ').join(sql.Identifier(c) for c in [id_column] + columns),
+            sql.Identifier(table)))
+        copy_rows(cur, stage, [id_column] + columns, ((target_id,) + tuple(values) for target_id, values in rows))
+
+        assignments = []
+        for c in columns:
+            if locate and c == 'id_quartier':
+                assignments.append(sql.SQL("""id_quartier = COALESCE(s.id_quartier, (
+                    SELECT q.id_quartier FROM quartier q WHERE ST_Contains(q.geom, s.geom) LIMIT 1
+                ), t.id_quartier)"""))
+            else:
+                assignments.append(sql.SQL("{} = s.{}").format(sql.Identifier(c), sql.Identifier(c)))
+        cur.execute(sql.SQL("UPDATE {} t SET {} FROM {} s WHERE t.{} = s.{}").format(
+            sql.Identifier(table), sql.SQL(', ').join(assignments), sql.Identifier(stage),
+            sql.Identifier(id_column), sql.Identifier(id_column)))
+        updated = cur.rowcount
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(stage)))
+        return updated
+
+    def _keep(self, source_keys, table, reason):
+        """Retire des suppressions les clés données : leurs lignes, leur état et leurs
+        correspondances sont conservés (clés reproposées à la prochaine synchronisation)"""
+        if not source_keys:
+            return
+        for source_key in source_keys:
+            del self.deleted[source_key]
+        listed = ', '.join(sorted(source_keys)[:20])
+        logging.warning(f"{len(source_keys)} ligne(s) de {table} disparue(s) de la source, conservée(s) "
+                        f"({reason}): {listed}")
+
+    def referenced_ids(self, cur, table, id_column, target_ids):
+        """Ids de target_ids encore référencés par une clé étrangère (toutes tables,
+        quelle que soit leur règle ON DELETE)"""
+        cur.execute("""
+            SELECT c.conrelid::regclass::text, a.attname
+            FROM pg_constraint c
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+            JOIN pg_attribute r ON r.attrelid = c.confrelid AND r.attnum = c.confkey[1]
+            WHERE c.contype = 'f' AND c.confrelid = %s::regclass
+              AND cardinality(c.conkey) = 1 AND r.attname = %s;
+        """, (table, id_column))
+        referenced = set()
+        for ref_table, ref_column in cur.fetchall():
+            cur.execute(sql.SQL("SELECT DISTINCT {} FROM {} WHERE {} = ANY(%s)").format(
+                sql.Identifier(ref_column), sql.SQL(ref_table), sql.Identifier(ref_column)),
+                (list(target_ids),))
+            referenced.update(r[0] for r in cur.fetchall())
+        return referenced
+
+    def delete_rows(self, cur, table, id_column):
+        """Supprime de la cible les lignes dont la clé a disparu de la source, seulement avec
+        delete_missing ; sinon elles sont conservées et signalées.
+
+        Une ligne encore référencée (volumes, conduites, relations...) est toujours conservée
+        et signalée : sa clé reste dans l'état et sera reproposée à la prochaine synchronisation.
+        """
+        if not self.deleted:
+            return 0
+        if not self.delete_missing:
+            self._keep(list(self.deleted), table, "--delete-missing pour les supprimer")
+            return 0
+        referenced = self.referenced_ids(cur, table, id_column, self.deleted.values())
+        self._keep([k for k, target_id in self.deleted.items() if target_id in referenced], table,
+                   "encore référencée(s)")
+        if not self.deleted:
+            return 0
+        delete = sql.SQL("DELETE FROM {} WHERE {} = ANY(%s)").format(sql.Identifier(table), sql.Identifier(id_column))
+        cur.execute("SAVEPOINT sync_delete")
+        try:
+            cur.execute(delete, (list(self.deleted.values()),))
+            cur.execute("RELEASE SAVEPOINT sync_delete")
+            return cur.rowcount
+        except psycopg2.IntegrityError:
+            cur.execute("ROLLBACK TO SAVEPOINT sync_delete")
+
+        # Suppression en masse refusée : ligne par ligne pour isoler les lignes référencées
+        kept = []
+        for source_key, target_id in list(self.deleted.items()):
+            cur.execute("SAVEPOINT sync_delete")
+            try:
+                cur.execute(delete, ([target_id],))
+                cur.execute("RELEASE SAVEPOINT sync_delete")
+            except psycopg2.IntegrityError:
+                cur.execute("ROLLBACK TO SAVEPOINT sync_delete")
+                kept.append(source_key)
+                del self.deleted[source_key]
+        if kept:
+            logging.warning(f"{len(kept)} ligne(s) de {table} disparue(s) de la source mais encore "
+                            f"référencée(s), conservée(s): {', '.join(kept[:20])}")
+        return len(self.deleted)
+
+    def record(self, cur, inserted, updated_keys=()):
+        """Enregistre l'état après écriture (dans la même transaction).
+
+        inserted : [(clé source, id cible)] des lignes insérées ; updated_keys : clés mises à jour.
+        """
+        if not self.available:
+            return
+        forget_mappings(cur, self.system, self.table, self.deleted)
+        if self.mode == 'full':
+            cur.execute("DELETE FROM sync_etat_source WHERE source_system = %s AND source_table = %s;",
+                        (self.system, self.table))
+        rows = [(self.system, self.table, str(key), self.hashes.get(str(key)), target_id)
+                for key, target_id in inserted]
+        rows += [(self.system, self.table, key, self.hashes.get(key), self.changed[key])
+                 for key in map(str, updated_keys) if key in self.changed]
+        if rows:
+            cur.execute("DROP TABLE IF EXISTS _sync_etat")
+            cur.execute("CREATE TEMP TABLE _sync_etat (LIKE sync_etat_source INCLUDING DEFAULTS)")
+            copy_rows(cur, '_sync_etat', ('source_system', 'source_table', 'source_key', 'row_hash', 'target_id'), rows)
+            cur.execute("""
+                INSERT INTO sync_etat_source (source_system, source_table, source_key, row_hash, target_id)
+                SELECT source_system, source_table, source_key, row_hash, target_id FROM _sync_etat
+                ON CONFLICT (source_system, source_table, source_key) DO UPDATE SET
+                    row_hash = EXCLUDED.row_hash, target_id = EXCLUDED.target_id, synced_at = now();
+            """)
+            cur.execute("DROP TABLE IF EXISTS _sync_etat")
+        if self.deleted:
+            cur.execute("""
+                DELETE FROM sync_etat_source
+                WHERE source_system = %s AND source_table = %s AND source_key = ANY(%s);
+            """, (self.system, self.table, list(self.deleted)))
+
+        if self.watermark_column:
+            watermark = max(w for w in (self.watermark, self.max_key) if w is not None) \
+                if (self.watermark is not None or self.max_key is not None) else None
+            cur.execute("""
+                INSERT INTO sync_watermark (source_system, source_table, watermark, row_count)
+                SELECT %s, %s, %s, count(*) FROM sync_etat_source
+                WHERE source_system = %s AND source_table = %s
+                ON CONFLICT (source_system, source_table) DO UPDATE SET
+                    watermark = EXCLUDED.watermark, row_count = EXCLUDED.row_count, synced_at = now();
+            """, (self.system, self.table, watermark, self.system, self.table))
+
+    def mapping(self, cur):
+        """{clé source: id cible} de toutes les lignes synchronisées de la table"""
+        if not self.available:
+            return {}
+        cur.execute("""
+            SELECT source_key, target_id FROM sync_etat_source
+            WHERE source_system = %s AND source_table = %s;
+        """, (self.system, self.table))
+        return dict(cur.fetchall())